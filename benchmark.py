@@ -0,0 +1,188 @@
+"""Offline scale benchmarks against mock_cyclecloud
+
+Times the demo.py, cleanup_failed_nodes.py, start_stop_nodes.py and spot_replacement.py flows
+against a local mock CycleCloud holding 500, 5k and 50k nodes. Results can be saved as JSON and
+compared with a previous run to catch regressions:
+
+    python benchmark.py --save bench.json
+    python benchmark.py --baseline bench.json --tolerance 0.25
+
+Flows whose dependencies (requests, cyclecloud-api, scalelib) are not installed are reported
+as skipped. A flow that raises, and a timing in the baseline that this run did not produce
+(e.g. from a skipped or failed flow), count as regressions, and any failed flow makes the run
+exit non-zero.
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+import typing
+
+import mock_cyclecloud
+
+
+DEFAULT_SIZES = [500, 5000, 50000]
+CLUSTER_NAME = "benchTest"
+
+
+def _config(server) -> typing.Dict[str, typing.Any]:
+    return {
+        "url": "http://127.0.0.1:{}".format(server.server_port),
+        "username": "bench",
+        "password": "bench",
+        "verify_certificates": False,
+        "cluster_name": CLUSTER_NAME,
+    }
+
+
+def _timed(results: typing.Dict[str, float], name: str, fn: typing.Callable[[], typing.Any]) -> typing.Any:
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        value = fn()
+    results[name] = time.perf_counter() - start
+    return value
+
+
+def bench_cleanup(config, cc, node_count, results) -> None:
+    import cleanup_failed_nodes
+    from snapshot import SNAPSHOT_ATTRS, NodeSnapshot
+
+    cluster = cleanup_failed_nodes.Cluster(CLUSTER_NAME, config)
+    _timed(results, "cleanup.all_nodes", cluster.all_nodes)
+    snapshot = _timed(results, "cleanup.snapshot", lambda: NodeSnapshot.from_records(cluster.iter_nodes(attrs=SNAPSHOT_ATTRS)))
+    failed = snapshot.node_ids(snapshot.select(statuses=cleanup_failed_nodes.REPORT_FAILURE_STATES))
+    _timed(results, "cleanup.terminate_failed", lambda: cluster.terminate(failed))
+    request_ids = list(cc.clusters[CLUSTER_NAME].request_ids)[:100] or ["missing-request"]
+    _, failures = _timed(results, "cleanup.nodes_fanout", lambda: cluster.nodes(request_ids, parallelism=16))
+    if len(failures) == len(request_ids):
+        raise RuntimeError("every nodes request failed: {}".format(next(iter(failures.values()))))
+
+
+def bench_demo(config, cc, node_count, results) -> None:
+    from cyclecloud.client import Client
+    import demo
+
+    client = Client(config)
+    params = dict(demo.BASE_CLUSTER_PARAMS)
+    _timed(results, "demo.import_cluster", lambda: demo.import_cluster(client, CLUSTER_NAME, "./simple.txt", params,
+                                                                       template_cluster_name="simple"))
+    cc.populate(CLUSTER_NAME, node_count)
+    _timed(results, "demo.start_cluster", lambda: demo.start_cluster(client, CLUSTER_NAME))
+    _timed(results, "demo.get_node_status", lambda: demo.get_node_status(client, CLUSTER_NAME))
+    _timed(results, "demo.terminate_cluster", lambda: demo.terminate_cluster(client, CLUSTER_NAME))
+    _timed(results, "demo.wait_for_termination", lambda: demo.wait_for_cluster_termination(client, CLUSTER_NAME))
+
+
+def bench_start_stop(config, cc, node_count, results) -> None:
+    from hpc.autoscale.node.nodemanager import new_node_manager
+    from node_index import NodeIndex
+    import start_stop_nodes
+
+    cc.populate(CLUSTER_NAME, node_count // 10 or 1, nodearray="execute-spot")
+    node_mgr = _timed(results, "start_stop.new_node_manager", lambda: new_node_manager(config))
+    _timed(results, "start_stop.add_nodes", lambda: start_stop_nodes.add_nodes(node_mgr, CLUSTER_NAME, "execute",
+                                                                               count=min(100, node_count)))
+    # both deallocate paths: the plain scan, and the NodeIndex a multi-nodearray stop shares
+    stopped = _timed(results, "start_stop.deallocate_nodes",
+                     lambda: start_stop_nodes.deallocate_nodes(node_mgr, CLUSTER_NAME, "execute"))
+    index = _timed(results, "start_stop.node_index", lambda: NodeIndex(node_mgr))
+    stopped_spot = _timed(results, "start_stop.deallocate_nodes_indexed",
+                          lambda: start_stop_nodes.deallocate_nodes(node_mgr, CLUSTER_NAME, "execute-spot", index=index))
+    if not stopped or not stopped_spot:
+        raise RuntimeError("deallocate_nodes stopped {} execute and {} execute-spot nodes".format(
+            len(stopped), len(stopped_spot)))
+
+
+def bench_spot_replacement(config, cc, node_count, results) -> None:
+    import spot_replacement
+
+    spot_replacement.CC_CONFIG.update(config)
+    _timed(results, "spot.scale_to_target_count", lambda: spot_replacement.scale_nodearray_to_target_count(
+        CLUSTER_NAME, "execute-spot", node_count // 10 or 1))
+
+
+FLOWS = [bench_cleanup, bench_demo, bench_start_stop, bench_spot_replacement]
+
+
+def run(sizes: typing.List[int], failure_rate: float, latency: float, time_scale: float,
+        failures: typing.Optional[typing.Dict[str, typing.Dict[str, str]]] = None) -> typing.Dict[str, typing.Dict[str, float]]:
+    """{size: {timing name: seconds}}. Flows that raised are added to failures as {size: {flow: error}}"""
+    report: typing.Dict[str, typing.Dict[str, float]] = {}
+    failures = failures if failures is not None else {}
+    for node_count in sizes:
+        results: typing.Dict[str, float] = {}
+        for flow in FLOWS:
+            # a fresh server per flow so that flows do not see each other's nodes
+            cc = mock_cyclecloud.MockCycleCloud(failure_rate=failure_rate, time_scale=time_scale)
+            cc.populate(CLUSTER_NAME, node_count)
+            server, _ = mock_cyclecloud.serve(cc, latency=latency)
+            try:
+                flow(_config(server), cc, node_count, results)
+            except ImportError as e:
+                print("{:>6} nodes: skipping {} ({})".format(node_count, flow.__name__, e), file=sys.stderr)
+            except Exception as e:
+                print("{:>6} nodes: {} failed: {}".format(node_count, flow.__name__, e), file=sys.stderr)
+                failures.setdefault(str(node_count), {})[flow.__name__] = "{}: {}".format(type(e).__name__, e)
+            finally:
+                server.shutdown()
+                server.server_close()
+                with contextlib.suppress(Exception):
+                    import ccrest
+                    ccrest.close_all()
+        report[str(node_count)] = results
+    return report
+
+
+def compare(report, baseline, tolerance: float,
+            failures: typing.Optional[typing.Dict[str, typing.Dict[str, str]]] = None) -> typing.List[str]:
+    regressions = []
+    for size, flows in sorted((failures or {}).items()):
+        for flow, error in sorted(flows.items()):
+            regressions.append("{} nodes {}: failed ({})".format(size, flow, error))
+    for size, results in report.items():
+        for name, seconds in results.items():
+            before = baseline.get(size, {}).get(name)
+            if before and seconds > before * (1 + tolerance):
+                regressions.append("{} nodes {}: {:.3f}s -> {:.3f}s (+{:.0%})".format(
+                    size, name, before, seconds, seconds / before - 1))
+        for name in sorted(set(baseline.get(size, {})) - set(results)):
+            regressions.append("{} nodes {}: missing from this run".format(size, name))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Scale benchmarks against a local mock CycleCloud")
+    parser.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=DEFAULT_SIZES)
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--time-scale", type=float, default=1000.0)
+    parser.add_argument("--save", default=None, help="Write the results as JSON")
+    parser.add_argument("--baseline", default=None, help="Compare against a previous --save")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    failures: typing.Dict[str, typing.Dict[str, str]] = {}
+    report = run(args.sizes, args.failure_rate, args.latency, args.time_scale, failures)
+    for size, results in report.items():
+        for name, seconds in sorted(results.items()):
+            print("{:>6} nodes  {:32} {:9.3f}s".format(size, name, seconds))
+
+    if args.save:
+        with open(args.save, "w") as fw:
+            json.dump(report, fw, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fr:
+            regressions = compare(report, json.load(fr), args.tolerance, failures)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+    if failures:
+        sys.exit("{} flow runs failed".format(sum(len(flows) for flows in failures.values())))
+
+
+if __name__ == "__main__":
+    main()
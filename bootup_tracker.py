@@ -0,0 +1,230 @@
+"""Waits for exactly the nodes started by one bootup()
+
+node_mgr.bootup() returns the operation id of the nodes it started. track_bootup polls
+/clusters/{name}/nodes?operation={id} (with conditional requests) instead of the whole cluster,
+prints each node's state transitions as they are seen and reports the batch's time-to-ready
+distribution:
+
+    result = capacity.bootup()
+    report = track_bootup(get_rest_client(CC_CONFIG), cluster_name, result)
+    print(report.summary())
+
+A PhaseTracer passed to track_bootup also records every node's transitions (Acquiring,
+Preparing, Ready or Failed) with timestamps, along with the node's SKU, region and nodearray.
+It reports percentile latencies of each phase per SKU, region or nodearray and appends the
+transitions to a JSON Lines time series. Reports over the accumulated series show which
+machine types and regions start fastest:
+
+    python bootup_tracker.py bootup_trace.jsonl --by vm_size
+"""
+import argparse
+import json
+import logging
+import math
+import time
+import typing
+
+import metrics
+from waiters import NodeStateWait, wait_for_node_states
+
+
+READY_STATES = ("Ready",)
+FAILED_STATES = ("Failed",)
+
+
+def percentile(values: typing.Sequence[float], q: float) -> typing.Optional[float]:
+    """Nearest-rank percentile, q in [0, 100]"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(q / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+class BootupReport:
+
+    def __init__(self, operation_id: str, wait: NodeStateWait, offset: float = 0.0) -> None:
+        self.operation_id = operation_id
+        self.wait = wait
+        # seconds from bootup() until each node was Ready
+        self.time_to_ready = sorted(seconds + offset for seconds in wait.reached_at.values())
+        self.p50 = percentile(self.time_to_ready, 50)
+        self.p95 = percentile(self.time_to_ready, 95)
+        self.max = self.time_to_ready[-1] if self.time_to_ready else None
+
+    @property
+    def ready(self) -> int:
+        return len(self.time_to_ready)
+
+    @property
+    def failed(self) -> int:
+        return len(self.wait.failed_nodes)
+
+    def summary(self) -> str:
+        def _fmt(value: typing.Optional[float]) -> str:
+            return "-" if value is None else "{:.1f}s".format(value)
+
+        return "operation {}: {} ({} ready, {} failed, {} pending) time to ready p50 {} p95 {} max {}".format(
+            self.operation_id, self.wait.outcome, self.ready, self.failed, len(self.wait.pending),
+            _fmt(self.p50), _fmt(self.p95), _fmt(self.max))
+
+
+# Node record attributes a trace keeps
+TRACE_ATTRS = ["MachineType", "Region", "Template"]
+GROUP_BY = ("vm_size", "region", "nodearray")
+BOOTUP_EVENT = "Bootup"
+
+
+class PhaseTracer:
+    """Per node transitions with wall clock timestamps, and phase latencies computed from them.
+    A phase is the time from entering a state until the next transition; "total" is the time from
+    bootup until Ready. The "Bootup" phase runs from the bootup() call until the node is first seen.
+    Transition times are as observed by the poller, so they are as precise as its poll interval."""
+
+    def __init__(self, cluster_name: str = "", clock=time.time) -> None:
+        self.cluster_name = cluster_name
+        self.clock = clock
+        self.events: typing.List[typing.Dict[str, typing.Any]] = []
+        self._bootup_time: typing.Dict[str, float] = {}
+        self._operation_id: typing.Optional[str] = None
+
+    def start(self, operation_id: str, bootup_time: typing.Optional[float] = None) -> None:
+        """bootup_time is the wall clock time bootup() was called"""
+        self._operation_id = operation_id
+        self._bootup_time[operation_id] = bootup_time if bootup_time is not None else self.clock()
+
+    def observe(self, record: typing.Dict[str, typing.Any], previous: typing.Optional[str], elapsed: float) -> None:
+        """waiters on_transition callback"""
+        operation_id = self._operation_id or ""
+        if previous is None:
+            # the first sighting of a node, its phases are measured from bootup
+            self.events.append(self._event(record, BOOTUP_EVENT, self._bootup_time.get(operation_id, self.clock()), operation_id))
+        self.events.append(self._event(record, record.get("Status"), self.clock(), operation_id))
+
+    def _event(self, record: typing.Dict[str, typing.Any], status: typing.Optional[str], timestamp: float,
+               operation_id: str) -> typing.Dict[str, typing.Any]:
+        return {"time": timestamp, "cluster": self.cluster_name, "operation": operation_id,
+                "node_id": record.get("NodeId"), "name": record.get("Name"), "status": status,
+                "vm_size": record.get("MachineType"), "region": record.get("Region"), "nodearray": record.get("Template")}
+
+    def write(self, path: str) -> None:
+        """Appends this trace's events to a JSON Lines time series"""
+        with open(path, "a") as fw:
+            for event in self.events:
+                fw.write(json.dumps(event) + "\n")
+
+    @classmethod
+    def load(cls, path: str) -> "PhaseTracer":
+        tracer = cls()
+        with open(path) as fr:
+            tracer.events = [json.loads(line) for line in fr if line.strip()]
+        return tracer
+
+
+def phase_durations(events: typing.Iterable[typing.Dict[str, typing.Any]]) -> typing.List[typing.Dict[str, typing.Any]]:
+    """One entry per node and phase: {"node_id", "vm_size", "region", "nodearray", "phase", "seconds"}"""
+    by_node: typing.Dict[typing.Tuple[str, str], typing.List[typing.Dict[str, typing.Any]]] = {}
+    for event in events:
+        by_node.setdefault((event.get("operation", ""), event["node_id"]), []).append(event)
+
+    durations = []
+    for node_events in by_node.values():
+        node_events.sort(key=lambda event: event["time"])
+        first = node_events[0]
+        for current, following in zip(node_events, node_events[1:]):
+            if current["status"] in READY_STATES + FAILED_STATES:
+                break
+            durations.append(dict(first, phase=current["status"], seconds=following["time"] - current["time"]))
+        for event in node_events:
+            if event["status"] in READY_STATES:
+                durations.append(dict(first, phase="total", seconds=event["time"] - first["time"]))
+                break
+    for entry in durations:
+        entry.pop("time", None)
+        entry.pop("status", None)
+    return durations
+
+
+def phase_percentiles(events: typing.Iterable[typing.Dict[str, typing.Any]], by: str = "vm_size",
+                      quantiles: typing.Sequence[float] = (50, 95)) -> typing.Dict[str, typing.Dict[str, typing.Dict[str, float]]]:
+    """{group: {phase: {"count", "p50", "p95", "max"}}} with group one of vm_size, region or nodearray"""
+    if by not in GROUP_BY:
+        raise ValueError("by must be one of {}".format(GROUP_BY))
+    samples: typing.Dict[str, typing.Dict[str, typing.List[float]]] = {}
+    for entry in phase_durations(events):
+        samples.setdefault(str(entry.get(by)), {}).setdefault(entry["phase"], []).append(entry["seconds"])
+
+    report: typing.Dict[str, typing.Dict[str, typing.Dict[str, float]]] = {}
+    for group, phases in sorted(samples.items()):
+        for phase, values in phases.items():
+            stats = {"count": len(values), "max": max(values)}
+            for q in quantiles:
+                stats["p{:g}".format(q)] = percentile(values, q)
+            report.setdefault(group, {})[phase] = stats
+    return report
+
+
+def print_phase_percentiles(report: typing.Dict[str, typing.Dict[str, typing.Dict[str, float]]]) -> None:
+    print("{:28} {:12} {:>6} {:>8} {:>8} {:>8}".format("group", "phase", "count", "p50", "p95", "max"))
+
+    def _total_p50(group: str) -> float:
+        total = report[group].get("total")
+        return total["p50"] if total else float("inf")
+
+    # groups that reach Ready fastest first, each group's phases before its total
+    for group in sorted(report, key=lambda group: (_total_p50(group), group)):
+        phases = report[group]
+        for phase, stats in sorted(phases.items(), key=lambda item: (item[0] == "total", item[0])):
+            print("{:28} {:12} {:6} {:7.1f}s {:7.1f}s {:7.1f}s".format(
+                group, phase, stats["count"], stats["p50"], stats["p95"], stats["max"]))
+
+
+def track_bootup(rest_client, cluster_name: str, bootup_result: typing.Any, timeout: float = 1800,
+                 started_at: typing.Optional[float] = None, tracer: typing.Optional[PhaseTracer] = None,
+                 logger=None, clock=time.monotonic, **wait_kwargs: typing.Any) -> typing.Optional[BootupReport]:
+    """bootup_result is what node_mgr.bootup() returned, or an operation id. started_at is the
+    clock() value when bootup was called, so time to ready includes the bootup call itself.
+    With a tracer, every transition is recorded along with the node's SKU, region and nodearray.
+    Returns None when there is no operation to track (nothing was started)."""
+    logger = logger or logging.getLogger()
+    operation_id = bootup_result if isinstance(bootup_result, str) else getattr(bootup_result, "operation_id", None)
+    if not operation_id:
+        logger.warning("No operation id in bootup result %s, nothing to track", bootup_result)
+        return None
+
+    offset = clock() - started_at if started_at is not None else 0.0
+    if tracer is not None:
+        tracer.start(operation_id, tracer.clock() - offset)
+        wait_kwargs.update(attrs=TRACE_ATTRS, on_transition=tracer.observe)
+    with metrics.timed("bootup.track"):
+        wait = wait_for_node_states(rest_client, cluster_name, target_states=READY_STATES,
+                                    failed_states=FAILED_STATES, timeout=timeout,
+                                    params={"operation": operation_id}, stop_on_failure=False,
+                                    logger=logger, clock=clock, **wait_kwargs)
+    report = BootupReport(operation_id, wait, offset)
+    for name, value in [("p50", report.p50), ("p95", report.p95), ("max", report.max)]:
+        if value is not None:
+            metrics.REGISTRY.gauge("bootup_time_to_ready_{}_seconds".format(name), value)
+    logger.info(report.summary())
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bootup phase latency percentiles from trace files")
+    parser.add_argument("traces", nargs="+", help="JSON Lines files written by PhaseTracer.write")
+    parser.add_argument("--by", choices=GROUP_BY, default="vm_size")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    events: typing.List[typing.Dict[str, typing.Any]] = []
+    for path in args.traces:
+        events.extend(PhaseTracer.load(path).events)
+    report = phase_percentiles(events, by=args.by)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_phase_percentiles(report)
+
+
+if __name__ == "__main__":
+    main()
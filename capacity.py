@@ -0,0 +1,159 @@
+"""TTL cache of node manager buckets and per-SKU capacity
+
+Scripts print capacity before and after scaling and list vm_sizes from the same buckets.
+CapacityCache serves those repeated reads from memory for ttl seconds. allocate() and bootup()
+go through the cache and mark the nodearrays they touched stale, so the next read sees their new
+buckets before the ttl runs out. That read still calls node_mgr.get_buckets() once for every
+nodearray, but only the touched nodearrays' entries are replaced.
+
+    capacity = CapacityCache(node_mgr)
+    capacity.print_buckets()
+    capacity.allocate({"node.vm_size": sku}, node_count=count)
+    capacity.bootup()
+    capacity.print_buckets()
+"""
+import logging
+import time
+import typing
+
+import metrics
+from retry_policy import BOOTUP_POLICY
+
+
+class SkuCapacity:
+    """Capacity of one vm_size, summed over its buckets (one bucket per nodearray/location/spot)"""
+
+    __slots__ = ("vm_size", "vcpu_count", "available_count", "max_count", "available_core_quota", "nodearrays")
+
+    def __init__(self, vm_size: str) -> None:
+        self.vm_size = vm_size
+        self.vcpu_count = 0
+        self.available_count = 0
+        self.max_count = 0
+        # None when the buckets do not report quota limits
+        self.available_core_quota: typing.Optional[int] = None
+        self.nodearrays: typing.Set[str] = set()
+
+    def __repr__(self) -> str:
+        return "SkuCapacity({}, available={}/{}, vcpus={}, core_quota={}, nodearrays={})".format(
+            self.vm_size, self.available_count, self.max_count, self.vcpu_count,
+            self.available_core_quota, sorted(self.nodearrays))
+
+
+def _available_core_quota(bucket: typing.Any) -> typing.Optional[int]:
+    limits = getattr(bucket, "limits", None)
+    if limits is None:
+        return None
+    counts = [getattr(limits, attr, None) for attr in ("regional_available_core_count",
+                                                        "cluster_available_core_count",
+                                                        "family_available_core_count",
+                                                        "nodearray_available_core_count")]
+    counts = [c for c in counts if c is not None]
+    return min(counts) if counts else None
+
+
+class CapacityCache:
+
+    def __init__(self, node_mgr: typing.Any, ttl: float = 30, logger=None, clock=time.monotonic) -> None:
+        self.node_mgr = node_mgr
+        self.ttl = ttl
+        self.logger = logger or logging.getLogger()
+        self.clock = clock
+
+        self._by_nodearray: typing.Dict[str, typing.List[typing.Any]] = {}
+        self._by_sku: typing.Optional[typing.Dict[str, SkuCapacity]] = None
+        self._loaded_at: typing.Optional[float] = None
+        self._stale_nodearrays: typing.Set[str] = set()
+        self.hits = 0
+        self.refreshes = 0
+
+    def invalidate(self, nodearrays: typing.Optional[typing.Iterable[str]] = None) -> None:
+        """Marks the given nodearrays (or everything) for refresh on the next read"""
+        if nodearrays is None:
+            self._loaded_at = None
+        else:
+            self._stale_nodearrays.update(nodearrays)
+
+    def _refresh(self) -> None:
+        expired = self._loaded_at is None or self.clock() - self._loaded_at >= self.ttl
+        if not expired and not self._stale_nodearrays:
+            self.hits += 1
+            return
+
+        self.refreshes += 1
+        with metrics.timed("node_mgr.get_buckets"):
+            buckets = self.node_mgr.get_buckets()
+        if expired:
+            self._by_nodearray = {}
+            for bucket in buckets:
+                self._by_nodearray.setdefault(bucket.nodearray, []).append(bucket)
+            self._loaded_at = self.clock()
+        else:
+            # get_buckets() has no filter, so keep only the buckets of the nodearrays an allocation touched
+            replaced: typing.Dict[str, typing.List[typing.Any]] = {nodearray: [] for nodearray in self._stale_nodearrays}
+            for bucket in buckets:
+                if bucket.nodearray in replaced:
+                    replaced[bucket.nodearray].append(bucket)
+            self._by_nodearray.update(replaced)
+        self._stale_nodearrays.clear()
+        self._by_sku = None
+
+    def buckets(self) -> typing.List[typing.Any]:
+        self._refresh()
+        return [bucket for buckets in self._by_nodearray.values() for bucket in buckets]
+
+    def vm_sizes(self, nodearray: typing.Optional[str] = None) -> typing.List[str]:
+        self._refresh()
+        seen: typing.Dict[str, None] = {}
+        for name, buckets in self._by_nodearray.items():
+            if nodearray is None or name == nodearray:
+                for bucket in buckets:
+                    seen[bucket.vm_size] = None
+        return list(seen)
+
+    def by_sku(self, nodearray: typing.Optional[str] = None) -> typing.Dict[str, SkuCapacity]:
+        """Capacity per vm_size, over all nodearrays (cached) or just one"""
+        self._refresh()
+        if nodearray is not None:
+            return self._aggregate({nodearray: self._by_nodearray.get(nodearray, [])})
+        if self._by_sku is None:
+            self._by_sku = self._aggregate(self._by_nodearray)
+        return self._by_sku
+
+    def _aggregate(self, by_nodearray: typing.Dict[str, typing.List[typing.Any]]) -> typing.Dict[str, SkuCapacity]:
+        by_sku: typing.Dict[str, SkuCapacity] = {}
+        for nodearray, buckets in by_nodearray.items():
+            for bucket in buckets:
+                sku = by_sku.get(bucket.vm_size)
+                if sku is None:
+                    sku = by_sku[bucket.vm_size] = SkuCapacity(bucket.vm_size)
+                sku.vcpu_count = bucket.vcpu_count
+                sku.available_count += bucket.available_count
+                sku.max_count += getattr(bucket, "max_count", 0) or 0
+                sku.nodearrays.add(nodearray)
+                quota = _available_core_quota(bucket)
+                if quota is not None:
+                    # quota is shared by every bucket of the family/region, so take the tightest
+                    sku.available_core_quota = quota if sku.available_core_quota is None else min(sku.available_core_quota, quota)
+        return by_sku
+
+    def _invalidate_touched(self, result: typing.Any) -> None:
+        touched = {node.nodearray for node in (getattr(result, "nodes", None) or [])}
+        # without nodes in the result we can't tell what changed
+        self.invalidate(touched or None)
+
+    def print_buckets(self) -> None:
+        for bucket in self.buckets():
+            print(bucket)
+
+    def allocate(self, *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        with metrics.timed("node_mgr.allocate"):
+            result = self.node_mgr.allocate(*args, **kwargs)
+        self._invalidate_touched(result)
+        return result
+
+    def bootup(self, *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        with metrics.timed("node_mgr.bootup"):
+            result = BOOTUP_POLICY.call(self.node_mgr.bootup, *args, name="node_mgr.bootup", **kwargs)
+        self._invalidate_touched(result)
+        return result
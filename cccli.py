@@ -0,0 +1,345 @@
+"""Single entry point for the demo tools
+
+    python cccli.py login --url https://cyclecloud:8443 --username admin
+    python cccli.py status CLUSTER
+    python cccli.py start CLUSTER --nodearray execute --count 4
+    python cccli.py stop CLUSTER --nodearray execute
+    python cccli.py plan CLUSTER plan.json
+    python cccli.py spot CLUSTER --nodearray execute-spot --target 50
+    python cccli.py cleanup CLUSTER
+    python cccli.py nodes CLUSTER --sync --filter 'Status == "Failed"' --attrs Name,Hostname --format csv
+    python cccli.py scale-up CLUSTER ARRAY CORES
+    python cccli.py bench-startup
+
+Scheduler prolog/epilog hooks call these tools very often, so start up is kept cheap: nothing
+heavier than the standard library is imported until a subcommand needs it (scalelib and
+cyclecloud-api only for the subcommands that use a node manager), and `login` persists the
+CycleCloud url, username and session cookies so later invocations don't re-negotiate the session.
+The password is never written to disk: it is read from CC_PASSWORD (set it for hooks and other
+unattended callers) or prompted for. The session file is only readable by its owner.
+"""
+import argparse
+import getpass
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+
+SESSION_FILE = os.environ.get("CC_SESSION_FILE",
+                              os.path.join(os.path.expanduser("~"), ".cyclecloud-demo", "session.json"))
+# Everything else, the password in particular, stays out of the session file
+SESSION_KEYS = ("url", "username", "verify_certificates", "cookies")
+
+
+def load_session() -> typing.Dict[str, typing.Any]:
+    try:
+        with open(SESSION_FILE) as fr:
+            return json.load(fr)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_session(session: typing.Dict[str, typing.Any]) -> None:
+    directory = os.path.dirname(SESSION_FILE)
+    os.makedirs(directory, exist_ok=True)
+    # mkstemp creates the file readable by its owner only
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as fw:
+        json.dump({key: session[key] for key in SESSION_KEYS if key in session}, fw)
+    os.replace(tmp_path, SESSION_FILE)
+
+
+def get_config(args: argparse.Namespace, cluster_name: str = "") -> typing.Dict[str, typing.Any]:
+    """Command line, then CC_URL / CC_USERNAME, then the saved session. The password comes from
+    CC_PASSWORD or a prompt."""
+    session = load_session()
+    config = {
+        "url": args.url or os.environ.get("CC_URL") or session.get("url"),
+        "username": args.username or os.environ.get("CC_USERNAME") or session.get("username"),
+        "password": os.environ.get("CC_PASSWORD"),
+        "verify_certificates": session.get("verify_certificates", False),
+        "cluster_name": cluster_name,
+    }
+    if not config["url"] or not config["username"]:
+        sys.exit("No CycleCloud url/username: run `cccli.py login` or pass --url and --username")
+    if not config["password"]:
+        config["password"] = getpass.getpass("password: ")
+    return config
+
+
+def rest_client(config: typing.Dict[str, typing.Any]):
+    import ccrest
+
+    client = ccrest.get_rest_client(config)
+    session = load_session()
+    if session.get("url") == config["url"] and session.get("cookies"):
+        client.import_cookies(session["cookies"])
+    return client
+
+
+def _save_cookies(client) -> None:
+    session = load_session()
+    if session.get("url") == client.config["url"]:
+        session["cookies"] = client.export_cookies()
+        save_session(session)
+
+
+def cmd_login(args: argparse.Namespace) -> None:
+    url = args.url or input("CycleCloud URL: ")
+    username = args.username or input("username: ")
+    password = os.environ.get("CC_PASSWORD") or getpass.getpass("password: ")
+    config = {"url": url, "username": username, "password": password, "verify_certificates": not args.no_verify}
+
+    client = rest_client(config)
+    response = client.get("/cloud/clusters", {"summary": "true"})
+    if response.status_code < 200 or response.status_code > 299:
+        sys.exit("Login failed: {} {}".format(response.status_code, response.text))
+    config["cookies"] = client.export_cookies()
+    save_session(config)
+    print("Saved session for {}@{} to {}".format(username, url, SESSION_FILE))
+
+
+def cmd_logout(args: argparse.Namespace) -> None:
+    if os.path.exists(SESSION_FILE):
+        os.remove(SESSION_FILE)
+
+
+def cmd_status(args: argparse.Namespace) -> None:
+    client = rest_client(get_config(args, args.cluster))
+    for node in client.iter_cluster_nodes(args.cluster, attrs=["Name", "Hostname", "Status", "Template"]):
+        print("{Name:32} {Template:24} {Status:14} {Hostname}".format(**{k: v or "" for k, v in node.items()}))
+    _save_cookies(client)
+
+
+def cmd_nodes(args: argparse.Namespace) -> None:
+    import node_store
+
+    if args.db != ":memory:":
+        os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    store = node_store.NodeStore(args.db)
+    if args.sync:
+        client = rest_client(get_config(args, args.cluster))
+        print("sync: {}".format(store.sync(client, args.cluster)), file=sys.stderr)
+        _save_cookies(client)
+    attrs = node_store.parse_attrs(args.attrs)
+    rows = store.query(args.cluster, args.filter, attrs, limit=args.limit, offset=args.offset)
+    if args.format == "csv":
+        node_store.write_csv(rows, attrs)
+    else:
+        node_store.write_jsonl(rows)
+
+
+def cmd_cleanup(args: argparse.Namespace) -> None:
+    import cleanup_failed_nodes
+
+    cleanup_failed_nodes.CC_CONFIG.update(get_config(args, args.cluster))
+    client = rest_client(cleanup_failed_nodes.CC_CONFIG)
+    # without a terminal nobody can confirm, so unattended runs always go through the reaper's policy
+    if args.reap_interval > 0 or args.once or not sys.stdin.isatty():
+        from reaper import FailedNodeReaper, ReaperPolicy, default_state_file
+
+        policy = ReaperPolicy(min_failed_age=args.min_failed_age, max_kills_per_cycle=args.max_kills,
+                              max_nodearray_fraction=args.max_nodearray_fraction)
+        reaper = FailedNodeReaper(cleanup_failed_nodes.Cluster(args.cluster, cleanup_failed_nodes.CC_CONFIG), policy,
+                                  nodearray=args.nodearray, decision_log=args.decision_log, dry_run=args.dry_run,
+                                  state_file=args.state_file or default_state_file(args.cluster))
+        reaper.run(args.reap_interval, max_cycles=1 if args.once else None)
+    else:
+        cleanup_failed_nodes.terminate_failed_nodes(args.cluster, nodearray=args.nodearray)
+    _save_cookies(client)
+
+
+def cmd_start(args: argparse.Namespace) -> None:
+    import start_stop_nodes
+    from hpc.autoscale.node.nodemanager import new_node_manager
+
+    config = get_config(args, args.cluster)
+    start_stop_nodes.CC_CONFIG.update(config)
+    node_mgr = new_node_manager(config)
+    start_stop_nodes.add_nodes(node_mgr, args.cluster, args.nodearray, count=args.count, sku=args.sku,
+                               wait_timeout=args.wait, trace_file=args.trace)
+
+
+def cmd_stop(args: argparse.Namespace) -> None:
+    import start_stop_nodes
+    from hpc.autoscale.node.nodemanager import new_node_manager
+
+    config = get_config(args, args.cluster)
+    start_stop_nodes.CC_CONFIG.update(config)
+    node_mgr = new_node_manager(config)
+    try:
+        start_stop_nodes.deallocate_nodes(node_mgr, args.cluster, args.nodearray, idle_minutes=args.idle_minutes)
+    except start_stop_nodes.NoDemandDataError as e:
+        sys.exit("Not stopping anything: {}".format(e))
+
+
+def cmd_plan(args: argparse.Namespace) -> None:
+    import start_stop_nodes
+    from hpc.autoscale.node.nodemanager import new_node_manager
+
+    plan = start_stop_nodes.load_plan(args.plan)
+    config = get_config(args, args.cluster)
+    start_stop_nodes.CC_CONFIG.update(config)
+    node_mgr = new_node_manager(config)
+    try:
+        start_stop_nodes.apply_plan(node_mgr, args.cluster, plan, dry_run=args.dry_run)
+    except start_stop_nodes.NoDemandDataError as e:
+        sys.exit("Not applying the plan: {}".format(e))
+
+
+def cmd_spot(args: argparse.Namespace) -> None:
+    import spot_replacement
+    from sku_scoring import DEFAULT_HISTORY_FILE
+
+    history_file = args.history or DEFAULT_HISTORY_FILE
+
+    spot_replacement.CC_CONFIG.update(get_config(args, args.cluster))
+    if args.interval > 0:
+        spot_replacement.TargetCountController(args.cluster, args.nodearray, args.target,
+                                               shuffle=not args.no_shuffle, dry_run=args.dry_run,
+                                               history_file=history_file).run(args.interval)
+    else:
+        spot_replacement.scale_nodearray_to_target_count(args.cluster, args.nodearray, args.target,
+                                                         shuffle=not args.no_shuffle, dry_run=args.dry_run,
+                                                         history_file=history_file, wait_timeout=args.wait, trace_file=args.trace)
+
+
+def cmd_scale_up(args: argparse.Namespace) -> None:
+    from cyclecloud.client import Client
+
+    cluster_obj = Client(get_config(args, args.cluster)).clusters[args.cluster]
+    print(cluster_obj.get_status().state)
+    cluster_obj.scale_by_cores(args.nodearray, args.cores)
+
+
+def cmd_noop(args: argparse.Namespace) -> None:
+    pass
+
+
+def cmd_bench_startup(args: argparse.Namespace) -> None:
+    """Median wall time to start the CLI vs importing the heavy libraries the scripts import eagerly"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    candidates = [
+        ("cccli.py noop", [sys.executable, os.path.join(here, "cccli.py"), "noop"]),
+        ("import ccrest", [sys.executable, "-c", "import ccrest"]),
+        ("import cyclecloud.client", [sys.executable, "-c", "import cyclecloud.client"]),
+        ("import hpc.autoscale nodemanager", [sys.executable, "-c", "import hpc.autoscale.node.nodemanager"]),
+    ]
+    for name, command in candidates:
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            completed = subprocess.run(command, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - start)
+            if completed.returncode != 0:
+                break
+        if completed.returncode != 0:
+            print("{:34} failed (exit {})".format(name, completed.returncode))
+        else:
+            print("{:34} median {:7.1f} ms   min {:7.1f} ms".format(
+                name, statistics.median(timings) * 1000, min(timings) * 1000))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="CycleCloud autoscale demo tools")
+    parser.add_argument("--url", default=None, help="CC URL (default: saved session)")
+    parser.add_argument("--username", default=None, help="CC Username (default: saved session)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    login = subparsers.add_parser("login", help="Check and save the CycleCloud url, credentials and session")
+    login.add_argument("--no-verify", action="store_true", help="Do not verify the server certificate")
+    login.set_defaults(func=cmd_login)
+
+    subparsers.add_parser("logout", help="Forget the saved session").set_defaults(func=cmd_logout)
+
+    status = subparsers.add_parser("status", help="Show the cluster's nodes")
+    status.add_argument("cluster")
+    status.set_defaults(func=cmd_status)
+
+    nodes = subparsers.add_parser("nodes", help="Query a local SQLite copy of the cluster's nodes")
+    nodes.add_argument("cluster")
+    nodes.add_argument("--db", default=os.path.join(os.path.dirname(SESSION_FILE), "nodes.db"))
+    nodes.add_argument("--sync", action="store_true", help="Refresh the local copy first")
+    nodes.add_argument("--filter", default=None, help='Filter expression, e.g. Status == "Ready"')
+    nodes.add_argument("--attrs", default=None, help="Comma separated attributes")
+    nodes.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    nodes.add_argument("--limit", type=int, default=None)
+    nodes.add_argument("--offset", type=int, default=0)
+    nodes.set_defaults(func=cmd_nodes)
+
+    cleanup = subparsers.add_parser("cleanup", help="Terminate Failed and Unavailable nodes")
+    cleanup.add_argument("cluster")
+    cleanup.add_argument("--nodearray", default=None)
+    cleanup.add_argument("--reap-interval", type=float, default=0, help="Reap unattended every N seconds")
+    cleanup.add_argument("--once", action="store_true", help="Run a single unattended reaper cycle")
+    cleanup.add_argument("--min-failed-age", type=float, default=300, help="Seconds a node must have been failed")
+    cleanup.add_argument("--max-kills", type=int, default=50, help="Maximum terminations per cycle")
+    cleanup.add_argument("--max-nodearray-fraction", type=float, default=0.25,
+                         help="Maximum fraction of a nodearray terminated per cycle")
+    cleanup.add_argument("--decision-log", default=None, help="Append every reaper decision to this JSON Lines file")
+    cleanup.add_argument("--state-file", default=None,
+                         help="When nodes were first seen failed, kept between runs (default ~/.cyclecloud-demo/reaper-CLUSTER.json)")
+    cleanup.add_argument("--dry-run", action="store_true")
+    cleanup.set_defaults(func=cmd_cleanup)
+
+    start = subparsers.add_parser("start", help="Allocate and start nodes in a nodearray")
+    start.add_argument("cluster")
+    start.add_argument("--nodearray", default="persistent-execute")
+    start.add_argument("--count", type=int, default=1)
+    start.add_argument("--sku", default="", help="Force specific SKU selection")
+    start.add_argument("--wait", type=float, default=0, help="Seconds to wait for the nodes to be Ready")
+    start.add_argument("--trace", default=None, help="With --wait, append bootup transitions to this JSON Lines file")
+    start.set_defaults(func=cmd_start)
+
+    stop = subparsers.add_parser("stop", help="Deallocate the nodes of a nodearray")
+    stop.add_argument("cluster")
+    stop.add_argument("--nodearray", default="persistent-execute")
+    stop.add_argument("--idle-minutes", type=float, default=None, help="Only nodes idle for at least N minutes")
+    stop.set_defaults(func=cmd_stop)
+
+    plan = subparsers.add_parser("plan", help="Apply a JSON plan of start/stop actions with one bootup")
+    plan.add_argument("cluster")
+    plan.add_argument("plan")
+    plan.add_argument("--dry-run", action="store_true")
+    plan.set_defaults(func=cmd_plan)
+
+    spot = subparsers.add_parser("spot", help="Scale a spot nodearray to a target count")
+    spot.add_argument("cluster")
+    spot.add_argument("--nodearray", default="execute-spot")
+    spot.add_argument("--target", type=int, required=True)
+    spot.add_argument("--no-shuffle", action="store_true", help="Do not spread across machine types")
+    spot.add_argument("--dry-run", action="store_true")
+    spot.add_argument("--interval", type=float, default=0, help="Run as a controller every N seconds")
+    spot.add_argument("--wait", type=float, default=0, help="Seconds to wait for started nodes to be Ready")
+    spot.add_argument("--trace", default=None, help="With --wait, append bootup transitions to this JSON Lines file")
+    spot.add_argument("--history", default=None,
+                      help="SKU failure and eviction history kept between runs "
+                           "(default $CC_SKU_HISTORY_FILE or ~/.cyclecloud-demo/sku_history.json)")
+    spot.set_defaults(func=cmd_spot)
+
+    scale_up = subparsers.add_parser("scale-up", help="Start up to N new cores in a nodearray")
+    scale_up.add_argument("cluster")
+    scale_up.add_argument("nodearray")
+    scale_up.add_argument("cores", type=int)
+    scale_up.set_defaults(func=cmd_scale_up)
+
+    bench = subparsers.add_parser("bench-startup", help="Measure start up time")
+    bench.add_argument("--runs", type=int, default=10)
+    bench.set_defaults(func=cmd_bench_startup)
+
+    subparsers.add_parser("noop", help=argparse.SUPPRESS).set_defaults(func=cmd_noop)
+    return parser
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
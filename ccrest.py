@@ -0,0 +1,309 @@
+"""Shared, pooled CycleCloud REST client
+
+All of the raw REST helpers in demo.py and cleanup_failed_nodes.py go through a
+single RestClient per CycleCloud url/username so that they share one authenticated
+requests.Session, one HTTP keep-alive connection pool, one RateLimiter and one
+CircuitBreaker. Failed requests are retried with jittered backoff: GETs on any connection
+error or 429/5xx, POSTs (which are not idempotent) only when the request never reached the
+server or the server refused it with 429/503.
+"""
+import codecs
+import json
+import logging
+import re
+import threading
+import time
+import typing
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from ratelimit import RateLimiter, parse_retry_after
+from retry_policy import CircuitBreaker, RetryPolicy
+
+
+DEFAULT_POOL_SIZE = 16
+STREAM_CHUNK_SIZE = 64 * 1024
+# Characters that can continue a number cut off at the end of a streamed chunk
+NUMBER_TAIL_RE = re.compile(r"[0-9.eE+-]*")
+
+
+def quote(name: str) -> str:
+    # cluster and node names must be url quoted when used in a path
+    return urllib.parse.quote(name, safe="")
+
+
+def endpoint_template(api_path: str) -> str:
+    """/cloud/actions/startcluster/apiTest -> /cloud/actions/{action}/{name}, so metrics are per endpoint"""
+    parts = api_path.split("?")[0].strip("/").split("/")
+    if parts[:2] == ["cloud", "actions"] and len(parts) > 2:
+        return "/cloud/actions/{}/{{name}}".format(parts[2])
+    if parts[:2] in (["cloud", "clusters"], ["cloud", "api"]) and len(parts) > 2:
+        if parts[:3] == ["cloud", "api", "import_cluster"] or parts[:3] == ["cloud", "api", "nodes"]:
+            return "/" + "/".join(parts[:3] + ["{name}"] * (len(parts) > 3))
+        return "/cloud/clusters/{name}"
+    if parts[0] == "clusters" and len(parts) > 1:
+        return "/" + "/".join(["clusters", "{name}"] + parts[2:])
+    return "/" + "/".join(parts)
+
+
+def _payload_size(body: typing.Any) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, dict):
+        return len(urllib.parse.urlencode(body))
+    if isinstance(body, str):
+        return len(body.encode())
+    return len(body)
+
+
+class RestClient:
+
+    def __init__(self, config: typing.Dict[str, typing.Any], pool_size: int = DEFAULT_POOL_SIZE, logger=None) -> None:
+        self.config = config
+        self.base_url = config["url"].rstrip("/")
+        self.pool_size = pool_size
+        self.logger = logger or logging.getLogger()
+
+        self.session = requests.Session()
+        self.session.auth = (config["username"], config["password"])
+        self.session.verify = config.get("verify_certificates", True)
+        self.session.headers.update({"Accept": "application/json"})
+
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+        self.limiter = RateLimiter.from_config(config, max_concurrency=pool_size)
+        self.breaker = CircuitBreaker(self.base_url)
+        max_attempts = int(config.get("retry_attempts", 5))
+        deadline = float(config.get("retry_deadline", 120))
+        self.retry_policies = {
+            "GET": RetryPolicy(max_attempts, deadline=deadline, retry_on=(requests.RequestException,),
+                               breaker=self.breaker, logger=self.logger),
+            "POST": RetryPolicy(max_attempts, deadline=deadline, retry_on=(requests.ConnectTimeout,),
+                                retry_status=(429, 503), breaker=self.breaker, logger=self.logger),
+        }
+
+    def url(self, api_path: str) -> str:
+        return self.base_url + api_path
+
+    def request(self, verb: str, api_path: str, params=None, headers=None, body=None,
+                deadline: typing.Optional[float] = None, **kwargs) -> requests.Response:
+        """deadline bounds the total time spent on retries (see RetryPolicy.call), timeout in kwargs
+        is per attempt"""
+        full_url = self.url(api_path)
+        self.logger.info("%s %s params %s headers %s body %s", verb, full_url, params, headers, body)
+        endpoint = "{} {}".format(verb, endpoint_template(api_path))
+        policy = self.retry_policies.get(verb)
+        if policy is None:
+            return self._send(verb, full_url, endpoint, params, headers, body, **kwargs)
+        return policy.call(self._send, verb, full_url, endpoint, params, headers, body, name=endpoint,
+                           deadline=deadline, **kwargs)
+
+    def _send(self, verb: str, full_url: str, endpoint: str, params=None, headers=None, body=None, **kwargs) -> requests.Response:
+        waited = self.limiter.acquire()
+        if waited > 0:
+            self.logger.debug("Rate limited %s for %.3fs", endpoint, waited)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(verb, full_url, params=params or {}, headers=headers or {}, data=body, **kwargs)
+        except Exception:
+            elapsed = time.perf_counter() - start
+            self.limiter.release(None, elapsed)
+            metrics.REGISTRY.observe(endpoint, elapsed, error=True, request_bytes=_payload_size(body))
+            raise
+        # streamed bodies are read after the slot is given back
+        self.limiter.release(response.status_code, time.perf_counter() - start,
+                             parse_retry_after(response.headers.get("Retry-After")))
+        # for streamed responses this is the time to the response headers, the body is read by the caller
+        if kwargs.get("stream"):
+            content_length = response.headers.get("Content-Length")
+            response_bytes = int(content_length) if content_length else None
+        else:
+            response_bytes = len(response.content or b"")
+        metrics.REGISTRY.observe(endpoint, time.perf_counter() - start, status_code=response.status_code,
+                                 error=response.status_code >= 400, request_bytes=_payload_size(body),
+                                 response_bytes=response_bytes)
+        return response
+
+    def get(self, api_path: str, params=None, headers=None, body=None, **kwargs) -> requests.Response:
+        return self.request("GET", api_path, params, headers, body, **kwargs)
+
+    def post(self, api_path: str, params=None, headers=None, body=None, **kwargs) -> requests.Response:
+        return self.request("POST", api_path, params, headers, body, **kwargs)
+
+    def iter_cluster_nodes(self, cluster_name: str, attrs: typing.Optional[typing.Sequence[str]] = None,
+                           params=None, chunk_size: int = STREAM_CHUNK_SIZE) -> typing.Iterator[typing.Dict]:
+        """Yields the node records of /clusters/{name}/nodes one at a time as the body is read,
+        projected onto attrs (e.g. Name, Hostname, Status, NodeId) when given."""
+        response = self.get("/clusters/{}/nodes".format(quote(cluster_name)), params, stream=True)
+        try:
+            if response.status_code < 200 or response.status_code > 299:
+                raise ValueError(response.text)
+            for record in iter_json_array(response.iter_content(chunk_size=chunk_size), "nodes"):
+                if attrs:
+                    yield {attr: record.get(attr) for attr in attrs}
+                else:
+                    yield record
+        finally:
+            response.close()
+
+    def poll_cluster_nodes(self, cluster_name: str, attrs: typing.Optional[typing.Sequence[str]] = None,
+                           etag: typing.Optional[str] = None, params=None) -> typing.Tuple[typing.Optional[str], typing.Optional[typing.List[typing.Dict]]]:
+        """Conditional, projected GET of /clusters/{name}/nodes for pollers.
+        Returns (etag, records). records is None when the server answered 304 Not Modified to
+        the If-None-Match etag from the previous poll (servers without ETag support always
+        return the full listing)."""
+        headers = {"If-None-Match": etag} if etag else None
+        response = self.get("/clusters/{}/nodes".format(quote(cluster_name)), params, headers, stream=True)
+        try:
+            if response.status_code == 304:
+                return etag, None
+            if response.status_code < 200 or response.status_code > 299:
+                raise ValueError(response.text)
+            records = []
+            for record in iter_json_array(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), "nodes"):
+                records.append({attr: record.get(attr) for attr in attrs} if attrs else record)
+            return response.headers.get("ETag"), records
+        finally:
+            response.close()
+
+    def connection_stats(self) -> typing.Dict[str, int]:
+        """Connections opened vs reused across every host pool of this client.
+        Every request that did not need a new connection (and so a new TLS handshake) was a reuse."""
+        opened = 0
+        requests_sent = 0
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+            "requests": requests_sent,
+            "connections_opened": opened,
+            "connections_reused": max(0, requests_sent - opened),
+        }
+
+    def log_connection_stats(self) -> None:
+        stats = self.connection_stats()
+        for key, value in stats.items():
+            metrics.REGISTRY.gauge("rest_" + key, value)
+        self.logger.info("REST connections for %s: %d requests, %d opened, %d reused",
+                         self.base_url, stats["requests"], stats["connections_opened"], stats["connections_reused"])
+
+    def export_cookies(self) -> typing.Dict[str, str]:
+        """Session cookies issued by CycleCloud, so a later process can resume the server side session"""
+        return requests.utils.dict_from_cookiejar(self.session.cookies)
+
+    def import_cookies(self, cookies: typing.Dict[str, str]) -> None:
+        self.session.cookies.update(requests.utils.cookiejar_from_dict(cookies))
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def iter_json_array(chunks: typing.Iterable[typing.Union[str, bytes]], key: str) -> typing.Iterator[typing.Any]:
+    """Incrementally parses a JSON object read in chunks and yields the elements of its
+    top level array member named key, without ever holding the whole document.
+    Only one element (plus one chunk) is buffered at a time."""
+    decoder = json.JSONDecoder()
+    # bytes chunks may split a multi-byte character
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+
+    def _fill() -> bool:
+        nonlocal buf, pos
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                chunk = text_decoder.decode(chunk)
+            if chunk:
+                buf = buf[pos:] + chunk
+                pos = 0
+                return True
+        return False
+
+    def _next_char() -> str:
+        # skips whitespace, returns the next significant character without consuming it
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not _fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def _decode() -> typing.Any:
+        # decodes one complete value, reading more chunks until it is complete
+        nonlocal pos
+        _next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if not _fill():
+                    raise
+                continue
+            if not isinstance(value, (str, dict, list)) and NUMBER_TAIL_RE.match(buf, end).end() == len(buf):
+                # a number may continue in the next chunk: "1" + "e5", or "2." + "5" where the
+                # "." was not part of the number parsed so far
+                if _fill():
+                    continue
+            pos = end
+            return value
+
+    def _expect(chars: str) -> str:
+        nonlocal pos
+        c = _next_char()
+        if c not in chars:
+            raise ValueError("Expected one of {!r} at offset {} but found {!r}".format(chars, pos, c))
+        pos += 1
+        return c
+
+    _expect("{")
+    if _next_char() == "}":
+        return
+    while True:
+        member = _decode()
+        _expect(":")
+        if member == key:
+            _expect("[")
+            if _next_char() == "]":
+                return
+            while True:
+                yield _decode()
+                if _expect(",]") == "]":
+                    return
+        _decode()
+        if _expect(",}") == "}":
+            return
+
+
+_CLIENTS: typing.Dict[typing.Tuple[str, str], RestClient] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_rest_client(config: typing.Dict[str, typing.Any], pool_size: int = DEFAULT_POOL_SIZE) -> RestClient:
+    """Returns the shared RestClient for this CycleCloud url and user, creating it on first use."""
+    key = (config["url"].rstrip("/"), config["username"])
+    with _CLIENTS_LOCK:
+        rest_client = _CLIENTS.get(key)
+        if rest_client is None:
+            rest_client = RestClient(config, pool_size=pool_size)
+            _CLIENTS[key] = rest_client
+        else:
+            # credentials may have been re-entered since the client was created
+            rest_client.session.auth = (config["username"], config["password"])
+        return rest_client
+
+
+def close_all() -> None:
+    with _CLIENTS_LOCK:
+        for rest_client in _CLIENTS.values():
+            rest_client.close()
+        _CLIENTS.clear()
@@ -1,11 +1,13 @@
 """Cyclecloud API cleanup_failed_nodes"""
 from subprocess import check_call
+from concurrent.futures import ThreadPoolExecutor
 import json
-from cyclecloud.client import Client, Record
 import logging
 import sys
-from retry import retry
-from urllib.parse import urlencode
+
+import metrics
+from ccrest import get_rest_client
+from snapshot import SNAPSHOT_ATTRS, NodeSnapshot
 
 from uuid import uuid4
 
@@ -24,12 +26,39 @@ logging.basicConfig(
     level=logging.DEBUG,
 )        
 
+logger = logging.getLogger()
+
 
 
 class ClusterTimeoutError(Exception):
     pass
 
 
+# Bulk termination is split into chunks that CycleCloud handles comfortably in one request
+TERMINATE_CHUNK_SIZE = 200
+TERMINATE_MAX_BODY_BYTES = 64 * 1024
+TERMINATE_MAX_FILTER_BYTES = 6 * 1024
+TERMINATE_PARALLELISM = 4
+
+
+def _chunk(items, max_count, max_bytes, item_size):
+    '''Splits items into lists of at most max_count items and roughly max_bytes each'''
+    chunks = []
+    current = []
+    current_bytes = 0
+    for item in items:
+        size = item_size(item)
+        if current and (len(current) >= max_count or current_bytes + size > max_bytes):
+            chunks.append(current)
+            current = []
+            current_bytes = 0
+        current.append(item)
+        current_bytes += size
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 
 class Cluster:
     
@@ -39,7 +68,8 @@ class Cluster:
         self.config = config
         self.logger = logger or logging.getLogger()
 
-        self.client = Client(config)
+        # Shares one pooled, authenticated session with every other Cluster for this CycleCloud
+        self.rest = get_rest_client(config)
     
     def status(self):
         '''pprint.pprint(json.dumps(json.loads(dougs_example)))'''
@@ -56,12 +86,48 @@ class Cluster:
     def all_nodes(self):
         return self.get("/clusters/%s/nodes" % self.cluster_name)
 
-    def nodes(self, request_ids):
-        responses = {}
-        for request_id in request_ids:
-            params = {'request_id': request_id}
-            responses[request_id] = self.get(f"/clusters/{self.cluster_name}/nodes", params=params)
-        return responses
+    def iter_nodes(self, attrs=None, params=None):
+        '''Streams node records one at a time, projected onto attrs if given
+        Use this instead of all_nodes on large clusters, peak memory does not grow with the node count.'''
+        return self.rest.iter_cluster_nodes(self.cluster_name, attrs=attrs, params=params)
+
+    def poll_nodes(self, attrs=None, etag=None, params=None):
+        '''Conditional GET of the node listing, returns (etag, records) with records None if the
+        listing did not change since etag'''
+        return self.rest.poll_cluster_nodes(self.cluster_name, attrs=attrs, etag=etag, params=params)
+
+    def nodes(self, request_ids, parallelism=1, timeout=None):
+        '''Nodes for each allocation request_id, as ({request_id: response}, {request_id: exception})
+        A failed or timed out request does not abort the sweep, serial or parallel: it is left out
+        of the responses and its exception is in the failures instead. Both keep the caller's order.
+        With parallelism > 1 the GETs are fanned out over a thread pool no larger than the
+        connection pool.
+        timeout bounds the total time spent on each request_id, retries included.'''
+        def _get(request_id):
+            try:
+                return self._nodes_by_request_id(request_id, timeout), None
+            except Exception as e:
+                self.logger.error("Failed to get nodes for request_id %s: %s", request_id, e)
+                return None, e
+
+        parallelism = max(1, min(parallelism, self.rest.pool_size, len(request_ids)))
+        if parallelism == 1:
+            results = [_get(request_id) for request_id in request_ids]
+        else:
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                results = list(executor.map(_get, request_ids))
+
+        responses, failures = {}, {}
+        for request_id, (response, error) in zip(request_ids, results):
+            if error is None:
+                responses[request_id] = response
+            else:
+                failures[request_id] = error
+        return responses, failures
+
+    def _nodes_by_request_id(self, request_id, timeout=None):
+        params = {'request_id': request_id}
+        return self.get(f"/clusters/{self.cluster_name}/nodes", params=params, timeout=timeout, deadline=timeout)
     
     def nodes_by_operation_id(self, operation_id):
         if not operation_id:
@@ -70,50 +136,77 @@ class Cluster:
         return self.get(f"/clusters/{self.cluster_name}/nodes", params=params)
 
     
-    def terminate(self, node_ids=[]):
+    def terminate(self, node_ids=[], chunk_size=TERMINATE_CHUNK_SIZE, max_body_bytes=TERMINATE_MAX_BODY_BYTES,
+                  parallelism=TERMINATE_PARALLELISM):
         '''Terminate by NodeId
         Terminating by NodeId is STRONGLY preferred because hostname may be reused
-        (in the case of Spot this can cause termination of valid nodes)'''
+        (in the case of Spot this can cause termination of valid nodes)
+
+        Large id lists are split into chunks (by count and by request body size) which are
+        sent concurrently. A failed chunk does not raise (nor stop the other chunks): check the
+        returned per-chunk results, see _terminate_chunks.'''
 
         self.logger.warning("Terminating the following nodes by id: %s", node_ids)
-        
-        
-        response_raw = None
-        try:
-            response_raw = self.post(f"/clusters/{self.cluster_name}/nodes/terminate", body=json.dumps({"ids": node_ids}))
-        except Exception as e:
-            if "No instances were found matching your query" in str(e):
-                return
-            raise
-        
-        self.logger.warning(json.loads(response_raw))
-        return json.loads(response_raw)
+
+        def _terminate_ids(chunk):
+            return self.post(f"/clusters/{self.cluster_name}/nodes/terminate", body=json.dumps({"ids": chunk}))
+
+        chunks = _chunk(node_ids, chunk_size, max_body_bytes, lambda node_id: len(json.dumps(node_id)) + 2)
+        return self._terminate_chunks(chunks, _terminate_ids, parallelism)
 
 
-    def terminate_by_hostname(self, hostnames=[]):
+    def terminate_by_hostname(self, hostnames=[], chunk_size=TERMINATE_CHUNK_SIZE, max_filter_bytes=TERMINATE_MAX_FILTER_BYTES,
+                              parallelism=TERMINATE_PARALLELISM):
         '''Terminate by Hostname
-        Prefer terminating by NodeId if possible.'''
+        Prefer terminating by NodeId if possible.
+
+        The HostName filter is split into chunks (by count and by filter length) which are
+        sent concurrently. A failed chunk does not raise (nor stop the other chunks): check the
+        returned per-chunk results, see _terminate_chunks.'''
 
         self.logger.warning("Terminating the following nodes by hostnames: %s", hostnames)
-        f = urlencode('HostName in {%s}' % ",".join('"%s"' % x for x in hostnames))
-        
-        response_raw = None
-        try:
+
+        def _terminate_hostnames(chunk):
+            # the query params are url encoded by the session
+            f = 'HostName in {%s}' % ",".join('"%s"' % x for x in chunk)
             params = { 'instance-filter': f }
-            response_raw = self.post(f"/cloud/actions/terminate_node/{self.cluster_name}", params=params)
-        except Exception as e:
-            if "No instances were found matching your query" in str(e):
-                return
-            raise
-        self.logger.warning(json.loads(response_raw))
-        return json.loads(response_raw)
-            
-    def post(self, url, body=None, params={}, headers={}):
-        root_url = self.config['url']
-        full_url = root_url + url
-        self.logger.info("POST %s params %s headers %s body %s", full_url, params, headers, body)
-        
-        response = self.client.session._request("POST", full_url, params, headers, body)
+            return self.post(f"/cloud/actions/terminate_node/{self.cluster_name}", params=params)
+
+        chunks = _chunk(hostnames, chunk_size, max_filter_bytes, lambda hostname: len(hostname) + 3)
+        return self._terminate_chunks(chunks, _terminate_hostnames, parallelism)
+
+    def _terminate_chunks(self, chunks, terminate_chunk, parallelism):
+        '''Dispatches each chunk concurrently and aggregates the results
+        Every chunk gets its own status: "terminated", "not_found" (CycleCloud found none of
+        the chunk's nodes, which is not an error) or "failed", also when the response is not
+        JSON. The overall status is "success" unless at least one chunk failed ("partial") or
+        all of them did ("failed").'''
+        def _run(index):
+            chunk = chunks[index]
+            try:
+                response = json.loads(terminate_chunk(chunk))
+            except Exception as e:
+                if "No instances were found matching your query" in str(e):
+                    return {"items": chunk, "status": "not_found"}
+                self.logger.error("Failed to terminate chunk %d of %d (%d nodes): %s", index + 1, len(chunks), len(chunk), e)
+                return {"items": chunk, "status": "failed", "error": str(e)}
+            self.logger.debug(response)
+            return {"items": chunk, "status": "terminated", "response": response}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(chunks)))) as executor:
+            results = list(executor.map(_run, range(len(chunks))))
+
+        failed = [r for r in results if r["status"] == "failed"]
+        if not failed:
+            status = "success"
+        elif len(failed) == len(results):
+            status = "failed"
+        else:
+            status = "partial"
+        return {"status": status, "chunks": results}
+
+    def post(self, url, body=None, params={}, headers={}, timeout=None):
+        response = self.rest.post(url, params, headers, body, timeout=timeout)
         response_content = response.text
         if response_content is not None and isinstance(response_content, bytes):
             response_content = response_content.decode()
@@ -121,12 +214,8 @@ class Cluster:
             raise ValueError(response_content)
         return response_content
         
-    def get(self, url, body=None, params={}, headers={}):
-        root_url = self.config['url']
-        full_url = root_url + url        
-        self.logger.info("GET %s params %s headers %s body %s", full_url, params, headers, body)
-
-        response = self.client.session._request("GET", full_url, params, headers, body)
+    def get(self, url, body=None, params={}, headers={}, timeout=None, deadline=None):
+        response = self.rest.get(url, params, headers, body, timeout=timeout, deadline=deadline)
         response_content = response.text
         if response_content is not None and isinstance(response_content, bytes):
             response_content = response_content.decode()
@@ -136,46 +225,76 @@ class Cluster:
         return json.loads(response_content)
 
     
-def terminate_failed_nodes(cluster_name):
-
-    print(f"Terminating Failed Nodes for cluster : {cluster_name}")
+REPORT_FAILURE_STATES = ["Unavailable", "Failed"]
 
-    cluster = Cluster(cluster_name, CC_CONFIG)
 
+def terminate_failed_nodes(cluster_name, inventory=None, nodearray=None, confirm=True):
+    '''Terminates Failed and Unavailable nodes (optionally only in one nodearray)
+    Without an inventory the node list is streamed into a compact NodeSnapshot.
+    Pass a NodeInventory that is kept between calls to only re-read (and print) the nodes
+    that changed since the last call.
+    confirm asks before terminating. Without a terminal to ask on nothing is terminated: every
+    failed node would go at once, with no minimum age or caps. For unattended, policy driven
+    cleanup use reaper.FailedNodeReaper (cccli.py cleanup --once). confirm=False terminates
+    without asking.'''
 
-    try:
-        all_nodes = cluster.all_nodes()
-    except:
-        logger.exception("Azure CycleCloud experienced an error and the get return request failed. %s", e)
+    print(f"Terminating Failed Nodes for cluster : {cluster_name}")
 
-    failed_nodes=[]
-    for node in all_nodes['nodes']:
-        node_name = node.get("Name")
-        hostname = node.get("Hostname")
-        node_status = node.get("Status")
+    if inventory is None:
+        cluster = Cluster(cluster_name, CC_CONFIG)
+        try:
+            snapshot = NodeSnapshot.from_records(cluster.iter_nodes(attrs=SNAPSHOT_ATTRS))
+        except Exception as e:
+            logger.exception("Azure CycleCloud experienced an error and the get return request failed. %s", e)
+            return
+        printed = snapshot.iter_name_host_status()
+        failed_nodes = [snapshot.row(i) for i in snapshot.select(statuses=REPORT_FAILURE_STATES, nodearray=nodearray)]
+    else:
+        cluster = inventory.cluster
+        try:
+            changes = inventory.refresh()
+        except Exception as e:
+            logger.exception("Azure CycleCloud experienced an error and the get return request failed. %s", e)
+            return
+        printed = ((node.get("Name"), node.get("Hostname"), node.get("Status"))
+                   for node in (inventory.nodes[node_id] for node_id in changes["added"] + changes["changed"]))
+        failed_nodes = [n for n in inventory.by_status(*REPORT_FAILURE_STATES)
+                        if nodearray is None or n.get("Template") == nodearray]
 
+    for node_name, hostname, node_status in printed:
         print(f"Cluster Node: {node_name}   Host: {hostname}  Status: {node_status}")
 
-        report_failure_states = ["Unavailable", "Failed"]
-        if node_status in report_failure_states:
-            failed_nodes.append(node)
-
     if failed_nodes:
         print(f"The following nodes are unhealthy: {failed_nodes}")
-        input("Press a enter to terminate...") 
+        if confirm:
+            if not sys.stdin.isatty():
+                print("Not terminating: no terminal to confirm on. Use `cccli.py cleanup --once` for unattended cleanup.")
+                cluster.rest.log_connection_stats()
+                return
+            input("Press a enter to terminate...")
 
         failed_node_ids = [n['NodeId'] for n in failed_nodes]
         print(f"Terminating nodes : {failed_node_ids}")
         try:
-            cluster.terminate(failed_node_ids)
-        except:
+            result = cluster.terminate(failed_node_ids)
+            if result["status"] != "success":
+                print(f"Termination {result['status']}: {[c['error'] for c in result['chunks'] if c['status'] == 'failed']}")
+            if inventory is not None:
+                for chunk in result["chunks"]:
+                    if chunk["status"] == "terminated":
+                        inventory.track_operation(chunk["response"].get("operationId"))
+        except Exception as e:
             logger.exception("Azure CycleCloud experienced an error and the get return request failed. %s", e)
 
+    cluster.rest.log_connection_stats()
+
     
 if __name__ == "__main__":
 
     import getpass
 
+    metrics.configure_from_env()
+
     print('Enter CycleCloud url, username and password.')
     url = input('CycleCloud URL: ({})'.format(CC_CONFIG['url'])) or CC_CONFIG['url']
     username = input('username: ({})'.format(CC_CONFIG['username'])) or CC_CONFIG['username']
@@ -186,7 +305,14 @@ if __name__ == "__main__":
     CC_CONFIG['password'] = passwd
     CC_CONFIG['cluster_name'] = cluster_name
 
-                      
+    interval = float(input('Reap continuously every N seconds, 0 to run once: (0)') or 0)
+
     print("***************************")
-    terminate_failed_nodes(cluster_name)
+    if interval > 0:
+        from reaper import FailedNodeReaper, ReaperPolicy
+        min_failed_age = float(input('Minimum seconds in a failed state: (300)') or 300)
+        FailedNodeReaper(Cluster(cluster_name, CC_CONFIG), ReaperPolicy(min_failed_age=min_failed_age),
+                         decision_log="reaper-{}.jsonl".format(cluster_name)).run(interval)
+    else:
+        terminate_failed_nodes(cluster_name)
 
@@ -0,0 +1,295 @@
+"""Local parser and parameter validator for CycleCloud cluster templates (simple.txt style)
+
+Parses the [cluster], [[node]], [[nodearray]] and [[[subsection]]] INI dialect along with the
+[parameters] / [[[parameter]]] definitions, resolves Extends = inheritance (and [[node defaults]])
+and checks every $Param reference against the template's parameters and the parameters that will
+be passed to import_cluster, so typos are found before any network call. Parse results are cached
+by file path, size and mtime.
+
+    python cluster_template.py simple.txt simple_3nodearrays.txt -p params.json
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import typing
+
+
+SECTION_RE = re.compile(r"^(\[+)\s*([^\s\]]+)(?:\s+([^\]]*?))?\s*(\]+)$")
+ATTRIBUTE_RE = re.compile(r"^([^=:\s][^=]*?)\s*:?=\s*(.*)$")
+PARAM_REF_RE = re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*)")
+
+
+class TemplateValidationError(ValueError):
+    pass
+
+
+class Section:
+
+    def __init__(self, kind: str, name: str, line: int) -> None:
+        self.kind = kind
+        self.name = name
+        self.line = line
+        self.attributes: typing.Dict[str, str] = {}
+        self.subsections: typing.List["Section"] = []
+
+    def __repr__(self) -> str:
+        return "Section({} {}, {} attributes, {} subsections)".format(
+            self.kind, self.name, len(self.attributes), len(self.subsections))
+
+
+class ClusterDefinition:
+
+    def __init__(self, name: str, line: int) -> None:
+        self.name = name
+        self.line = line
+        self.attributes: typing.Dict[str, str] = {}
+        # node and nodearray sections by name, "defaults" included
+        self.nodes: typing.Dict[str, Section] = {}
+
+
+class Template:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.clusters: typing.Dict[str, ClusterDefinition] = {}
+        self.parameters: typing.Dict[str, Section] = {}
+        self.errors: typing.List[str] = []
+
+    def cluster(self, name: typing.Optional[str] = None) -> ClusterDefinition:
+        if name is None:
+            return next(iter(self.clusters.values()))
+        return self.clusters[name]
+
+    def resolved(self, cluster_name: typing.Optional[str] = None,
+                 cluster_parameters: typing.Optional[typing.Dict[str, typing.Any]] = None) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """Attributes of every node/nodearray after [[node defaults]] and Extends inheritance.
+        With cluster_parameters, $Param values are replaced by the parameter (or its DefaultValue)."""
+        cluster = self.cluster(cluster_name)
+        resolved: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        for name in cluster.nodes:
+            if name != "defaults":
+                resolved[name] = _resolve(cluster, name, [])
+        if cluster_parameters is not None:
+            for attributes in resolved.values():
+                for key, value in attributes.items():
+                    attributes[key] = self.substitute(value, cluster_parameters)
+        return resolved
+
+    def parameter_value(self, name: str, cluster_parameters: typing.Dict[str, typing.Any]) -> typing.Any:
+        if name in cluster_parameters:
+            return cluster_parameters[name]
+        parameter = self.parameters.get(name)
+        return parameter.attributes.get("DefaultValue") if parameter else None
+
+    def substitute(self, value: str, cluster_parameters: typing.Dict[str, typing.Any]) -> typing.Any:
+        match = PARAM_REF_RE.fullmatch(value)
+        if match:
+            # a bare reference keeps the parameter's type (e.g. a list of machine types)
+            return self.parameter_value(match.group(1), cluster_parameters)
+        return PARAM_REF_RE.sub(lambda m: str(self.parameter_value(m.group(1), cluster_parameters)), value)
+
+
+def _resolve(cluster: ClusterDefinition, name: str, chain: typing.List[str]) -> typing.Dict[str, str]:
+    if name in chain:
+        raise TemplateValidationError("Circular Extends: {}".format(" -> ".join(chain + [name])))
+    section = cluster.nodes[name]
+    parent = section.attributes.get("Extends")
+    if parent:
+        if parent not in cluster.nodes:
+            raise TemplateValidationError("[[{} {}]] line {} extends unknown node or nodearray '{}'".format(
+                section.kind, name, section.line, parent))
+        attributes = _resolve(cluster, parent, chain + [name])
+    elif name != "defaults" and "defaults" in cluster.nodes:
+        attributes = dict(cluster.nodes["defaults"].attributes)
+    else:
+        attributes = {}
+    attributes.update({k: v for k, v in section.attributes.items() if k != "Extends"})
+    return attributes
+
+
+def parse(text: str, path: str = "<string>") -> Template:
+    template = Template(path)
+    # stack of (depth, object) for the sections currently open
+    stack: typing.List[typing.Tuple[int, typing.Any]] = []
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        lineno = i + 1
+        line = lines[i].strip()
+        i += 1
+        if not line or line.startswith("#"):
+            continue
+
+        match = SECTION_RE.match(line)
+        if match:
+            depth = len(match.group(1))
+            if depth != len(match.group(4)):
+                template.errors.append("{}:{}: unbalanced brackets in '{}'".format(path, lineno, line))
+                continue
+            kind, name = match.group(2), (match.group(3) or "").strip()
+            while stack and stack[-1][0] >= depth:
+                stack.pop()
+            parent = stack[-1][1] if stack else None
+
+            if depth == 1 and kind == "cluster":
+                obj: typing.Any = ClusterDefinition(name, lineno)
+                template.clusters[name] = obj
+            elif depth == 2 and kind in ("node", "nodearray") and isinstance(parent, ClusterDefinition):
+                obj = Section(kind, name, lineno)
+                if name in parent.nodes:
+                    template.errors.append("{}:{}: duplicate [[{} {}]]".format(path, lineno, kind, name))
+                parent.nodes[name] = obj
+            elif kind == "parameter":
+                obj = Section(kind, name, lineno)
+                template.parameters[name] = obj
+            elif kind == "parameters" or depth == 1:
+                obj = Section(kind, name, lineno)
+            elif isinstance(parent, Section):
+                obj = Section(kind, name, lineno)
+                parent.subsections.append(obj)
+            else:
+                template.errors.append("{}:{}: [{}] section is not inside a cluster or node".format(path, lineno, kind))
+                obj = Section(kind, name, lineno)
+            stack.append((depth, obj))
+            continue
+
+        match = ATTRIBUTE_RE.match(line)
+        if not match:
+            template.errors.append("{}:{}: cannot parse '{}'".format(path, lineno, line))
+            continue
+        key, value = match.group(1).strip(), match.group(2).strip()
+        if value.startswith("'''") and (len(value) < 6 or not value.endswith("'''")):
+            # multi-line string
+            parts = [value[3:]]
+            while i < len(lines) and not lines[i].rstrip().endswith("'''"):
+                parts.append(lines[i])
+                i += 1
+            if i < len(lines):
+                parts.append(lines[i].rstrip()[:-3])
+                i += 1
+            else:
+                template.errors.append("{}:{}: unterminated ''' string".format(path, lineno))
+            value = "\n".join(parts)
+        if not stack:
+            template.errors.append("{}:{}: attribute '{}' outside of any section".format(path, lineno, key))
+            continue
+        stack[-1][1].attributes[key] = value
+    return template
+
+
+_CACHE: typing.Dict[str, typing.Tuple[typing.Tuple[int, float], Template]] = {}
+
+
+def load(path: str) -> Template:
+    """Parses the template file, or returns the cached parse if the file is unchanged"""
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    signature = (st.st_size, st.st_mtime)
+    cached = _CACHE.get(key)
+    if cached and cached[0] == signature:
+        return cached[1]
+    with open(path) as fr:
+        template = parse(fr.read(), path)
+    _CACHE[key] = (signature, template)
+    return template
+
+
+def validate(template: Template, cluster_parameters: typing.Dict[str, typing.Any],
+             template_cluster_name: typing.Optional[str] = None) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """Returns (errors, warnings) for importing the template with these parameters"""
+    errors = list(template.errors)
+    warnings: typing.List[str] = []
+
+    if not template.clusters:
+        errors.append("{}: no [cluster] section".format(template.path))
+        return errors, warnings
+    if template_cluster_name and template_cluster_name not in template.clusters:
+        errors.append("{}: no [cluster {}], found {}".format(template.path, template_cluster_name, sorted(template.clusters)))
+        return errors, warnings
+
+    defined = template.parameters
+    lowercase = {name.lower(): name for name in defined}
+    cluster = template.cluster(template_cluster_name)
+
+    try:
+        template.resolved(cluster.name)
+    except TemplateValidationError as e:
+        errors.append("{}: {}".format(template.path, e))
+
+    referenced: typing.Set[str] = set()
+    sections = [("cluster {}".format(cluster.name), cluster.line, cluster.attributes)]
+    for node in cluster.nodes.values():
+        sections.append(("{} {}".format(node.kind, node.name), node.line, node.attributes))
+        pending = list(node.subsections)
+        while pending:
+            sub = pending.pop()
+            sections.append(("{} {} {}".format(node.name, sub.kind, sub.name).strip(), sub.line, sub.attributes))
+            pending.extend(sub.subsections)
+
+    for where, line, attributes in sections:
+        for key, value in attributes.items():
+            for ref in PARAM_REF_RE.findall(value):
+                referenced.add(ref)
+                if ref in defined or ref in cluster_parameters:
+                    continue
+                if ref.lower() in lowercase:
+                    errors.append("{}:{}: [{}] {} references ${} but the parameter is named {}".format(
+                        template.path, line, where, key, ref, lowercase[ref.lower()]))
+                else:
+                    errors.append("{}:{}: [{}] {} references undefined parameter ${}".format(
+                        template.path, line, where, key, ref))
+
+    for name, parameter in defined.items():
+        supplied = name in cluster_parameters or "DefaultValue" in parameter.attributes
+        if parameter.attributes.get("Required", "").lower() == "true" and not supplied:
+            errors.append("{}:{}: required parameter {} is not set".format(template.path, parameter.line, name))
+        elif name in referenced and not supplied:
+            warnings.append("{}:{}: parameter {} has no value or DefaultValue".format(template.path, parameter.line, name))
+
+    for name in sorted(cluster_parameters):
+        if name not in defined:
+            if name.lower() in lowercase:
+                errors.append("{}: parameter {} is passed but the template defines {}".format(
+                    template.path, name, lowercase[name.lower()]))
+            else:
+                warnings.append("{}: parameter {} is passed but not defined by the template".format(template.path, name))
+    return errors, warnings
+
+
+def check(template_file: str, cluster_parameters: typing.Dict[str, typing.Any],
+          template_cluster_name: typing.Optional[str] = None) -> typing.List[str]:
+    """Raises TemplateValidationError listing every error, returns the warnings"""
+    errors, warnings = validate(load(template_file), cluster_parameters, template_cluster_name)
+    if errors:
+        raise TemplateValidationError("Invalid cluster template {}:\n  {}".format(template_file, "\n  ".join(errors)))
+    return warnings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Validate cluster templates before import_cluster")
+    parser.add_argument("templates", nargs="+")
+    parser.add_argument("-p", "--parameters", default=None, help="JSON parameters file, as passed to import_cluster")
+    parser.add_argument("-c", "--cluster", default=None, help="Cluster name inside the template")
+    parser.add_argument("--strict", action="store_true", help="Treat warnings as errors")
+    args = parser.parse_args()
+
+    cluster_parameters = {}
+    if args.parameters:
+        with open(args.parameters) as fr:
+            cluster_parameters = json.load(fr)
+
+    failed = False
+    for path in args.templates:
+        errors, warnings = validate(load(path), cluster_parameters, args.cluster)
+        for message in errors:
+            print("ERROR", message)
+        for message in warnings:
+            print("WARNING", message)
+        failed = failed or bool(errors) or (args.strict and bool(warnings))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
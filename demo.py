@@ -4,10 +4,16 @@ import json
 from cyclecloud.client import Client, Record
 import logging
 import sys
-from retry import retry
 
 from uuid import uuid4
 
+import cluster_template
+import metrics
+import node_store
+from capacity import CapacityCache
+from ccrest import get_rest_client, quote
+from import_state import ImportState, import_hash
+from waiters import wait_for_node_states
 from hpc.autoscale.example.readmeutil import clone_dcalc, example, withcontext
 from hpc.autoscale.hpctypes import Memory
 from hpc.autoscale.node.constraints import BaseNodeConstraint
@@ -84,43 +90,79 @@ def generate_import_params(template_file, cluster_parameters, template_cluster_n
     return params
 
 
-def import_cluster(client, cluster_name, template_file, cluster_parameters, template_cluster_name = None):
-    # cluster_name should be url quoted
-    import urllib
-    quoted_name = urllib.parse.quote(cluster_name, safe="")
+def _rest(client):
+    # All raw REST helpers share one pooled, authenticated session per CycleCloud url/user
+    return get_rest_client(client.session._config)
 
+
+# What each cluster was last imported (and started) with, so no-op imports and starts are skipped
+IMPORT_STATE = ImportState()
+
+
+class SkippedResponse:
+    """Returned in place of a response when a request was skipped because nothing changed"""
+    status_code = 304
+
+    def __init__(self, text):
+        self.text = text
+
+
+def _state_key(client, cluster_name):
+    return "{}/{}".format(_rest(client).base_url, cluster_name)
+
+
+# Cluster states in which startcluster has nothing to do
+STARTED_CLUSTER_STATES = {"started", "starting"}
+
+
+def _cluster_state(client, cluster_name):
+    """The cluster's state according to the server (lower case), None if it does not exist"""
+    response = show_cluster(client, cluster_name)
+    if response.status_code == 404:
+        return None
+    if not 200 <= response.status_code < 300:
+        raise RuntimeError("Could not get cluster {}: {} {}".format(cluster_name, response.status_code, response.text))
+    record = response.json()
+    if isinstance(record, list):
+        if not record:
+            return None
+        record = record[0]
+    return str(record.get("state") or record.get("State") or "").lower()
+
+
+def import_cluster(client, cluster_name, template_file, cluster_parameters, template_cluster_name = None, force=False):
     # Quoted Name is the desired new cluster name
-    api_path = "/cloud/api/import_cluster/{}".format(quoted_name)
-    base_url = client.session._config["url"]
-    base_url = base_url.rstrip("/")
-    full_url = base_url + api_path        
+    api_path = "/cloud/api/import_cluster/{}".format(quote(cluster_name))
 
-    verb="POST"
     params = {}
     headers = {}
     if not template_cluster_name:
         template_cluster_name = cluster_name
+    # Catch template and parameter typos locally instead of after a server round-trip
+    for warning in cluster_template.check(template_file, cluster_parameters, template_cluster_name):
+        logging.warning(warning)
     body = generate_import_params(template_file, cluster_parameters, template_cluster_name)
-    responses = []
 
-    return client.session._request(verb, full_url, params, headers, body)
+    # Skip the import if the rendered template and parameters are unchanged since the last one
+    digest = import_hash(body)
+    key = _state_key(client, cluster_name)
+    # ... and the cluster was not deleted behind our back
+    if not force and IMPORT_STATE.is_imported(key, digest) and _cluster_state(client, cluster_name) is not None:
+        return SkippedResponse("Cluster {} is already imported with this template and parameters".format(cluster_name))
+
+    response = _rest(client).post(api_path, params, headers, body)
+    if 200 <= response.status_code < 300:
+        IMPORT_STATE.update(key, import_hash=digest)
+    return response
 
 def show_cluster(client, cluster_name=None, summary=True, include_templates=False):
     # This method replicates the CLI show_cluster method
     # NOTE: It is better to use client.clusters and client.nodes to iterate over clusters
     #       and nodes.
-    import urllib
-    quoted_name = None
     api_path = "/cloud/clusters"
     if cluster_name:
-        quoted_name = urllib.parse.quote(cluster_name, safe="")
-        api_path = "/cloud/clusters/{}".format(quoted_name)
-
-    base_url = client.session._config["url"]
-    base_url = base_url.rstrip("/")
-    full_url = base_url + api_path        
+        api_path = "/cloud/clusters/{}".format(quote(cluster_name))
 
-    verb="GET"
     params = {}
     # Use new Cloud.Instance records not legacy types
     params['cloud_instances'] = "true"
@@ -134,19 +176,17 @@ def show_cluster(client, cluster_name=None, summary=True, include_templates=Fals
     headers = {}
     body = None
 
-    return client.session._request(verb, full_url, params, headers, body)
+    return _rest(client).get(api_path, params, headers, body)
     
-def start_cluster(client, cluster_name):
-    # cluster_name should be url quoted
-    import urllib
-    quoted_name = urllib.parse.quote(cluster_name, safe="")
-
-    api_path = "/cloud/actions/startcluster/{}".format(quoted_name)
-    base_url = client.session._config["url"]
-    base_url = base_url.rstrip("/")
-    full_url = base_url + api_path
+def start_cluster(client, cluster_name, force=False):
+    # Skip the start if the cluster was already started (activated) since its last import, and
+    # the server agrees it still is (it may have been terminated from the UI or CLI since)
+    key = _state_key(client, cluster_name)
+    if not force and IMPORT_STATE.is_started(key) and _cluster_state(client, cluster_name) in STARTED_CLUSTER_STATES:
+        return SkippedResponse("Cluster {} is already started with its current import".format(cluster_name))
+
+    api_path = "/cloud/actions/startcluster/{}".format(quote(cluster_name))
     
-    verb = "POST"
     params = {}
     # Optional, insert a sleep to wait for cluster state to update for more user friendly output
     # params['wait_time'] = 30
@@ -157,39 +197,27 @@ def start_cluster(client, cluster_name):
     headers = {}
     body = None
     
-    return client.session._request(verb, full_url, params, headers, body)
+    response = _rest(client).post(api_path, params, headers, body)
+    if 200 <= response.status_code < 300:
+        IMPORT_STATE.update(key, started_hash=IMPORT_STATE.get(key).get("import_hash"))
+    return response
 
 def retry_cluster(client, cluster_name):
-    import urllib
-    quoted_name = urllib.parse.quote(cluster_name, safe="")
-
-    api_path = "/cloud/actions/retry/{}".format(quoted_name)
-    base_url = client.session._config["url"]
-    base_url = base_url.rstrip("/")
-    full_url = base_url + api_path
+    api_path = "/cloud/actions/retry/{}".format(quote(cluster_name))
     
-    verb = "POST"
     params = {}
     # Retry dependent clusters for hierarchical clusters
     # params['recursive'] = false
     headers = {}
     body = None
     
-    return client.session._request(verb, full_url, params, headers, body)
+    return _rest(client).post(api_path, params, headers, body)
     
 
 
 def terminate_cluster(client, cluster_name):
-    # cluster_name should be url quoted
-    import urllib
-    quoted_name = urllib.parse.quote(cluster_name, safe="")
-
-    api_path = "/cloud/actions/terminatecluster/{}".format(quoted_name)
-    base_url = client.session._config["url"]
-    base_url = base_url.rstrip("/")
-    full_url = base_url + api_path
+    api_path = "/cloud/actions/terminatecluster/{}".format(quote(cluster_name))
     
-    verb = "POST"
     params = {}
     # Optional, insert a sleep to wait for cluster state to update for more user friendly output
     params['wait_time'] = 30
@@ -198,21 +226,16 @@ def terminate_cluster(client, cluster_name):
     headers = {}
     body = None
     
-    return client.session._request(verb, full_url, params, headers, body)
+    response = _rest(client).post(api_path, params, headers, body)
+    if 200 <= response.status_code < 300:
+        IMPORT_STATE.update(_state_key(client, cluster_name), started_hash=None)
+    return response
 
 
 
 def delete_cluster(client, cluster_name):
-    # cluster_name should be url quoted
-    import urllib
-    quoted_name = urllib.parse.quote(cluster_name, safe="")
-
-    api_path = "/cloud/actions/removecluster/{}".format(quoted_name)
-    base_url = client.session._config["url"]
-    base_url = base_url.rstrip("/")
-    full_url = base_url + api_path
+    api_path = "/cloud/actions/removecluster/{}".format(quote(cluster_name))
     
-    verb = "POST"
     params = {}
     # Optional, insert a sleep to wait for cluster state to update for more user friendly output
     # params['wait_time'] = 30
@@ -226,32 +249,34 @@ def delete_cluster(client, cluster_name):
     headers = {}
     body = None
     
-    return client.session._request(verb, full_url, params, headers, body)
+    response = _rest(client).post(api_path, params, headers, body)
+    if 200 <= response.status_code < 300:
+        IMPORT_STATE.forget(_state_key(client, cluster_name))
+    return response
 
 
 def add_nodes(cluster_name, sku="Standard_F72S_v2", count=1):
     config = dict(CC_CONFIG)
-    config["cluster_name"] = "apiTest"
-    node_mgr=new_node_manager(config)
+    config["cluster_name"] = cluster_name
+    with metrics.timed("new_node_manager"):
+        node_mgr=new_node_manager(config)
     # Optional: add consumable resources for autoscale packing
     node_mgr.add_default_resource({}, "ncpus", "node.vcpu_count")
 
+    capacity = CapacityCache(node_mgr)
+
     # Show available capacity before:
     print("Capacity BEFORE scale up")
-    buckets=node_mgr.get_buckets()
-    for bucket in buckets:
-        print(bucket)
+    capacity.print_buckets()
     
     # allocate by  node (vs slot)
-    r=node_mgr.allocate({"node.vm_size": sku}, node_count=count)
+    r=capacity.allocate({"node.vm_size": sku}, node_count=count)
     print("About to START nodes")
-    node_mgr.bootup()
+    capacity.bootup()
 
     # Show capacity after
     print("Capacity AFTER scale up")
-    buckets=node_mgr.get_buckets()
-    for bucket in buckets:
-        print(bucket)
+    capacity.print_buckets()
 
 
 def show_nodes(client, cluster_name=None, node_name=None, filter_expr=None, attrs_select=None,
@@ -259,18 +284,11 @@ def show_nodes(client, cluster_name=None, node_name=None, filter_expr=None, attr
     # This method replicates the CLI show_nodes method
     # NOTE: It is generally better to use client.clusters and client.nodes to iterate over clusters
     #       and nodes.
-    import urllib
-    quoted_name = None
     api_path = "/cloud/api/nodes"
     if node_name:
-        quoted_name = urllib.parse.quote(node_name, safe="")
-        api_path = "/cloud/api/nodes/{}".format(quoted_name)
-
-    base_url = client.session._config["url"]
-    base_url = base_url.rstrip("/")
-    full_url = base_url + api_path        
+        api_path = "/cloud/api/nodes/{}".format(quote(node_name))
 
-    verb="GET"
+    rest_client = _rest(client)
     headers = {}
     body = None
     params = {}
@@ -295,29 +313,41 @@ def show_nodes(client, cluster_name=None, node_name=None, filter_expr=None, attr
 
     params['filter'] = filter_expr
 
-    print("Requesting: {}\nParams: {}".format(full_url, params))
-    return client.session._request(verb, full_url, params, headers, body)
+    print("Requesting: {}\nParams: {}".format(rest_client.url(api_path), params))
+    return rest_client.get(api_path, params, headers, body)
+
 
+def show_nodes_local(store, cluster_name, filter_expr=None, attrs_select=None, output_format="jsonl",
+                     limit=None, offset=0, out=sys.stdout):
+    # Same filter expression and attrs as show_nodes, answered from a local NodeStore
+    # (kept fresh with store.sync) instead of a server side dump, one page streamed at a time
+    attrs = node_store.parse_attrs(attrs_select)
+    rows = store.query(cluster_name, filter_expr, attrs, limit=limit, offset=offset)
+    if output_format == "csv":
+        return node_store.write_csv(rows, attrs, out)
+    return node_store.write_jsonl(rows, out)
+
+
+NODE_STATUS_ATTRS = ["Name", "Hostname", "Status", "NodeId"]
 
 def get_node_status(client, cluster_name):
-    cluster = client.clusters.get(cluster_name)
     print("Cluster {}".format(cluster_name))
     node_status = []
-    for node in cluster.nodes:
+    # Stream the node list so only a handful of attributes per node is ever held in memory
+    for node in _rest(client).iter_cluster_nodes(cluster_name, attrs=NODE_STATUS_ATTRS):
         print(node)
         node_status.append(node['Status'])
     return node_status
 
-@retry(ClusterTimeoutError, tries=600)
-def wait_for_cluster_termination(client, cluster_name):
-    import time
-    time.sleep(10)
-    node_status = get_node_status(client, cluster_name)
-    if all(map(lambda s: s == "Off", node_status)):
-        return
-    if any(map(lambda s: s == "Failed", node_status)):
+def wait_for_cluster_termination(client, cluster_name, timeout=6000):
+    # Polls with adaptive backoff and only reports nodes that are not Off yet
+    result = wait_for_node_states(_rest(client), cluster_name, target_states=["Off"], failed_states=["Failed"],
+                                  timeout=timeout)
+    print("Time per phase: {}".format({status: round(seconds, 1) for status, seconds in result.phases.items()}))
+    if result.outcome == "failed":
         raise Exception("One or more nodes failed unexpectedly in cluster {}".format(cluster_name))
-    raise ClusterTimeoutError("Timer expired waiting for nodes in cluster {} to terminate.")
+    if result.outcome == "timeout":
+        raise ClusterTimeoutError("Timer expired waiting for nodes in cluster {} to terminate.".format(cluster_name))
     
 
 def test_cli_cluster_management(cluster_name="cliTest"):
@@ -415,6 +445,8 @@ def test_api_cluster_management(cluster_name="apiTest"):
     r = delete_cluster(client, cluster_name)
     print("{} : {}".format(r.status_code, r.text))
 
+    _rest(client).log_connection_stats()
+
     
 
 
@@ -424,6 +456,8 @@ if __name__ == "__main__":
 
     import getpass
 
+    metrics.configure_from_env()
+
     print('Enter CycleCloud url, username and password.')
     url = input('CycleCloud URL: ({})'.format(CC_CONFIG['url'])) or CC_CONFIG['url']
     username = input('username: ({})'.format(CC_CONFIG['username'])) or CC_CONFIG['username']
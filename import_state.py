@@ -0,0 +1,72 @@
+"""Local record of what each cluster was last imported with
+
+import_cluster and start_cluster consult it to skip calls that would not change anything: an
+import whose rendered template and parameters hash the same as the last successful import of
+that cluster, and a start_cluster when the cluster was already started after that import.
+The record is only a hint: the cluster can be deleted, stopped or edited from the UI, the CLI
+or another host. Callers confirm the cluster's existence and state with the server before
+skipping (edits made outside this process are not detected, pass force to re-import).
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import typing
+
+
+DEFAULT_STATE_FILE = os.path.join(os.path.expanduser("~"), ".cyclecloud-demo", "import_state.json")
+
+
+def import_hash(import_params: typing.Dict[str, typing.Any]) -> str:
+    """sha256 of the import body, with the parameters canonicalized so key order doesn't matter"""
+    canonical = dict(import_params)
+    if canonical.get("parameters_format") == "json" and isinstance(canonical.get("parameters"), str):
+        canonical["parameters"] = json.loads(canonical["parameters"])
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+
+class ImportState:
+
+    def __init__(self, path: str = DEFAULT_STATE_FILE) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        try:
+            with open(self.path) as fr:
+                return json.load(fr)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, state: typing.Dict[str, typing.Dict[str, typing.Any]]) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        # a temporary file of our own, so concurrent writers in other processes don't clobber it
+        with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as fw:
+            json.dump(state, fw, indent=2, sort_keys=True)
+        # atomic, so concurrent readers never see a partial file
+        os.replace(fw.name, self.path)
+
+    def get(self, key: str) -> typing.Dict[str, typing.Any]:
+        with self.lock:
+            return self._load().get(key, {})
+
+    def update(self, key: str, **values: typing.Any) -> None:
+        with self.lock:
+            state = self._load()
+            state.setdefault(key, {}).update(values)
+            self._save(state)
+
+    def forget(self, key: str) -> None:
+        with self.lock:
+            state = self._load()
+            if state.pop(key, None) is not None:
+                self._save(state)
+
+    def is_imported(self, key: str, digest: str) -> bool:
+        return self.get(key).get("import_hash") == digest
+
+    def is_started(self, key: str) -> bool:
+        record = self.get(key)
+        return bool(record.get("import_hash")) and record.get("started_hash") == record.get("import_hash")
@@ -0,0 +1,140 @@
+"""Incremental node inventory for a CycleCloud cluster
+
+Keeps the cluster's node records keyed by NodeId along with lookup indexes by Status,
+nodearray (the node's Template) and hostname.
+
+The node listing is fetched with a conditional (If-None-Match) GET, streamed from the
+response. When the server supports ETags, every refresh does such a poll: a 304 costs next to
+nothing and otherwise every node is seen, including new failures of nodes no operation of ours
+touched. Without ETags the listing is only fetched on the first refresh and every
+full_sync_interval seconds. In between, the /clusters/{name}/nodes API can only be narrowed by
+operation (or request_id), so a delta refresh fetches just the nodes touched by the operations
+we know about (allocations, terminations, ...). An operation stays tracked until all of its
+nodes settled (see SETTLED_STATUSES) or went away. Only the records that actually changed are
+re-indexed.
+"""
+import logging
+import time
+import typing
+
+
+# Changes to any of these attributes move a node between indexes or matter to callers
+TRACKED_ATTRIBUTES = ("Status", "TargetState", "Hostname", "Template", "PrivateIp", "State")
+
+# A node in one of these stays there until someone acts on it
+SETTLED_STATUSES = ("Ready", "Failed", "Unavailable", "Off", "Terminated", "Deallocated")
+
+
+class NodeInventory:
+
+    def __init__(self, cluster, full_sync_interval: float = 300, logger=None) -> None:
+        self.cluster = cluster
+        self.full_sync_interval = full_sync_interval
+        self.logger = logger or logging.getLogger()
+
+        self.nodes: typing.Dict[str, typing.Dict] = {}
+        self._by_status: typing.Dict[str, typing.Set[str]] = {}
+        self._by_nodearray: typing.Dict[str, typing.Set[str]] = {}
+        self._by_hostname: typing.Dict[str, str] = {}
+        self._pending_operations: typing.Set[str] = set()
+        self._etag: typing.Optional[str] = None
+
+        self.last_full_sync: typing.Optional[float] = None
+        self.last_refresh: typing.Optional[float] = None
+
+    def track_operation(self, operation_id: str) -> None:
+        """Refresh the nodes of this operation (e.g. from an allocation or terminate) on the next delta refresh."""
+        if operation_id:
+            self._pending_operations.add(operation_id)
+
+    def refresh(self, force_full: bool = False) -> typing.Dict[str, typing.List[str]]:
+        """Brings the inventory up to date and returns the NodeIds that were added, changed and removed."""
+        now = time.time()
+        full = (
+            force_full
+            or self.last_full_sync is None
+            or now - self.last_full_sync >= self.full_sync_interval
+        )
+        changes: typing.Dict[str, typing.List[str]] = {"added": [], "changed": [], "removed": []}
+        modified = True
+        if full or self._etag:
+            modified = self._sync(changes, None if force_full else self._etag)
+            if full:
+                self.last_full_sync = now
+        if modified:
+            # a 304 means none of the operations' nodes moved either
+            self._refresh_operations(changes)
+        self.last_refresh = now
+        self.logger.debug("Inventory %s refresh of %s: %d added, %d changed, %d removed",
+                          "full" if full else "delta", self.cluster.cluster_name,
+                          len(changes["added"]), len(changes["changed"]), len(changes["removed"]))
+        return changes
+
+    def _sync(self, changes: typing.Dict[str, typing.List[str]], etag: typing.Optional[str]) -> bool:
+        """Merges the whole node listing, returns False if it was not modified since etag"""
+        self._etag, records = self.cluster.poll_nodes(etag=etag)
+        if records is None:
+            return False
+        seen = self._merge(records, changes)
+        for node_id in list(self.nodes.keys()):
+            if node_id not in seen:
+                self._remove(node_id)
+                changes["removed"].append(node_id)
+        return True
+
+    def _refresh_operations(self, changes: typing.Dict[str, typing.List[str]]) -> None:
+        for operation_id in list(self._pending_operations):
+            records = self.cluster.nodes_by_operation_id(operation_id).get("nodes", [])
+            self._merge(records, changes)
+            # keep polling until e.g. Terminating nodes are Terminated, or gone
+            if all(record.get("Status") in SETTLED_STATUSES for record in records):
+                self._pending_operations.discard(operation_id)
+
+    def _merge(self, records: typing.Iterable[typing.Dict], changes: typing.Dict[str, typing.List[str]]) -> typing.Set[str]:
+        seen = set()
+        for record in records:
+            node_id = record.get("NodeId")
+            if not node_id:
+                continue
+            seen.add(node_id)
+            existing = self.nodes.get(node_id)
+            if existing is None:
+                self._add(node_id, record)
+                changes["added"].append(node_id)
+            elif any(existing.get(attr) != record.get(attr) for attr in TRACKED_ATTRIBUTES):
+                self._remove(node_id)
+                self._add(node_id, record)
+                changes["changed"].append(node_id)
+            else:
+                # keep the latest copy of the untracked attributes without touching the indexes
+                self.nodes[node_id] = record
+        return seen
+
+    def _add(self, node_id: str, record: typing.Dict) -> None:
+        self.nodes[node_id] = record
+        self._by_status.setdefault(record.get("Status"), set()).add(node_id)
+        self._by_nodearray.setdefault(record.get("Template"), set()).add(node_id)
+        hostname = record.get("Hostname")
+        if hostname:
+            self._by_hostname[hostname.lower()] = node_id
+
+    def _remove(self, node_id: str) -> None:
+        record = self.nodes.pop(node_id)
+        self._by_status.get(record.get("Status"), set()).discard(node_id)
+        self._by_nodearray.get(record.get("Template"), set()).discard(node_id)
+        hostname = record.get("Hostname")
+        if hostname and self._by_hostname.get(hostname.lower()) == node_id:
+            self._by_hostname.pop(hostname.lower())
+
+    def by_status(self, *statuses: str) -> typing.List[typing.Dict]:
+        return [self.nodes[node_id] for status in statuses for node_id in self._by_status.get(status, ())]
+
+    def by_nodearray(self, nodearray: str) -> typing.List[typing.Dict]:
+        return [self.nodes[node_id] for node_id in self._by_nodearray.get(nodearray, ())]
+
+    def by_hostname(self, hostname: str) -> typing.Optional[typing.Dict]:
+        node_id = self._by_hostname.get(hostname.lower())
+        return self.nodes.get(node_id) if node_id else None
+
+    def __len__(self) -> int:
+        return len(self.nodes)
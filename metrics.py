@@ -0,0 +1,228 @@
+"""Call counts, latency histograms, payload sizes and retries for CycleCloud calls
+
+Every RestClient request is recorded per endpoint (e.g. "POST /cloud/actions/{action}/{name}").
+Scalelib calls are recorded by wrapping them:
+
+    with metrics.timed("node_mgr.bootup"):
+        node_mgr.bootup()
+
+Results are exported as JSON or Prometheus text, either at the end of a run (set CC_METRICS_OUT
+to a .json or .prom path) or scraped live from a long running process (set CC_METRICS_PORT).
+"""
+import atexit
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(10))
+
+
+class Histogram:
+
+    def __init__(self, buckets: typing.Sequence[float]) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "buckets": {str(bound): count for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts)},
+        }
+
+
+class CallStats:
+    """Everything recorded for one endpoint or wrapped call"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.status_codes: typing.Dict[str, int] = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.request_bytes = Histogram(SIZE_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "status_codes": dict(self.status_codes),
+            "latency_seconds": self.latency.to_dict(),
+            "request_bytes": self.request_bytes.to_dict(),
+            "response_bytes": self.response_bytes.to_dict(),
+        }
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls: typing.Dict[str, CallStats] = {}
+        self.gauges: typing.Dict[str, float] = {}
+        self.started = time.time()
+
+    def _stats(self, name: str) -> CallStats:
+        stats = self.calls.get(name)
+        if stats is None:
+            stats = self.calls[name] = CallStats()
+        return stats
+
+    def observe(self, name: str, seconds: float, status_code: typing.Optional[int] = None, error: bool = False,
+                request_bytes: typing.Optional[int] = None, response_bytes: typing.Optional[int] = None) -> None:
+        with self.lock:
+            stats = self._stats(name)
+            stats.calls += 1
+            stats.latency.observe(seconds)
+            if error:
+                stats.errors += 1
+            if status_code is not None:
+                stats.status_codes[str(status_code)] = stats.status_codes.get(str(status_code), 0) + 1
+            if request_bytes is not None:
+                stats.request_bytes.observe(request_bytes)
+            if response_bytes is not None:
+                stats.response_bytes.observe(response_bytes)
+
+    def retry(self, name: str, count: int = 1) -> None:
+        with self.lock:
+            self._stats(name).retries += count
+
+    def gauge(self, name: str, value: float) -> None:
+        with self.lock:
+            self.gauges[name] = value
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        with self.lock:
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "calls": {name: stats.to_dict() for name, stats in sorted(self.calls.items())},
+                "gauges": dict(sorted(self.gauges.items())),
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        data = self.to_dict()
+        lines = []
+
+        def _label(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"')
+
+        for metric, kind, help_text in [("cyclecloud_calls_total", "counter", "Calls per endpoint"),
+                                        ("cyclecloud_errors_total", "counter", "Failed calls per endpoint"),
+                                        ("cyclecloud_retries_total", "counter", "Retried calls per endpoint")]:
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} {}".format(metric, kind))
+            key = metric.split("_")[1]
+            for name, stats in data["calls"].items():
+                lines.append('{}{{endpoint="{}"}} {}'.format(metric, _label(name), stats[key]))
+
+        lines.append("# HELP cyclecloud_responses_total Responses per endpoint and HTTP status")
+        lines.append("# TYPE cyclecloud_responses_total counter")
+        for name, stats in data["calls"].items():
+            for code, count in sorted(stats["status_codes"].items()):
+                lines.append('cyclecloud_responses_total{{endpoint="{}",code="{}"}} {}'.format(_label(name), code, count))
+
+        for metric, key, help_text in [("cyclecloud_latency_seconds", "latency_seconds", "Call latency"),
+                                       ("cyclecloud_request_bytes", "request_bytes", "Request body size"),
+                                       ("cyclecloud_response_bytes", "response_bytes", "Response body size")]:
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} histogram".format(metric))
+            for name, stats in data["calls"].items():
+                histogram = stats[key]
+                if not histogram["count"]:
+                    continue
+                cumulative = 0
+                for bound, count in histogram["buckets"].items():
+                    cumulative += count
+                    lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(metric, _label(name), bound, cumulative))
+                lines.append('{}_sum{{endpoint="{}"}} {}'.format(metric, _label(name), histogram["sum"]))
+                lines.append('{}_count{{endpoint="{}"}} {}'.format(metric, _label(name), histogram["count"]))
+
+        for name, value in data["gauges"].items():
+            metric = "cyclecloud_" + name.replace(".", "_").replace("-", "_")
+            lines.append("# TYPE {} gauge".format(metric))
+            lines.append("{} {}".format(metric, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Writes Prometheus text for .prom/.txt paths, JSON otherwise"""
+        content = self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json()
+        with open(path, "w") as fw:
+            fw.write(content)
+
+
+REGISTRY = Registry()
+
+
+@contextlib.contextmanager
+def timed(name: str, registry: Registry = REGISTRY) -> typing.Iterator[None]:
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        registry.observe(name, time.perf_counter() - start, error=error)
+
+
+def serve(port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """Serves /metrics (Prometheus text) and /metrics.json on a background thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self) -> None:
+            if self.path.startswith("/metrics.json"):
+                body, content_type = registry.to_json().encode(), "application/json"
+            elif self.path.startswith("/metrics"):
+                body, content_type = registry.to_prometheus().encode(), "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_from_env(registry: Registry = REGISTRY) -> None:
+    """Honours CC_METRICS_OUT (export at exit) and CC_METRICS_PORT (live scraping)"""
+    out = os.environ.get("CC_METRICS_OUT")
+    if out:
+        atexit.register(registry.write, out)
+    port = os.environ.get("CC_METRICS_PORT")
+    if port:
+        serve(int(port), registry)
+        logging.getLogger().info("Serving metrics on port %s", port)
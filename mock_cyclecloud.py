@@ -0,0 +1,439 @@
+"""Local stand-in for the CycleCloud REST endpoints used by these scripts
+
+Serves, from memory, the endpoints used by demo.py, cleanup_failed_nodes.py and (through
+scalelib) spot_replacement.py and start_stop_nodes.py:
+
+    POST /cloud/api/import_cluster/{name}
+    POST /cloud/actions/{startcluster,terminatecluster,removecluster,retry,terminate_node}/{name}
+    GET  /cloud/clusters[/{name}]      GET /cloud/api/nodes[/{name}]
+    GET  /clusters/{name}/status       GET /clusters/{name}/nodes[?operation=|request_id=]
+    POST /clusters/{name}/nodes/{create,terminate,deallocate,start,shutdown,remove}
+
+Nodes move through Acquiring -> Preparing -> Ready (or Failed, for failure_rate of them) and
+Terminating -> Off on a clock that can be sped up with time_scale. Every request can be delayed
+by latency (+ jitter) and requests above throttle_rps are answered with 429.
+
+    python mock_cyclecloud.py --port 8080 --nodes 5000 --latency 0.02 --throttle-rps 200
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import typing
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import cluster_template
+
+
+DEFAULT_MACHINE_TYPES = {
+    "Standard_D2_v3": {"vcpuCount": 2, "memory": 8.0},
+    "Standard_D64S_v3": {"vcpuCount": 64, "memory": 256.0},
+    "Standard_F64S_v2": {"vcpuCount": 64, "memory": 128.0},
+    "Standard_F72S_v2": {"vcpuCount": 72, "memory": 144.0},
+}
+
+
+class MockCluster:
+
+    def __init__(self, name: str, nodearrays: typing.Dict[str, typing.Dict[str, typing.Any]]) -> None:
+        self.name = name
+        self.nodearrays = nodearrays
+        self.state = "Imported"
+        self.nodes: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        self.operations: typing.Dict[str, typing.List[str]] = {}
+        self.request_ids: typing.Dict[str, typing.List[str]] = {}
+        self.next_index: typing.Dict[str, int] = {}
+
+
+class MockCycleCloud:
+    """The simulated CycleCloud state, shared by all handler threads"""
+
+    def __init__(self, acquire_secs: float = 30, prepare_secs: float = 60, terminate_secs: float = 30,
+                 failure_rate: float = 0.0, time_scale: float = 1.0, max_count: int = 100000, seed: int = 0) -> None:
+        self.acquire_secs = acquire_secs
+        self.prepare_secs = prepare_secs
+        self.terminate_secs = terminate_secs
+        self.failure_rate = failure_rate
+        self.time_scale = time_scale
+        self.max_count = max_count
+        self.rng = random.Random(seed)
+        self.lock = threading.RLock()
+        self.clusters: typing.Dict[str, MockCluster] = {}
+
+    def now(self) -> float:
+        return time.monotonic() * self.time_scale
+
+    def add_cluster(self, name: str, nodearrays: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = None) -> MockCluster:
+        nodearrays = nodearrays or {
+            "execute": {"machine_types": list(DEFAULT_MACHINE_TYPES), "spot": False},
+            "execute-spot": {"machine_types": list(DEFAULT_MACHINE_TYPES), "spot": True},
+        }
+        with self.lock:
+            cluster = self.clusters.get(name)
+            if cluster is None:
+                cluster = self.clusters[name] = MockCluster(name, nodearrays)
+            else:
+                cluster.nodearrays = nodearrays
+            return cluster
+
+    def populate(self, cluster_name: str, count: int, nodearray: str = "execute", ready: bool = True) -> None:
+        """Adds count nodes that have already finished booting (or are still booting)"""
+        cluster = self.add_cluster(cluster_name)
+        with self.lock:
+            started = self.now() - (self.acquire_secs + self.prepare_secs if ready else 0)
+            for _ in range(count):
+                self._create_node(cluster, nodearray, None, started, None)
+
+    def _create_node(self, cluster: MockCluster, nodearray: str, vm_size: typing.Optional[str], started: float,
+                     operation_id: typing.Optional[str]) -> typing.Dict[str, typing.Any]:
+        definition = cluster.nodearrays.get(nodearray) or {"machine_types": list(DEFAULT_MACHINE_TYPES), "spot": False}
+        vm_size = vm_size or definition["machine_types"][0]
+        index = cluster.next_index.get(nodearray, 0) + 1
+        cluster.next_index[nodearray] = index
+        node_id = uuid.UUID(int=self.rng.getrandbits(128)).hex
+        node = {
+            "NodeId": node_id,
+            "Name": "{}-{}".format(nodearray, index),
+            "Template": nodearray,
+            "MachineType": vm_size,
+            "Region": definition.get("region", "westus2"),
+            "Interruptible": definition.get("spot", False),
+            "TargetState": "Started",
+            "Hostname": "ip-{:08X}".format(self.rng.getrandbits(32)),
+            "PrivateIp": "10.{}.{}.{}".format(self.rng.randint(0, 255), self.rng.randint(0, 255), self.rng.randint(1, 254)),
+            "CoreCount": DEFAULT_MACHINE_TYPES.get(vm_size, {"vcpuCount": 2})["vcpuCount"],
+            "Configuration": {},
+            "_started": started,
+            "_stopped": None,
+            "_fails": self.rng.random() < self.failure_rate,
+        }
+        cluster.nodes[node_id] = node
+        if operation_id:
+            cluster.operations.setdefault(operation_id, []).append(node_id)
+        return node
+
+    def status_of(self, node: typing.Dict[str, typing.Any]) -> str:
+        now = self.now()
+        if node["TargetState"] in ("Terminated", "Deallocated"):
+            if now - node["_stopped"] < self.terminate_secs:
+                return "Terminating" if node["TargetState"] == "Terminated" else "Deallocating"
+            return "Off" if node["TargetState"] == "Terminated" else "Deallocated"
+        age = now - node["_started"]
+        if age < self.acquire_secs:
+            return "Acquiring"
+        if age < self.acquire_secs + self.prepare_secs:
+            return "Preparing"
+        return "Failed" if node["_fails"] else "Ready"
+
+    def render(self, node: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        record = {k: v for k, v in node.items() if not k.startswith("_")}
+        record["Status"] = self.status_of(node)
+        record["State"] = record["Status"]
+        return record
+
+    def nodes(self, cluster: MockCluster, operation_id: typing.Optional[str] = None,
+              request_id: typing.Optional[str] = None) -> typing.List[typing.Dict[str, typing.Any]]:
+        with self.lock:
+            if operation_id:
+                node_ids = cluster.operations.get(operation_id, [])
+            elif request_id:
+                node_ids = cluster.request_ids.get(request_id, [])
+            else:
+                node_ids = list(cluster.nodes)
+            return [self.render(cluster.nodes[node_id]) for node_id in node_ids if node_id in cluster.nodes]
+
+    def create_nodes(self, cluster: MockCluster, body: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        operation_id = str(uuid.uuid4())
+        created = []
+        with self.lock:
+            request_id = body.get("requestId")
+            for create_set in body.get("sets", []):
+                nodearray = create_set.get("nodearray")
+                definition = create_set.get("definition") or {}
+                for _ in range(int(create_set.get("count", 0))):
+                    node = self._create_node(cluster, nodearray, definition.get("machineType"), self.now(), operation_id)
+                    created.append(node["NodeId"])
+            if request_id:
+                cluster.request_ids.setdefault(request_id, []).extend(created)
+        return {"operationId": operation_id, "sets": [{"added": len(created)}]}
+
+    def stop_nodes(self, cluster: MockCluster, node_ids: typing.Iterable[str], target_state: str) -> typing.Dict[str, typing.Any]:
+        operation_id = str(uuid.uuid4())
+        stopped = []
+        with self.lock:
+            for node_id in node_ids:
+                node = cluster.nodes.get(node_id)
+                if node is None or node["TargetState"] == target_state:
+                    continue
+                node["TargetState"] = target_state
+                node["_stopped"] = self.now()
+                stopped.append(node_id)
+            cluster.operations[operation_id] = stopped
+        if not stopped:
+            raise LookupError("No instances were found matching your query")
+        return {"operationId": operation_id, "nodes": [{"id": node_id, "status": "OK"} for node_id in stopped]}
+
+    def status(self, cluster: MockCluster) -> typing.Dict[str, typing.Any]:
+        with self.lock:
+            nodes = [self.render(node) for node in cluster.nodes.values()]
+            nodearrays = []
+            for name, definition in cluster.nodearrays.items():
+                buckets = []
+                for vm_size in definition["machine_types"]:
+                    machine = DEFAULT_MACHINE_TYPES.get(vm_size, {"vcpuCount": 2, "memory": 8.0})
+                    active = len([n for n in nodes if n["Template"] == name and n["MachineType"] == vm_size
+                                  and n["TargetState"] == "Started"])
+                    buckets.append({
+                        "bucketId": hashlib.md5("{}/{}".format(name, vm_size).encode()).hexdigest(),
+                        "definition": {"machineType": vm_size},
+                        "maxCount": self.max_count,
+                        "maxCoreCount": self.max_count * machine["vcpuCount"],
+                        "activeCount": active,
+                        "activeCoreCount": active * machine["vcpuCount"],
+                        "availableCount": self.max_count - active,
+                        "availableCoreCount": (self.max_count - active) * machine["vcpuCount"],
+                        "quotaCount": self.max_count,
+                        "quotaCoreCount": self.max_count * machine["vcpuCount"],
+                        "familyQuotaCount": self.max_count,
+                        "familyQuotaCoreCount": self.max_count * machine["vcpuCount"],
+                        "regionalQuotaCount": self.max_count,
+                        "regionalQuotaCoreCount": self.max_count * machine["vcpuCount"],
+                        "valid": True,
+                        "virtualMachine": {"vcpuCount": machine["vcpuCount"], "pcpuCount": machine["vcpuCount"],
+                                           "memory": machine["memory"], "gpuCount": 0, "infiniband": False},
+                    })
+                nodearrays.append({
+                    "name": name,
+                    "maxCount": self.max_count,
+                    "maxCoreCount": self.max_count * 72,
+                    "buckets": buckets,
+                    "nodearray": {"Name": name, "Interruptible": definition.get("spot", False),
+                                  "Region": definition.get("region", "westus2"),
+                                  "MachineType": definition["machine_types"], "Configuration": {}},
+                })
+            return {"state": cluster.state, "maxCount": self.max_count, "maxCoreCount": self.max_count * 72,
+                    "nodearrays": nodearrays, "nodes": nodes}
+
+
+def parse_nodearrays(template_text: str, parameters: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """The nodearrays of the imported template with their machine types, regions and spot setting"""
+    template = cluster_template.parse(template_text)
+    if not template.clusters:
+        return {}
+    cluster = template.cluster()
+    nodearrays: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+    for name, attributes in template.resolved(cluster.name, parameters).items():
+        if cluster.nodes[name].kind != "nodearray":
+            continue
+        machine_types = attributes.get("MachineType") or list(DEFAULT_MACHINE_TYPES)
+        if isinstance(machine_types, str):
+            machine_types = [m.strip() for m in machine_types.split(",") if m.strip()]
+        nodearrays[name] = {
+            "machine_types": machine_types,
+            "spot": str(attributes.get("Interruptible", "false")).lower() == "true",
+            "region": attributes.get("Region") or "westus2",
+        }
+    return nodearrays
+
+
+class _Throttle:
+
+    def __init__(self, rps: float) -> None:
+        self.rps = rps
+        self.tokens = rps
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if self.rps <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rps, self.tokens + (now - self.last) * self.rps)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def make_handler(cc: MockCycleCloud, latency: float = 0.0, jitter: float = 0.0, throttle_rps: float = 0.0):
+
+    throttle = _Throttle(throttle_rps)
+    stats = {"requests": 0, "throttled": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, payload: typing.Any = None, headers: typing.Optional[typing.Dict[str, str]] = None) -> None:
+            body = b"" if payload is None else (payload if isinstance(payload, bytes) else json.dumps(payload).encode())
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self) -> typing.Tuple[bytes, typing.Dict[str, typing.List[str]]]:
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            form = {}
+            if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                form = parse_qs(raw.decode())
+            return raw, form
+
+        def _handle(self, verb: str) -> None:
+            stats["requests"] += 1
+            if latency or jitter:
+                time.sleep(latency + random.random() * jitter)
+            if not throttle.allow():
+                stats["throttled"] += 1
+                self._body()
+                self._send(429, {"message": "Too many requests"}, {"Retry-After": "1"})
+                return
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            parts = [unquote(p) for p in url.path.strip("/").split("/")]
+            raw, form = self._body() if verb == "POST" else (b"", {})
+            try:
+                status, payload, headers = self._route(verb, parts, query, raw, form)
+            except KeyError as e:
+                status, payload, headers = 404, {"message": "Not found: {}".format(e)}, None
+            except LookupError as e:
+                status, payload, headers = 404, {"message": str(e)}, None
+            except Exception as e:
+                status, payload, headers = 500, {"message": "{}: {}".format(type(e).__name__, e)}, None
+            self._send(status, payload, headers)
+
+        def _cluster(self, name: str) -> MockCluster:
+            return cc.clusters[name]
+
+        def _route(self, verb, parts, query, raw, form):
+            if parts[:3] == ["cloud", "api", "import_cluster"] and verb == "POST":
+                parameters = json.loads(form.get("parameters", ["{}"])[0])
+                cc.add_cluster(parts[3], parse_nodearrays(form.get("cluster", [""])[0], parameters))
+                return 200, {"message": "Imported cluster {}".format(parts[3])}, None
+
+            if parts[:2] == ["cloud", "actions"] and verb == "POST":
+                action, name = parts[2], parts[3]
+                cluster = self._cluster(name)
+                if action == "startcluster":
+                    cluster.state = "Started"
+                elif action == "terminatecluster":
+                    started = [n for n, node in cluster.nodes.items() if node["TargetState"] == "Started"]
+                    if started:
+                        cc.stop_nodes(cluster, started, "Terminated")
+                    cluster.state = "Terminated"
+                elif action == "retry":
+                    with cc.lock:
+                        for node in cluster.nodes.values():
+                            if cc.status_of(node) == "Failed":
+                                node["_fails"], node["_started"] = False, cc.now()
+                elif action == "removecluster":
+                    with cc.lock:
+                        cc.clusters.pop(name)
+                elif action == "terminate_node":
+                    hostnames = set(re.findall(r'"([^"]+)"', query.get("instance-filter", "")))
+                    node_ids = [n for n, node in cluster.nodes.items() if node["Hostname"] in hostnames]
+                    return 200, cc.stop_nodes(cluster, node_ids, "Terminated"), None
+                return 200, {"message": "{} {}".format(action, name)}, None
+
+            if parts[:2] == ["cloud", "clusters"] and verb == "GET":
+                names = [parts[2]] if len(parts) > 2 else list(cc.clusters)
+                return 200, [{"ClusterName": n, "State": self._cluster(n).state,
+                              "Nodes": cc.nodes(self._cluster(n))} for n in names], None
+
+            if parts[:3] == ["cloud", "api", "nodes"] and verb == "GET":
+                clusters = [self._cluster(query["cluster"])] if "cluster" in query else list(cc.clusters.values())
+                nodes = [n for cluster in clusters for n in cc.nodes(cluster)]
+                if len(parts) > 3:
+                    nodes = [n for n in nodes if n["Name"] == parts[3]]
+                return 200, nodes, None
+
+            if parts[0] == "clusters" and len(parts) >= 3:
+                cluster = self._cluster(parts[1])
+                if parts[2] == "status" and verb == "GET":
+                    return 200, cc.status(cluster), None
+                if parts[2] == "nodes" and len(parts) == 3 and verb == "GET":
+                    nodes = cc.nodes(cluster, query.get("operation"), query.get("request_id"))
+                    etag = '"{}"'.format(hashlib.md5(json.dumps([(n["NodeId"], n["Status"]) for n in nodes]).encode()).hexdigest())
+                    if self.headers.get("If-None-Match") == etag:
+                        return 304, None, {"ETag": etag}
+                    payload = {"nodes": nodes}
+                    if query.get("operation"):
+                        payload["operation"] = {"id": query["operation"]}
+                    return 200, payload, {"ETag": etag}
+                if parts[2] == "nodes" and len(parts) == 4 and verb == "POST":
+                    body = json.loads(raw or b"{}")
+                    if parts[3] == "create":
+                        return 200, cc.create_nodes(cluster, body), None
+                    node_ids = body.get("ids") or [n for n, node in cluster.nodes.items() if node["Name"] in set(body.get("names", []))]
+                    if parts[3] in ("terminate", "remove"):
+                        return 200, cc.stop_nodes(cluster, node_ids, "Terminated"), None
+                    if parts[3] in ("deallocate", "shutdown"):
+                        return 200, cc.stop_nodes(cluster, node_ids, "Deallocated"), None
+                    if parts[3] == "start":
+                        with cc.lock:
+                            for node_id in node_ids:
+                                node = cluster.nodes[node_id]
+                                node["TargetState"], node["_started"], node["_stopped"] = "Started", cc.now(), None
+                        return 200, {"operationId": str(uuid.uuid4()), "nodes": [{"id": n} for n in node_ids]}, None
+
+            return 404, {"message": "Unsupported {} {}".format(verb, self.path)}, None
+
+        def do_GET(self) -> None:
+            self._handle("GET")
+
+        def do_POST(self) -> None:
+            self._handle("POST")
+
+    Handler.stats = stats
+    return Handler
+
+
+def serve(cc: MockCycleCloud, port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+          throttle_rps: float = 0.0) -> typing.Tuple[ThreadingHTTPServer, threading.Thread]:
+    """Starts the server on a background thread (port 0 picks a free port, see server.server_port)"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(cc, latency, jitter, throttle_rps))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, thread
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local mock CycleCloud REST server")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cluster", default="apiTest")
+    parser.add_argument("--nodes", type=int, default=0, help="Ready nodes to pre-populate")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many more seconds per request")
+    parser.add_argument("--throttle-rps", type=float, default=0.0, help="429 above this request rate (0 = off)")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Speed up node state transitions")
+    args = parser.parse_args()
+
+    cc = MockCycleCloud(failure_rate=args.failure_rate, time_scale=args.time_scale)
+    cc.add_cluster(args.cluster)
+    if args.nodes:
+        cc.populate(args.cluster, args.nodes)
+    server, thread = serve(cc, args.port, args.latency, args.jitter, args.throttle_rps)
+    print("Mock CycleCloud listening on http://127.0.0.1:{}".format(server.server_port), file=sys.stderr)
+    try:
+        thread.join()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
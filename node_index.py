@@ -0,0 +1,230 @@
+"""Index of a node manager's nodes by nodearray, vm_size, state and hostname
+
+deallocate_nodes used to scan node_mgr.get_nodes() for every nodearray it stopped. NodeIndex
+reads the node list once and keeps a set of node names per attribute value, so a selection is
+an intersection of small sets. It is kept current as nodes are allocated and deallocated through
+it, and supports compound selections for scale-down:
+
+    index = NodeIndex(node_mgr, idle=IdleTracker(DEFAULT_IDLE_FILE))
+    idle = index.select(nodearray="execute", states=["Ready"], idle=True, min_idle=30 * 60)
+    index.deallocate_nodes(idle)
+    index.idle.save()
+
+Idle means no jobs are assigned to the node. min_age is measured from the node's create time,
+min_idle from when the node last became idle: the later of the last time scalelib matched a job
+to it and the first time an IdleTracker saw it Ready and idle since it last was not. The tracker
+keeps those sightings in a JSON file between runs, so a node that is first seen idle now is not
+stopped for min_idle, however old it is.
+
+Job state has to come from demand data: jobs assigned to the nodes, or the last match times a
+scalelib node history records for a demand driven autoscaler (new_demand_calculator(...,
+node_history=...)). A bare new_node_manager() has neither and every node would look idle, so
+select(min_idle=...) raises NoDemandDataError when none of the nodes carries any.
+"""
+import json
+import os
+import tempfile
+import time
+import typing
+
+import metrics
+
+
+# States a node is given in the index once we ask CycleCloud to stop it
+DEALLOCATING_STATE = "Deallocating"
+
+DEFAULT_IDLE_FILE = os.environ.get("CC_IDLE_FILE",
+                                   os.path.join(os.path.expanduser("~"), ".cyclecloud-demo", "idle_since.json"))
+
+
+def _timestamp(node: typing.Any, attr: str) -> typing.Optional[float]:
+    """scalelib's attr_unix, or attr as a datetime, in seconds since the epoch"""
+    value = getattr(node, attr + "_unix", None)
+    if value:
+        return value
+    value = getattr(node, attr, None)
+    return value.timestamp() if hasattr(value, "timestamp") else None
+
+
+def _create_time(node: typing.Any) -> typing.Optional[float]:
+    return _timestamp(node, "create_time")
+
+
+def _is_idle(node: typing.Any) -> bool:
+    return not getattr(node, "assignments", None)
+
+
+class NoDemandDataError(ValueError):
+    pass
+
+
+def _has_demand_data(nodes: typing.Iterable[typing.Any]) -> bool:
+    return any(getattr(node, "assignments", None) or _timestamp(node, "last_match_time") for node in nodes)
+
+
+class IdleTracker:
+    """Node name -> when the node was first seen Ready and idle, since it last was not"""
+
+    def __init__(self, path: typing.Optional[str] = None, clock=time.time) -> None:
+        self.path = path
+        self.clock = clock
+        self.since: typing.Dict[str, float] = {}
+        if path:
+            try:
+                with open(path) as fr:
+                    self.since = json.load(fr)
+            except (OSError, ValueError):
+                self.since = {}
+
+    def update(self, nodes: typing.Iterable[typing.Any]) -> None:
+        now = self.clock()
+        names = set()
+        for node in nodes:
+            names.add(node.name)
+            if getattr(node, "state", None) == "Ready" and _is_idle(node):
+                self.since.setdefault(node.name, now)
+            else:
+                self.since.pop(node.name, None)
+        for name in list(self.since):
+            if name not in names:
+                del self.since[name]
+
+    def idle_since(self, node: typing.Any) -> typing.Optional[float]:
+        times = [t for t in (self.since.get(node.name), _timestamp(node, "last_match_time")) if t is not None]
+        return max(times) if times else None
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as fw:
+            json.dump(self.since, fw)
+        os.replace(fw.name, self.path)
+
+
+class NodeIndex:
+
+    def __init__(self, node_mgr: typing.Any, clock=time.time, idle: typing.Optional[IdleTracker] = None) -> None:
+        self.node_mgr = node_mgr
+        self.clock = clock
+        # without a tracker kept in a file, every node is first seen idle now
+        self.idle = idle or IdleTracker(clock=clock)
+        self.nodes: typing.Dict[str, typing.Any] = {}
+        # our view of each node's state, updated by deallocate_nodes before CycleCloud catches up
+        self.states: typing.Dict[str, typing.Optional[str]] = {}
+        self._by_nodearray: typing.Dict[str, typing.Set[str]] = {}
+        self._by_vm_size: typing.Dict[str, typing.Set[str]] = {}
+        self._by_state: typing.Dict[typing.Optional[str], typing.Set[str]] = {}
+        self._by_hostname: typing.Dict[str, str] = {}
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Rebuilds the index from node_mgr.get_nodes()"""
+        self.nodes.clear()
+        self.states.clear()
+        self._by_nodearray.clear()
+        self._by_vm_size.clear()
+        self._by_state.clear()
+        self._by_hostname.clear()
+        self.add(self.node_mgr.get_nodes())
+        self.idle.update(self.nodes.values())
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def add(self, nodes: typing.Iterable[typing.Any]) -> None:
+        for node in nodes:
+            if node.name in self.nodes:
+                self.remove([self.nodes[node.name]])
+            self.nodes[node.name] = node
+            self._by_nodearray.setdefault(node.nodearray, set()).add(node.name)
+            self._by_vm_size.setdefault(node.vm_size, set()).add(node.name)
+            self._set_state(node.name, getattr(node, "state", None))
+            hostname = getattr(node, "hostname", None)
+            if hostname:
+                self._by_hostname[hostname] = node.name
+
+    def remove(self, nodes: typing.Iterable[typing.Any]) -> None:
+        for node in nodes:
+            if self.nodes.pop(node.name, None) is None:
+                continue
+            self._by_nodearray.get(node.nodearray, set()).discard(node.name)
+            self._by_vm_size.get(node.vm_size, set()).discard(node.name)
+            self._by_state.get(self.states.pop(node.name, None), set()).discard(node.name)
+            hostname = getattr(node, "hostname", None)
+            if hostname and self._by_hostname.get(hostname) == node.name:
+                del self._by_hostname[hostname]
+
+    def _set_state(self, name: str, state: typing.Optional[str]) -> None:
+        if name in self.states:
+            self._by_state.get(self.states[name], set()).discard(name)
+        self.states[name] = state
+        self._by_state.setdefault(state, set()).add(name)
+
+    def set_state(self, nodes: typing.Iterable[typing.Any], state: str) -> None:
+        for node in nodes:
+            if node.name in self.nodes:
+                self._set_state(node.name, state)
+
+    def by_hostname(self, hostname: str) -> typing.Optional[typing.Any]:
+        name = self._by_hostname.get(hostname)
+        return self.nodes[name] if name else None
+
+    def select(self, nodearray: typing.Optional[str] = None,
+               vm_sizes: typing.Optional[typing.Iterable[str]] = None,
+               states: typing.Optional[typing.Iterable[str]] = None,
+               hostnames: typing.Optional[typing.Iterable[str]] = None,
+               idle: typing.Optional[bool] = None,
+               min_age: typing.Optional[float] = None,
+               min_idle: typing.Optional[float] = None) -> typing.List[typing.Any]:
+        """Nodes matching all of the given filters. min_age is in seconds since the node was created,
+        min_idle in seconds since it last became idle; nodes without a create time (or not known to
+        be idle) never match them."""
+        candidates = []
+        if nodearray is not None:
+            candidates.append(self._by_nodearray.get(nodearray, set()))
+        if vm_sizes is not None:
+            candidates.append(set().union(*[self._by_vm_size.get(v, set()) for v in vm_sizes]))
+        if states is not None:
+            candidates.append(set().union(*[self._by_state.get(s, set()) for s in states]))
+        if hostnames is not None:
+            candidates.append({self._by_hostname[h] for h in hostnames if h in self._by_hostname})
+
+        if candidates:
+            candidates.sort(key=len)
+            names = candidates[0].intersection(*candidates[1:])
+        else:
+            names = set(self.nodes)
+
+        selected = [self.nodes[name] for name in names]
+        if idle is not None:
+            selected = [node for node in selected if _is_idle(node) == idle]
+        if min_age is not None:
+            cutoff = self.clock() - min_age
+            selected = [node for node in selected
+                        if _create_time(node) is not None and _create_time(node) <= cutoff]
+        if min_idle is not None:
+            if not _has_demand_data(self.nodes.values()):
+                raise NoDemandDataError("No job assignments or last match times on any node, idle time is unknown. "
+                                        "Build the node manager from a demand calculator with a node history.")
+            cutoff = self.clock() - min_idle
+            selected = [node for node in selected
+                        if self.idle.idle_since(node) is not None and self.idle.idle_since(node) <= cutoff]
+        return sorted(selected, key=lambda node: node.name)
+
+    def allocate(self, *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        with metrics.timed("node_mgr.allocate"):
+            result = self.node_mgr.allocate(*args, **kwargs)
+        self.track_allocation(result)
+        return result
+
+    def track_allocation(self, result: typing.Any) -> None:
+        """Adds the nodes of an allocation result made elsewhere, e.g. through CapacityCache"""
+        self.add(getattr(result, "nodes", None) or [])
+
+    def deallocate_nodes(self, nodes: typing.List[typing.Any]) -> typing.Any:
+        with metrics.timed("node_mgr.deallocate_nodes"):
+            result = self.node_mgr.deallocate_nodes(nodes)
+        self.set_state(nodes, DEALLOCATING_STATE)
+        return result
@@ -0,0 +1,418 @@
+"""SQLite backed local copy of a cluster's nodes, queried offline like show_nodes
+
+show_nodes sends the filter expression and attribute list to CycleCloud and waits for a full
+dump on every query. NodeStore keeps the node records in an indexed SQLite table instead:
+
+  - sync() refreshes it with a conditional GET of /clusters/{name}/nodes (nothing is re-read
+    when the server answers 304) and only writes the records that changed;
+    sync_operation() refreshes just the nodes of one operation
+  - query() compiles the same filter expressions (Status == "Ready" && MachineType in {...},
+    =?=, =!=, =~ regex, !, ||, parentheses) to SQL over indexed columns, projects attrs and
+    pages with limit/offset, streaming rows from the cursor
+  - write_jsonl() and write_csv() stream query results without building the whole output
+
+    store = NodeStore("nodes.db")
+    store.sync(get_rest_client(CC_CONFIG), "demo")
+    write_csv(store.query("demo", 'Status == "Ready"', ["Name", "Hostname"]), ["Name", "Hostname"])
+
+    python node_store.py --db nodes.db --cluster demo --sync --filter 'Status != "Ready"' --format jsonl
+"""
+import argparse
+import csv
+import functools
+import itertools
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import typing
+
+
+# Record attributes stored in their own indexed columns (lower case name -> column)
+COLUMNS = {
+    "nodeid": "node_id",
+    "name": "name",
+    "hostname": "hostname",
+    "status": "status",
+    "template": "template",
+    "machinetype": "machine_type",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    cluster TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    name TEXT,
+    hostname TEXT,
+    status TEXT,
+    template TEXT,
+    machine_type TEXT,
+    record TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (cluster, node_id)
+);
+CREATE INDEX IF NOT EXISTS nodes_name ON nodes (cluster, name);
+CREATE INDEX IF NOT EXISTS nodes_hostname ON nodes (cluster, hostname COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS nodes_status ON nodes (cluster, status COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS nodes_template ON nodes (cluster, template COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS nodes_machine_type ON nodes (cluster, machine_type COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS sync_state (
+    cluster TEXT PRIMARY KEY,
+    etag TEXT,
+    last_sync REAL
+);
+"""
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*")
+      | (?P<number>-?\d+(?:\.\d+)?)
+      | (?P<op>=\?=|=!=|==|!=|<=|>=|=~|&&|\|\||[<>!(){},])
+      | (?P<ident>[A-Za-z_][A-Za-z0-9_.]*)
+    )""", re.VERBOSE)
+
+COMPARISONS = {"==": "= {} COLLATE NOCASE", "!=": "!= {} COLLATE NOCASE", "=?=": "IS {}", "=!=": "IS NOT {}",
+               "<": "< {}", "<=": "<= {}", ">": "> {}", ">=": ">= {}"}
+
+
+def _tokenize(expr: str) -> typing.List[typing.Tuple[str, typing.Any]]:
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = TOKEN_RE.match(expr, pos)
+        if not match or match.end() == pos:
+            raise FilterSyntaxError("Cannot parse filter at offset {}: {!r}".format(pos, expr[pos:pos + 20]))
+        pos = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "string":
+            tokens.append(("literal", json.loads(text)))
+        elif kind == "number":
+            tokens.append(("literal", float(text) if "." in text else int(text)))
+        elif kind == "ident" and text.lower() in ("true", "false"):
+            tokens.append(("literal", text.lower() == "true"))
+        elif kind == "ident" and text.lower() in ("undefined", "null"):
+            tokens.append(("literal", None))
+        elif kind == "ident" and text.lower() == "in":
+            tokens.append(("op", "in"))
+        else:
+            tokens.append((kind, text))
+    return tokens
+
+
+def _attribute_sql(name: str) -> str:
+    column = COLUMNS.get(name.lower())
+    if column:
+        return column
+    if not re.match(r"^[A-Za-z_][A-Za-z0-9_.]*$", name):
+        raise FilterSyntaxError("Invalid attribute name {!r}".format(name))
+    return "RECORD_ATTR(record, '{}')".format(name)
+
+
+@functools.lru_cache(maxsize=64)
+def _load_record(text: str) -> typing.Dict[str, typing.Any]:
+    # a filter usually reads several attributes of the same row in a row
+    return json.loads(text)
+
+
+def _record_attr(text: typing.Optional[str], path: str) -> typing.Any:
+    """json_extract(record, '$.' + path) with case insensitive attribute names, like _project"""
+    if text is None:
+        return None
+    value: typing.Any = _load_record(text)
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        if part not in value:
+            lowered = {key.lower(): key for key in value}
+            part = lowered.get(part.lower(), part)
+        value = value.get(part)
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+class _FilterCompiler:
+    """Recursive descent over the tokens, producing a SQL expression and its parameters"""
+
+    def __init__(self, expr: str) -> None:
+        self.tokens = _tokenize(expr)
+        self.pos = 0
+        self.params: typing.List[typing.Any] = []
+
+    def _peek(self) -> typing.Optional[typing.Tuple[str, typing.Any]]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _take(self, value: typing.Optional[str] = None) -> typing.Tuple[str, typing.Any]:
+        token = self._peek()
+        if token is None or (value is not None and token[1] != value):
+            raise FilterSyntaxError("Expected {} but found {}".format(value or "a value", token[1] if token else "the end"))
+        self.pos += 1
+        return token
+
+    def compile(self) -> typing.Tuple[str, typing.List[typing.Any]]:
+        sql = self._or()
+        if self._peek() is not None:
+            raise FilterSyntaxError("Unexpected {!r}".format(self._peek()[1]))
+        return sql, self.params
+
+    def _or(self) -> str:
+        parts = [self._and()]
+        while self._peek() == ("op", "||"):
+            self._take()
+            parts.append(self._and())
+        return parts[0] if len(parts) == 1 else "(" + " OR ".join(parts) + ")"
+
+    def _and(self) -> str:
+        parts = [self._not()]
+        while self._peek() == ("op", "&&"):
+            self._take()
+            parts.append(self._not())
+        return parts[0] if len(parts) == 1 else "(" + " AND ".join(parts) + ")"
+
+    def _not(self) -> str:
+        if self._peek() == ("op", "!"):
+            self._take()
+            return "(NOT " + self._not() + ")"
+        return self._comparison()
+
+    def _operand(self) -> str:
+        kind, value = self._take()
+        if kind == "ident":
+            return _attribute_sql(value)
+        if kind == "literal":
+            self.params.append(int(value) if isinstance(value, bool) else value)
+            return "?"
+        if value == "(":
+            sql = self._or()
+            self._take(")")
+            return sql
+        raise FilterSyntaxError("Unexpected {!r}".format(value))
+
+    def _comparison(self) -> str:
+        left = self._operand()
+        token = self._peek()
+        if token is None or token[0] != "op":
+            return left
+        op = token[1]
+        if op in COMPARISONS:
+            self._take()
+            return "({} {})".format(left, COMPARISONS[op].format(self._operand()))
+        if op == "=~":
+            self._take()
+            return "({} REGEXP {})".format(left, self._operand())
+        if op == "in":
+            self._take()
+            self._take("{")
+            values = [self._operand()]
+            while self._peek() == ("op", ","):
+                self._take()
+                values.append(self._operand())
+            self._take("}")
+            return "({} COLLATE NOCASE IN ({}))".format(left, ", ".join(values))
+        return left
+
+
+def compile_filter(expr: typing.Optional[str]) -> typing.Tuple[str, typing.List[typing.Any]]:
+    """CycleCloud filter expression -> (SQL expression, parameters)"""
+    if not expr or not expr.strip():
+        return "1", []
+    return _FilterCompiler(expr).compile()
+
+
+def _regexp(pattern: typing.Optional[str], value: typing.Any) -> bool:
+    return value is not None and pattern is not None and re.search(pattern, str(value)) is not None
+
+
+def _project(record: typing.Dict[str, typing.Any], attrs: typing.Sequence[str]) -> typing.Dict[str, typing.Any]:
+    # attribute names are case insensitive, like on the server
+    lowered = {key.lower(): key for key in record}
+    return {attr: record.get(lowered.get(attr.lower(), attr)) for attr in attrs}
+
+
+class NodeStore:
+
+    def __init__(self, path: str = ":memory:", clock=time.time) -> None:
+        self.path = path
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.create_function("REGEXP", 2, _regexp, deterministic=True)
+        self.db.create_function("RECORD_ATTR", 2, _record_attr, deterministic=True)
+        if path != ":memory:":
+            # dashboards read while a sync writes
+            self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _etag(self, cluster_name: str) -> typing.Optional[str]:
+        row = self.db.execute("SELECT etag FROM sync_state WHERE cluster = ?", (cluster_name,)).fetchone()
+        return row[0] if row else None
+
+    def _upsert(self, cluster_name: str, records: typing.Iterable[typing.Dict], now: float,
+                existing: typing.Dict[str, str]) -> typing.Tuple[typing.Set[str], int]:
+        seen = set()
+        rows = []
+        for record in records:
+            node_id = record.get("NodeId")
+            if not node_id:
+                continue
+            seen.add(node_id)
+            text = json.dumps(record, sort_keys=True)
+            if existing.get(node_id) == text:
+                continue
+            rows.append((cluster_name, node_id, record.get("Name"), record.get("Hostname"), record.get("Status"),
+                         record.get("Template"), record.get("MachineType"), text, now))
+        self.db.executemany("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return seen, len(rows)
+
+    def sync(self, rest_client, cluster_name: str, force_full: bool = False) -> typing.Dict[str, int]:
+        """Conditional full refresh. Returns counts of written and deleted records."""
+        with self.lock:
+            etag = None if force_full else self._etag(cluster_name)
+            new_etag, records = rest_client.poll_cluster_nodes(cluster_name, etag=etag)
+            now = self.clock()
+            if records is None:
+                self.db.execute("UPDATE sync_state SET last_sync = ? WHERE cluster = ?", (now, cluster_name))
+                self.db.commit()
+                return {"written": 0, "deleted": 0, "not_modified": 1}
+
+            existing = dict(self.db.execute("SELECT node_id, record FROM nodes WHERE cluster = ?", (cluster_name,)))
+            seen, written = self._upsert(cluster_name, records, now, existing)
+            removed = [(cluster_name, node_id) for node_id in existing if node_id not in seen]
+            self.db.executemany("DELETE FROM nodes WHERE cluster = ? AND node_id = ?", removed)
+            self.db.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)", (cluster_name, new_etag, now))
+            self.db.commit()
+            return {"written": written, "deleted": len(removed), "not_modified": 0}
+
+    def sync_operation(self, rest_client, cluster_name: str, operation_id: str) -> typing.Dict[str, int]:
+        """Refreshes only the nodes of one operation, e.g. right after a bootup or terminate"""
+        with self.lock:
+            _, records = rest_client.poll_cluster_nodes(cluster_name, params={"operation": operation_id})
+            records = records or []
+            ids = [r.get("NodeId") for r in records]
+            existing: typing.Dict[str, str] = {}
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i + 500]
+                existing.update(self.db.execute(
+                    "SELECT node_id, record FROM nodes WHERE cluster = ? AND node_id IN ({})".format(",".join("?" * len(batch))),
+                    [cluster_name] + batch))
+            _, written = self._upsert(cluster_name, records, self.clock(), existing)
+            # the listing changed under our etag
+            self.db.execute("UPDATE sync_state SET etag = NULL WHERE cluster = ?", (cluster_name,))
+            self.db.commit()
+            return {"written": written, "deleted": 0, "not_modified": 0}
+
+    def count(self, cluster_name: typing.Optional[str] = None, filter_expr: typing.Optional[str] = None) -> int:
+        where, params = self._where(cluster_name, filter_expr)
+        return self.db.execute("SELECT COUNT(*) FROM nodes WHERE " + where, params).fetchone()[0]
+
+    def _where(self, cluster_name: typing.Optional[str], filter_expr: typing.Optional[str]) -> typing.Tuple[str, typing.List[typing.Any]]:
+        where, params = compile_filter(filter_expr)
+        if cluster_name:
+            where = "cluster = ? AND " + where
+            params = [cluster_name] + params
+        return where, params
+
+    def query(self, cluster_name: typing.Optional[str] = None, filter_expr: typing.Optional[str] = None,
+              attrs: typing.Optional[typing.Sequence[str]] = None, limit: typing.Optional[int] = None,
+              offset: int = 0, order_by: str = "Name", fetch_size: int = 500) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        """Yields matching records (projected onto attrs) ordered by order_by, one page of
+        limit rows starting at offset. Rows are fetched from the cursor fetch_size at a time."""
+        where, params = self._where(cluster_name, filter_expr)
+        sql = "SELECT record FROM nodes WHERE {} ORDER BY {}, node_id".format(where, _attribute_sql(order_by))
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params = params + [-1 if limit is None else limit, offset]
+        cursor = self.db.execute(sql, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    return
+                for (text,) in rows:
+                    record = json.loads(text)
+                    yield _project(record, attrs) if attrs else record
+        finally:
+            cursor.close()
+
+
+def parse_attrs(attrs_select: typing.Optional[str]) -> typing.Optional[typing.List[str]]:
+    """show_nodes style "Name,Status" -> ["Name", "Status"]"""
+    if not attrs_select:
+        return None
+    return [attr.strip() for attr in attrs_select.split(",") if attr.strip()]
+
+
+def write_jsonl(rows: typing.Iterable[typing.Dict[str, typing.Any]], out: typing.TextIO = sys.stdout) -> int:
+    count = 0
+    for row in rows:
+        out.write(json.dumps(row) + "\n")
+        count += 1
+    return count
+
+
+def write_csv(rows: typing.Iterable[typing.Dict[str, typing.Any]], attrs: typing.Optional[typing.Sequence[str]] = None,
+              out: typing.TextIO = sys.stdout) -> int:
+    """Without attrs the columns are those of the first row"""
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return 0
+    writer = csv.DictWriter(out, fieldnames=list(attrs or first.keys()), extrasaction="ignore")
+    writer.writeheader()
+    count = 0
+    for row in itertools.chain([first], rows):
+        writer.writerow({k: (json.dumps(v) if isinstance(v, (dict, list)) else v) for k, v in row.items()})
+        count += 1
+    return count
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Query a local copy of a cluster's nodes")
+    parser.add_argument("--db", default="nodes.db", help="SQLite file")
+    parser.add_argument("--cluster", required=True)
+    parser.add_argument("--sync", action="store_true", help="Refresh from CycleCloud first (CC_URL, CC_USERNAME, CC_PASSWORD)")
+    parser.add_argument("--filter", default=None, help='Filter expression, e.g. Status == "Ready"')
+    parser.add_argument("--attrs", default=None, help="Comma separated attributes")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--offset", type=int, default=0)
+    parser.add_argument("--order-by", default="Name")
+    args = parser.parse_args(argv)
+
+    if args.db != ":memory:":
+        os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    store = NodeStore(args.db)
+    if args.sync:
+        from ccrest import get_rest_client
+
+        config = {"url": os.environ["CC_URL"], "username": os.environ["CC_USERNAME"],
+                  "password": os.environ["CC_PASSWORD"], "verify_certificates": False}
+        print("sync: {}".format(store.sync(get_rest_client(config), args.cluster)), file=sys.stderr)
+
+    attrs = parse_attrs(args.attrs)
+    start = time.perf_counter()
+    rows = store.query(args.cluster, args.filter, attrs, limit=args.limit, offset=args.offset, order_by=args.order_by)
+    if args.format == "csv":
+        count = write_csv(rows, attrs)
+    else:
+        count = write_jsonl(rows)
+    print("{} nodes in {:.1f} ms".format(count, (time.perf_counter() - start) * 1000), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""Runs the demo.py cluster lifecycle for many clusters concurrently
+
+test_api_cluster_management walks one cluster through import, start, modify, add nodearray,
+add nodes, terminate and delete one blocking step at a time. Pipeline runs the same stages for
+N clusters on an asyncio event loop:
+
+  - stages form a dependency graph inside each cluster: a stage starts once the stages it comes
+    after have finished, and is skipped if a stage it requires failed (so a cluster whose nodes
+    failed to start is still terminated and deleted, but one that never imported is not)
+  - each stage has its own concurrency limit across clusters (e.g. at most 4 imports and 2
+    node manager bootups at a time), on top of the REST client's rate limiter
+  - the blocking demo.py helpers run on a thread pool, the event loop only schedules them
+
+At the end a report gives per-stage timings (time queued for a slot and time running) and the
+critical path: the chain of stages that determined when the last cluster finished.
+
+    python orchestrate.py --clusters 10 --prefix campaign --limit import=4 --limit add_nodes=2
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import getpass
+import json
+import logging
+import os
+import time
+import typing
+
+import metrics
+from bootup_tracker import percentile
+
+
+class Stage:
+
+    def __init__(self, name: str, fn: typing.Callable[[str, typing.Dict[str, typing.Any]], typing.Any],
+                 after: typing.Sequence[str] = (), requires: typing.Optional[typing.Sequence[str]] = None) -> None:
+        self.name = name
+        # fn(cluster_name, context) runs on a worker thread; context is shared by the cluster's stages
+        self.fn = fn
+        self.after = list(after)
+        # stages that must have succeeded, by default all of after
+        self.requires = list(after if requires is None else requires)
+
+
+class StageRun:
+
+    def __init__(self, cluster_name: str, stage: str) -> None:
+        self.cluster_name = cluster_name
+        self.stage = stage
+        # "ok", "failed" or "skipped"
+        self.outcome: typing.Optional[str] = None
+        self.error: typing.Optional[str] = None
+        self.ready = 0.0
+        self.started = 0.0
+        self.finished = 0.0
+
+    @property
+    def queued(self) -> float:
+        return self.started - self.ready
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {"cluster": self.cluster_name, "stage": self.stage, "outcome": self.outcome, "error": self.error,
+                "ready": round(self.ready, 3), "started": round(self.started, 3), "finished": round(self.finished, 3)}
+
+
+class PipelineReport:
+
+    def __init__(self, stages: typing.List[Stage], runs: typing.Dict[str, typing.Dict[str, StageRun]], elapsed: float) -> None:
+        self.stages = stages
+        self.runs = runs
+        self.elapsed = elapsed
+
+    def critical_path(self) -> typing.List[StageRun]:
+        """From the stage that finished last, walk back through the dependency that finished last"""
+        by_name = {stage.name: stage for stage in self.stages}
+        finished = [run for cluster_runs in self.runs.values() for run in cluster_runs.values() if run.outcome != "skipped"]
+        if not finished:
+            return []
+        current = max(finished, key=lambda run: run.finished)
+        path = [current]
+        while True:
+            cluster_runs = self.runs[current.cluster_name]
+            deps = [cluster_runs[name] for name in by_name[current.stage].after if cluster_runs[name].outcome != "skipped"]
+            if not deps:
+                break
+            current = max(deps, key=lambda run: run.finished)
+            path.append(current)
+        return list(reversed(path))
+
+    def stage_stats(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        stats = {}
+        for stage in self.stages:
+            runs = [cluster_runs[stage.name] for cluster_runs in self.runs.values()]
+            ran = [run for run in runs if run.outcome in ("ok", "failed")]
+            durations = [run.duration for run in ran] or [0.0]
+            queued = [run.queued for run in ran] or [0.0]
+            stats[stage.name] = {
+                "ok": len([run for run in runs if run.outcome == "ok"]),
+                "failed": len([run for run in runs if run.outcome == "failed"]),
+                "skipped": len([run for run in runs if run.outcome == "skipped"]),
+                "p50": percentile(durations, 50),
+                "p95": percentile(durations, 95),
+                "max": max(durations),
+                "queued_max": max(queued),
+            }
+        return stats
+
+    def print(self) -> None:
+        print("{} clusters in {:.1f}s".format(len(self.runs), self.elapsed))
+        print("{:20} {:>4} {:>6} {:>7} {:>8} {:>8} {:>8} {:>10}".format(
+            "stage", "ok", "failed", "skipped", "p50", "p95", "max", "queued max"))
+        for name, stats in self.stage_stats().items():
+            print("{:20} {:4} {:6} {:7} {:7.1f}s {:7.1f}s {:7.1f}s {:9.1f}s".format(
+                name, stats["ok"], stats["failed"], stats["skipped"], stats["p50"], stats["p95"], stats["max"],
+                stats["queued_max"]))
+        print("Critical path:")
+        for run in self.critical_path():
+            print("  {:24} {:20} {:8} queued {:6.1f}s  ran {:6.1f}s  done at {:7.1f}s".format(
+                run.cluster_name, run.stage, run.outcome, run.queued, run.duration, run.finished))
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "elapsed": self.elapsed,
+            "stages": self.stage_stats(),
+            "critical_path": [run.to_dict() for run in self.critical_path()],
+            "runs": [run.to_dict() for cluster_runs in self.runs.values() for run in cluster_runs.values()],
+        }
+
+
+class Pipeline:
+
+    def __init__(self, stages: typing.List[Stage], limits: typing.Optional[typing.Dict[str, int]] = None,
+                 default_limit: int = 8, logger=None) -> None:
+        names = [stage.name for stage in stages]
+        for stage in stages:
+            unknown = [dep for dep in stage.after + stage.requires if dep not in names[:names.index(stage.name)]]
+            if unknown:
+                raise ValueError("Stage {} depends on {}, which must be defined before it".format(stage.name, unknown))
+        self.stages = stages
+        self.limits = {stage.name: (limits or {}).get(stage.name, default_limit) for stage in stages}
+        self.logger = logger or logging.getLogger()
+
+    async def _run_stage(self, stage: Stage, cluster_name: str, context: typing.Dict[str, typing.Any],
+                         runs: typing.Dict[str, StageRun], tasks: typing.Dict[str, "asyncio.Task"],
+                         semaphore: asyncio.Semaphore, executor: concurrent.futures.Executor, start: float) -> None:
+        run = runs[stage.name]
+        if stage.after:
+            await asyncio.gather(*[tasks[name] for name in stage.after])
+        run.ready = time.monotonic() - start
+        failed_requirements = [name for name in stage.requires if runs[name].outcome != "ok"]
+        if failed_requirements:
+            run.outcome = "skipped"
+            run.error = "requires {}".format(", ".join(failed_requirements))
+            run.started = run.finished = run.ready
+            return
+
+        async with semaphore:
+            run.started = time.monotonic() - start
+            self.logger.info("%s: %s", cluster_name, stage.name)
+            try:
+                with metrics.timed("lifecycle." + stage.name):
+                    await asyncio.get_running_loop().run_in_executor(executor, stage.fn, cluster_name, context)
+                run.outcome = "ok"
+            except Exception as e:
+                self.logger.exception("%s: %s failed", cluster_name, stage.name)
+                run.outcome = "failed"
+                run.error = str(e)
+            run.finished = time.monotonic() - start
+
+    async def run_async(self, cluster_names: typing.Sequence[str],
+                        contexts: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = None) -> PipelineReport:
+        semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.limits.items()}
+        all_runs: typing.Dict[str, typing.Dict[str, StageRun]] = {}
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, sum(self.limits.values()))) as executor:
+            pending = []
+            for cluster_name in cluster_names:
+                context = (contexts or {}).get(cluster_name, {})
+                runs = all_runs[cluster_name] = {stage.name: StageRun(cluster_name, stage.name) for stage in self.stages}
+                tasks: typing.Dict[str, asyncio.Task] = {}
+                # stages are in dependency order, so every dependency's task exists already
+                for stage in self.stages:
+                    tasks[stage.name] = asyncio.ensure_future(self._run_stage(
+                        stage, cluster_name, context, runs, tasks, semaphores[stage.name], executor, start))
+                pending.extend(tasks.values())
+            await asyncio.gather(*pending)
+        return PipelineReport(self.stages, all_runs, time.monotonic() - start)
+
+    def run(self, cluster_names: typing.Sequence[str],
+            contexts: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = None) -> PipelineReport:
+        return asyncio.run(self.run_async(cluster_names, contexts))
+
+
+def lifecycle_stages(client, sku: str = "Standard_D2_v3", node_count: int = 1, hold: float = 0) -> typing.List[Stage]:
+    """The test_api_cluster_management steps as a dependency chain"""
+    import demo
+
+    def _check(response) -> None:
+        # 304 is a skipped no-op import or start
+        if not (200 <= response.status_code < 300 or response.status_code == 304):
+            raise RuntimeError("{} : {}".format(response.status_code, response.text))
+
+    def _import(template_file: str, extra: typing.Dict[str, typing.Any]):
+        def _stage(cluster_name, context):
+            params = context.setdefault("params", dict(demo.BASE_CLUSTER_PARAMS))
+            params.update(extra)
+            _check(demo.import_cluster(client, cluster_name, template_file, params, template_cluster_name="simple"))
+        return _stage
+
+    def _start(cluster_name, context):
+        _check(demo.start_cluster(client, cluster_name))
+
+    def _add_nodes(cluster_name, context):
+        demo.add_nodes(cluster_name, sku=sku, count=node_count)
+        if hold:
+            time.sleep(hold)
+
+    def _terminate(cluster_name, context):
+        _check(demo.terminate_cluster(client, cluster_name))
+
+    def _wait(cluster_name, context):
+        demo.wait_for_cluster_termination(client, cluster_name)
+
+    def _delete(cluster_name, context):
+        _check(demo.delete_cluster(client, cluster_name))
+
+    return [
+        Stage("import", _import("./simple.txt", {})),
+        Stage("start", _start, after=["import"]),
+        Stage("modify", _import("./simple.txt", {"AzccMachineTypes": ["Standard_D2_v3", "Standard_D64S_v3",
+                                                                       "Standard_F64S_v2", "Standard_F72S_v2"]}),
+              after=["start"]),
+        Stage("add_nodearray", _import("./simple_3nodearrays.txt", {"SubnetId2": demo.BASE_CLUSTER_PARAMS["SubnetId"],
+                                                                    "Region2": demo.BASE_CLUSTER_PARAMS["Region"]}),
+              after=["modify"]),
+        # a new nodearray has to be activated by starting the cluster again
+        Stage("activate", _start, after=["add_nodearray"]),
+        Stage("add_nodes", _add_nodes, after=["activate"]),
+        # clean up whatever was created, even if a later stage failed
+        Stage("terminate", _terminate, after=["add_nodes"], requires=["import"]),
+        Stage("wait_terminated", _wait, after=["terminate"]),
+        Stage("delete", _delete, after=["wait_terminated"], requires=["import"]),
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the demo cluster lifecycle for many clusters at once")
+    parser.add_argument("--clusters", type=int, default=2, help="Number of clusters")
+    parser.add_argument("--prefix", default="apiTest", help="Cluster names are PREFIX-0, PREFIX-1, ...")
+    parser.add_argument("--limit", action="append", default=[], help="STAGE=N concurrency limit, repeatable")
+    parser.add_argument("--default-limit", type=int, default=8)
+    parser.add_argument("--sku", default="Standard_D2_v3")
+    parser.add_argument("--count", type=int, default=1, help="Nodes to add to each cluster")
+    parser.add_argument("--hold", type=float, default=0, help="Seconds to keep the nodes up before terminating")
+    parser.add_argument("--report", default=None, help="Write the timing report as JSON to this file")
+    args = parser.parse_args()
+
+    import demo
+    from cyclecloud.client import Client
+
+    demo.CC_CONFIG["url"] = os.environ.get("CC_URL") or input("CycleCloud URL: ({})".format(demo.CC_CONFIG["url"])) or demo.CC_CONFIG["url"]
+    demo.CC_CONFIG["username"] = os.environ.get("CC_USERNAME") or input("username: ({})".format(demo.CC_CONFIG["username"])) or demo.CC_CONFIG["username"]
+    demo.CC_CONFIG["password"] = os.environ.get("CC_PASSWORD") or getpass.getpass("password: ")
+    metrics.configure_from_env()
+
+    limits = {}
+    for limit in args.limit:
+        stage, _, value = limit.partition("=")
+        limits[stage] = int(value)
+
+    client = Client(demo.CC_CONFIG)
+    pipeline = Pipeline(lifecycle_stages(client, sku=args.sku, node_count=args.count, hold=args.hold), limits,
+                        default_limit=args.default_limit)
+    names = ["{}-{}".format(args.prefix, i) for i in range(args.clusters)]
+    report = pipeline.run(names, {name: {"params": dict(demo.BASE_CLUSTER_PARAMS)} for name in names})
+    report.print()
+    if args.report:
+        with open(args.report, "w") as fw:
+            json.dump(report.to_dict(), fw, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -134,6 +134,23 @@ def execute() -> None:
     _add("simple.txt", mode=os.stat("simple.txt")[0])
     _add("simple_3nodearrays.txt", mode=os.stat("simple_3nodearrays.txt")[0])
     _add("demo.py", mode=os.stat("demo.py")[0])
+    _add("cccli.py", mode=os.stat("cccli.py")[0])
+    _add("bootup_tracker.py", mode=os.stat("bootup_tracker.py")[0])
+    _add("capacity.py", mode=os.stat("capacity.py")[0])
+    _add("ccrest.py", mode=os.stat("ccrest.py")[0])
+    _add("cluster_template.py", mode=os.stat("cluster_template.py")[0])
+    _add("import_state.py", mode=os.stat("import_state.py")[0])
+    _add("inventory.py", mode=os.stat("inventory.py")[0])
+    _add("metrics.py", mode=os.stat("metrics.py")[0])
+    _add("node_index.py", mode=os.stat("node_index.py")[0])
+    _add("node_store.py", mode=os.stat("node_store.py")[0])
+    _add("orchestrate.py", mode=os.stat("orchestrate.py")[0])
+    _add("ratelimit.py", mode=os.stat("ratelimit.py")[0])
+    _add("reaper.py", mode=os.stat("reaper.py")[0])
+    _add("retry_policy.py", mode=os.stat("retry_policy.py")[0])
+    _add("sku_scoring.py", mode=os.stat("sku_scoring.py")[0])
+    _add("snapshot.py", mode=os.stat("snapshot.py")[0])
+    _add("waiters.py", mode=os.stat("waiters.py")[0])
     _add("scale_up.py", mode=os.stat("scale_up.py")[0])
     _add("spot_replacement.py", mode=os.stat("spot_replacement.py")[0])
     _add("start_stop_nodes.py", mode=os.stat("start_stop_nodes.py")[0])
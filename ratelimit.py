@@ -0,0 +1,162 @@
+"""Client side rate limiting and adaptive concurrency for CycleCloud REST calls
+
+Every RestClient request takes a token from a TokenBucket (a steady request rate with some
+burst) and a slot from an AdaptiveConcurrency limit. The concurrency limit follows AIMD:
+
+  - 429 and 5xx responses (and connection errors) halve it, at most once per cooldown, and a
+    Retry-After header pauses the token bucket for that long
+  - responses faster than target_latency grow it by one slot per limit's worth of requests
+  - slow but successful responses leave it unchanged
+
+so concurrent tools back off together when the server is throttling and recover while it is
+healthy. The limits are exported as metrics gauges (rest_rate_limit, rest_concurrency_limit,
+rest_inflight, rest_throttled).
+
+The limiter is shared by every helper in one process. Tools running side by side each have
+their own: set CC_RATE_LIMIT and CC_MAX_CONCURRENCY (or rate_limit / max_concurrency in
+CC_CONFIG) to split the server's budget between them.
+"""
+import os
+import threading
+import time
+import typing
+
+import metrics
+
+
+DEFAULT_RATE_LIMIT = 20.0
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_TARGET_LATENCY = 2.0
+
+
+def is_throttled(status_code: typing.Optional[int]) -> bool:
+    """None means the request failed without a response"""
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+def parse_retry_after(value: typing.Optional[str]) -> typing.Optional[float]:
+    # CycleCloud sends delta seconds, the HTTP date form is ignored
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: typing.Optional[float] = None,
+                 clock=time.monotonic, sleep=time.sleep) -> None:
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Takes a token, possibly going into debt, and returns how long the caller must wait"""
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def acquire(self) -> float:
+        """Blocks until a request may be sent, returns the time waited"""
+        if self.rate <= 0:
+            return 0.0
+        wait = self._reserve()
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+
+class AdaptiveConcurrency:
+
+    def __init__(self, max_limit: int = DEFAULT_MAX_CONCURRENCY, min_limit: int = 1,
+                 initial_limit: typing.Optional[float] = None, target_latency: float = DEFAULT_TARGET_LATENCY,
+                 decrease_factor: float = 0.5, cooldown: typing.Optional[float] = None,
+                 clock=time.monotonic) -> None:
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit if initial_limit is not None else max(min_limit, max_limit // 2))
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        # one throttled burst should only halve the limit once
+        self.cooldown = cooldown if cooldown is not None else target_latency
+        self.clock = clock
+        self.inflight = 0
+        self.throttled = 0
+        self.last_decrease = float("-inf")
+        self.condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.inflight >= int(self.limit):
+                self.condition.wait()
+            self.inflight += 1
+
+    def cancel(self) -> None:
+        """Gives the slot back without a response to learn from"""
+        with self.condition:
+            self.inflight -= 1
+            self.condition.notify_all()
+
+    def release(self, status_code: typing.Optional[int], latency: float) -> None:
+        with self.condition:
+            self.inflight -= 1
+            if is_throttled(status_code):
+                self.throttled += 1
+                now = self.clock()
+                if now - self.last_decrease >= self.cooldown:
+                    self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                    self.last_decrease = now
+            elif latency <= self.target_latency:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+class RateLimiter:
+    """TokenBucket + AdaptiveConcurrency, as used by RestClient.request"""
+
+    def __init__(self, rate: float = DEFAULT_RATE_LIMIT, burst: typing.Optional[float] = None,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY, target_latency: float = DEFAULT_TARGET_LATENCY,
+                 clock=time.monotonic, sleep=time.sleep) -> None:
+        self.bucket = TokenBucket(rate, burst, clock=clock, sleep=sleep)
+        self.concurrency = AdaptiveConcurrency(max_concurrency, target_latency=target_latency, clock=clock)
+
+    @classmethod
+    def from_config(cls, config: typing.Dict[str, typing.Any], max_concurrency: int = DEFAULT_MAX_CONCURRENCY) -> "RateLimiter":
+        rate = config.get("rate_limit", os.environ.get("CC_RATE_LIMIT", DEFAULT_RATE_LIMIT))
+        max_concurrency = config.get("max_concurrency", os.environ.get("CC_MAX_CONCURRENCY", max_concurrency))
+        target_latency = config.get("target_latency", os.environ.get("CC_TARGET_LATENCY", DEFAULT_TARGET_LATENCY))
+        return cls(float(rate), max_concurrency=int(max_concurrency), target_latency=float(target_latency))
+
+    def acquire(self) -> float:
+        """Blocks until the request may be sent. Returns the time spent waiting on the rate limit."""
+        self.concurrency.acquire()
+        try:
+            return self.bucket.acquire()
+        except BaseException:
+            self.concurrency.cancel()
+            raise
+
+    def release(self, status_code: typing.Optional[int], latency: float, retry_after: typing.Optional[float] = None) -> None:
+        if status_code == 429 and retry_after:
+            self.bucket.pause(retry_after)
+        self.concurrency.release(status_code, latency)
+        self.publish()
+
+    def publish(self, registry: metrics.Registry = metrics.REGISTRY) -> None:
+        registry.gauge("rest_rate_limit", self.bucket.rate)
+        registry.gauge("rest_concurrency_limit", int(self.concurrency.limit))
+        registry.gauge("rest_inflight", self.concurrency.inflight)
+        registry.gauge("rest_throttled", self.concurrency.throttled)
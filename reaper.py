@@ -0,0 +1,205 @@
+"""Unattended reaping of Failed and Unavailable nodes
+
+terminate_failed_nodes waits for someone to press enter, so spot nodes that failed overnight
+stay up and billable. FailedNodeReaper runs the same cleanup continuously without a prompt:
+
+  - a NodeInventory detects which nodes changed since the last cycle and when each node was
+    first seen in a failure state
+  - policy thresholds decide what may be terminated this cycle: a minimum time in the failure
+    state (nodes recovering from a transient Unavailable are left alone), a maximum number of
+    terminations per cycle and a per-nodearray blast radius cap
+  - nodes are terminated by NodeId, in batches
+  - every decision, including the decision not to terminate, is appended to a JSON Lines log
+  - when each node was first seen failed, and which terminations were requested, are kept in a
+    state file between runs, so a cron driven single cycle (or a restarted reaper) does not
+    start every node's minimum failure age over
+
+    reaper = FailedNodeReaper(Cluster(cluster_name, CC_CONFIG), ReaperPolicy(min_failed_age=600))
+    reaper.run(interval=60)
+"""
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+import typing
+
+import metrics
+from inventory import NodeInventory
+
+
+def default_state_file(cluster_name: str) -> str:
+    return os.path.join(os.path.expanduser("~"), ".cyclecloud-demo", "reaper-{}.json".format(cluster_name))
+
+
+class ReaperPolicy:
+
+    def __init__(self, min_failed_age: float = 300, max_kills_per_cycle: int = 50,
+                 max_nodearray_fraction: float = 0.25, max_per_nodearray: typing.Optional[int] = None,
+                 failure_states: typing.Iterable[str] = ("Failed", "Unavailable"), batch_size: int = 100) -> None:
+        # seconds a node must have been in a failure state
+        self.min_failed_age = min_failed_age
+        self.max_kills_per_cycle = max_kills_per_cycle
+        # at most this fraction of a nodearray's nodes (and at least one) per cycle
+        self.max_nodearray_fraction = max_nodearray_fraction
+        self.max_per_nodearray = max_per_nodearray
+        self.failure_states = tuple(failure_states)
+        self.batch_size = batch_size
+
+    def nodearray_cap(self, nodearray_size: int) -> int:
+        cap = max(1, int(math.floor(nodearray_size * self.max_nodearray_fraction)))
+        if self.max_per_nodearray is not None:
+            cap = min(cap, self.max_per_nodearray)
+        return cap
+
+
+class FailedNodeReaper:
+
+    def __init__(self, cluster, policy: typing.Optional[ReaperPolicy] = None, nodearray: typing.Optional[str] = None,
+                 decision_log: typing.Optional[str] = None, dry_run: bool = False, full_sync_interval: float = 60,
+                 state_file: typing.Optional[str] = None, logger=None, clock=time.time) -> None:
+        self.cluster = cluster
+        self.policy = policy or ReaperPolicy()
+        self.nodearray = nodearray
+        self.decision_log = decision_log
+        self.dry_run = dry_run
+        self.logger = logger or logging.getLogger()
+        self.clock = clock
+        self.inventory = NodeInventory(cluster, full_sync_interval=full_sync_interval, logger=self.logger)
+
+        self.cycles = 0
+        # NodeId -> when the node was first seen in a failure state
+        self.failed_since: typing.Dict[str, float] = {}
+        # NodeIds we asked to terminate, until they leave the failure state
+        self.terminating: typing.Set[str] = set()
+        self.state_file = state_file
+        self._load_state()
+
+    def _load_state(self) -> None:
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file) as fr:
+                state = json.load(fr)
+        except (OSError, ValueError):
+            return
+        self.failed_since = state.get("failed_since", {})
+        self.terminating = set(state.get("terminating", []))
+
+    def _save_state(self) -> None:
+        if not self.state_file:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as fw:
+            json.dump({"failed_since": self.failed_since, "terminating": sorted(self.terminating)}, fw)
+        os.replace(fw.name, self.state_file)
+
+    def _update_failed_since(self, changes: typing.Dict[str, typing.List[str]], now: float) -> None:
+        for node_id in changes["removed"]:
+            self.failed_since.pop(node_id, None)
+            self.terminating.discard(node_id)
+        for node_id in changes["added"] + changes["changed"]:
+            if self.inventory.nodes[node_id].get("Status") in self.policy.failure_states:
+                self.failed_since.setdefault(node_id, now)
+            else:
+                self.failed_since.pop(node_id, None)
+                self.terminating.discard(node_id)
+        # a loaded state can name nodes that went away while no reaper was running
+        for node_id in list(self.failed_since):
+            if node_id not in self.inventory.nodes:
+                del self.failed_since[node_id]
+        self.terminating.intersection_update(self.inventory.nodes)
+
+    def _log(self, decisions: typing.List[typing.Dict[str, typing.Any]]) -> None:
+        if not self.decision_log or not decisions:
+            return
+        with open(self.decision_log, "a") as fw:
+            for decision in decisions:
+                fw.write(json.dumps(decision) + "\n")
+
+    def plan(self, now: float) -> typing.List[typing.Dict[str, typing.Any]]:
+        """One decision per failed node, oldest failure first"""
+        failed = [node for node in self.inventory.by_status(*self.policy.failure_states)
+                  if self.nodearray is None or node.get("Template") == self.nodearray]
+        failed.sort(key=lambda node: (self.failed_since.get(node["NodeId"], now), node["NodeId"]))
+
+        decisions = []
+        selected = 0
+        per_nodearray: typing.Dict[str, int] = {}
+        for node in failed:
+            node_id = node["NodeId"]
+            nodearray = node.get("Template")
+            failed_for = now - self.failed_since.setdefault(node_id, now)
+            cap = self.policy.nodearray_cap(len(self.inventory.by_nodearray(nodearray)))
+
+            if node_id in self.terminating:
+                decision, reason = "skip", "terminate already requested"
+            elif failed_for < self.policy.min_failed_age:
+                decision, reason = "skip", "in {} for {:.0f}s < {:.0f}s".format(
+                    node.get("Status"), failed_for, self.policy.min_failed_age)
+            elif selected >= self.policy.max_kills_per_cycle:
+                decision, reason = "defer", "max {} terminations per cycle".format(self.policy.max_kills_per_cycle)
+            elif per_nodearray.get(nodearray, 0) >= cap:
+                decision, reason = "defer", "nodearray {} cap of {} per cycle".format(nodearray, cap)
+            else:
+                decision, reason = "terminate", "in {} for {:.0f}s".format(node.get("Status"), failed_for)
+                selected += 1
+                per_nodearray[nodearray] = per_nodearray.get(nodearray, 0) + 1
+
+            decisions.append({
+                "time": now, "cycle": self.cycles, "cluster": self.cluster.cluster_name,
+                "node_id": node_id, "name": node.get("Name"), "hostname": node.get("Hostname"),
+                "nodearray": nodearray, "status": node.get("Status"), "failed_for": round(failed_for, 1),
+                "decision": decision, "reason": reason,
+            })
+        return decisions
+
+    def cycle(self) -> typing.Dict[str, int]:
+        self.cycles += 1
+        now = self.clock()
+        with metrics.timed("reaper.refresh"):
+            changes = self.inventory.refresh()
+        self._update_failed_since(changes, now)
+
+        decisions = self.plan(now)
+        to_terminate = [d for d in decisions if d["decision"] == "terminate"]
+        if to_terminate and not self.dry_run:
+            by_id = {d["node_id"]: d for d in to_terminate}
+            result = self.cluster.terminate(list(by_id), chunk_size=self.policy.batch_size)
+            for chunk in result["chunks"]:
+                for node_id in chunk["items"]:
+                    by_id[node_id]["result"] = chunk["status"]
+                    if chunk["status"] == "failed":
+                        by_id[node_id]["error"] = chunk.get("error")
+                    else:
+                        self.terminating.add(node_id)
+                if chunk["status"] == "terminated":
+                    self.inventory.track_operation(chunk["response"].get("operationId"))
+        elif to_terminate:
+            for decision in to_terminate:
+                decision["result"] = "dry_run"
+        self._log(decisions)
+        self._save_state()
+
+        stats = {"failed": len(decisions)}
+        for decision in decisions:
+            stats[decision["decision"]] = stats.get(decision["decision"], 0) + 1
+        stats["terminate_failed"] = len([d for d in to_terminate if d.get("result") == "failed"])
+        for key in ("failed", "terminate", "defer", "skip", "terminate_failed"):
+            metrics.REGISTRY.gauge("reaper_" + key, stats.get(key, 0))
+        self.logger.info("Reaper cycle %d of %s: %s", self.cycles, self.cluster.cluster_name, stats)
+        return stats
+
+    def run(self, interval: float = 60, max_cycles: typing.Optional[int] = None) -> None:
+        while max_cycles is None or self.cycles < max_cycles:
+            started = time.monotonic()
+            try:
+                self.cycle()
+            except Exception:
+                # an unattended reaper must outlive a CycleCloud outage, the next cycle retries
+                self.logger.exception("Reaper cycle %d of %s failed", self.cycles, self.cluster.cluster_name)
+            if max_cycles is not None and self.cycles >= max_cycles:
+                break
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
@@ -0,0 +1,188 @@
+"""Retry with exponential backoff, full jitter, a deadline and a circuit breaker
+
+Replaces the fixed-interval @retry decorators. Each attempt that fails with a retryable
+exception or HTTP status sleeps for a random time in [0, min(max_delay, base_delay * multiplier ** n)]
+(longer if the server sent Retry-After), so a fleet of controllers hitting the same degraded
+server spreads out instead of retrying in lockstep. No sleep runs past the deadline.
+
+A CircuitBreaker shared per CycleCloud server counts consecutive failures. After
+failure_threshold of them it opens and calls fail immediately with CircuitOpenError for
+reset_timeout seconds, then lets a single trial call through (half open) to decide whether to
+close again.
+
+    policy = RetryPolicy(max_attempts=5, deadline=60, breaker=rest_client.breaker)
+    response = policy.call(rest_client.session.get, url, name="GET /cloud/clusters")
+"""
+import logging
+import random
+import threading
+import time
+import typing
+
+import metrics
+from ratelimit import parse_retry_after
+
+
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class RetriesExhaustedError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str = "", failure_threshold: int = 5, reset_timeout: float = 30,
+                 clock=time.monotonic) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self) -> None:
+        """Raises CircuitOpenError if the call should not be attempted"""
+        with self.lock:
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError("Circuit for {} is open after {} consecutive failures".format(
+                        self.name, self.failures))
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            if self.state == self.HALF_OPEN:
+                if self._trial_running:
+                    raise CircuitOpenError("Circuit for {} is half open, waiting on a trial call".format(self.name))
+                self._trial_running = True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+            self._publish()
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.getLogger().warning("Opening circuit for %s after %d consecutive failures",
+                                                self.name, self.failures)
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+            self._publish()
+
+    def _publish(self) -> None:
+        metrics.REGISTRY.gauge("circuit_open", 1 if self.state == self.OPEN else 0)
+
+
+class RetryPolicy:
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0,
+                 multiplier: float = 2.0, deadline: typing.Optional[float] = None,
+                 retry_on: typing.Tuple[typing.Type[BaseException], ...] = (Exception,),
+                 retry_status: typing.Iterable[int] = RETRY_STATUS_CODES,
+                 breaker: typing.Optional[CircuitBreaker] = None, logger=None,
+                 sleep=time.sleep, clock=time.monotonic, rng: typing.Optional[random.Random] = None) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.deadline = deadline
+        self.retry_on = retry_on
+        self.retry_status = frozenset(retry_status)
+        self.breaker = breaker
+        self.logger = logger or logging.getLogger()
+        self.sleep = sleep
+        self.clock = clock
+        self.rng = rng or random.Random()
+
+    def delay(self, attempt: int, retry_after: typing.Optional[float] = None) -> float:
+        """Full jitter backoff before retry number attempt (0 based)"""
+        ceiling = min(self.max_delay, self.base_delay * self.multiplier ** attempt)
+        delay = self.rng.uniform(0, ceiling)
+        return max(delay, retry_after) if retry_after else delay
+
+    def call(self, fn: typing.Callable[..., typing.Any], *args: typing.Any, name: typing.Optional[str] = None,
+             deadline: typing.Optional[float] = None, **kwargs: typing.Any) -> typing.Any:
+        """Calls fn until it returns a response whose status_code (if any) is not retryable, raises
+        a non retryable exception, or attempts or the deadline run out. When they run out on a
+        retryable status the last response is returned, on an exception it is raised.
+        deadline tightens the policy's deadline for this call. With a deadline, a timeout keyword
+        argument for fn is capped to the time left, so the whole call stays within the deadline."""
+        name = name or getattr(fn, "__name__", "call")
+        if deadline is None or (self.deadline is not None and self.deadline < deadline):
+            deadline = self.deadline
+        start = self.clock()
+        attempt = 0
+        while True:
+            if self.breaker:
+                self.breaker.before_call()
+            if deadline is not None and kwargs.get("timeout") is not None:
+                kwargs["timeout"] = min(kwargs["timeout"], max(0.0, deadline - (self.clock() - start)))
+            retry_after = None
+            try:
+                result = fn(*args, **kwargs)
+            except self.retry_on as e:
+                if self.breaker:
+                    self.breaker.record_failure()
+                failure: typing.Any = e
+                result = None
+            except BaseException:
+                # not retried, but it still has to end a half open trial call
+                if self.breaker:
+                    self.breaker.record_failure()
+                raise
+            else:
+                status_code = getattr(result, "status_code", None)
+                if status_code not in self.retry_status:
+                    if self.breaker:
+                        self.breaker.record_success()
+                    return result
+                if self.breaker:
+                    self.breaker.record_failure()
+                failure = "HTTP {}".format(status_code)
+                retry_after = parse_retry_after(getattr(result, "headers", {}).get("Retry-After"))
+
+            attempt += 1
+            delay = self.delay(attempt - 1, retry_after)
+            out_of_time = deadline is not None and self.clock() - start + delay > deadline
+            if attempt >= self.max_attempts or out_of_time:
+                self.logger.warning("%s failed after %d attempts: %s", name, attempt, failure)
+                if result is None:
+                    raise failure
+                return result
+
+            self.logger.info("%s failed (%s), retry %d in %.2fs", name, failure, attempt, delay)
+            metrics.REGISTRY.retry(name)
+            if result is not None and hasattr(result, "close"):
+                # give the connection back to the pool before sleeping
+                result.close()
+            self.sleep(delay)
+
+
+try:
+    import requests
+    # The connection was never established, so no request reached CycleCloud
+    NOT_SENT_ERRORS: typing.Tuple[typing.Type[BaseException], ...] = (requests.ConnectTimeout,)
+except ImportError:
+    NOT_SENT_ERRORS = ()
+
+# node_mgr.bootup is not idempotent: a bootup that failed after its request was sent may still
+# have started (and be billing for) nodes, and a retry would start them again. Like POSTs in
+# ccrest, it is only retried when the request was never sent.
+BOOTUP_POLICY = RetryPolicy(max_attempts=3, base_delay=2.0, max_delay=30.0, deadline=300,
+                            retry_on=NOT_SENT_ERRORS)
@@ -0,0 +1,251 @@
+"""Capacity-weighted SKU spreading for spot nodearrays
+
+Replaces random.shuffle of the vm_sizes with a deterministic score per SKU, computed over
+columns holding every bucket's remaining capacity, core quota, vcpu density and the SKU's
+recent allocation failures and evictions:
+
+    score = w_capacity * capacity + w_quota * quota + w_vcpu * vcpus
+            - w_failures * failures - w_evictions * evictions
+
+with capacity, quota and vcpus normalized to [0, 1] across the SKUs. Failures and evictions
+are scaled to [0, 1) by n / (n + PENALTY_SCALE) instead, so the penalty grows with how often a
+SKU failed rather than with its rank, and a SKU with one failure is not treated like one with
+500. SKUs without available capacity, or marked exhausted
+after an allocation came up short, are dropped. The scores give the "or" constraint ordering
+and a per-SKU split of the target count.
+
+The history is kept across runs in a JSON state file (DEFAULT_HISTORY_FILE, or
+$CC_SKU_HISTORY_FILE) by SkuHistory.save and SkuHistory.load.
+"""
+import json
+import math
+import os
+import tempfile
+import time
+import typing
+
+import metrics
+
+
+DEFAULT_WEIGHTS = {
+    "capacity": 1.0,
+    "quota": 0.5,
+    "vcpu": 0.25,
+    "failures": 1.0,
+    "evictions": 1.5,
+}
+
+# decayed failures (or evictions) that give half of the full penalty
+PENALTY_SCALE = 3.0
+
+# seconds a SKU is left out after an allocation for it came up short
+DEFAULT_EXHAUSTED_COOLDOWN = 600
+
+DEFAULT_HISTORY_FILE = os.environ.get("CC_SKU_HISTORY_FILE",
+                                      os.path.join(os.path.expanduser("~"), ".cyclecloud-demo", "sku_history.json"))
+
+
+class SkuHistory:
+    """Exponentially decayed allocation failure and eviction counts per SKU, and the SKUs that
+    are out of (spot) capacity for now"""
+
+    def __init__(self, half_life: float = 3600, exhausted_cooldown: float = DEFAULT_EXHAUSTED_COOLDOWN,
+                 clock=time.time) -> None:
+        self.half_life = half_life
+        self.exhausted_cooldown = exhausted_cooldown
+        self.clock = clock
+        # vm_size -> [failures, evictions, last update]
+        self.counts: typing.Dict[str, typing.List[float]] = {}
+        # vm_size -> time until which the SKU is left out
+        self.exhausted_until: typing.Dict[str, float] = {}
+
+    def _decayed(self, vm_size: str) -> typing.List[float]:
+        now = self.clock()
+        entry = self.counts.get(vm_size)
+        if entry is None:
+            entry = self.counts[vm_size] = [0.0, 0.0, now]
+        factor = 0.5 ** ((now - entry[2]) / self.half_life)
+        entry[0] *= factor
+        entry[1] *= factor
+        entry[2] = now
+        return entry
+
+    def record_failure(self, vm_size: str, count: float = 1) -> None:
+        self._decayed(vm_size)[0] += count
+
+    def record_eviction(self, vm_size: str, count: float = 1) -> None:
+        self._decayed(vm_size)[1] += count
+
+    def mark_exhausted(self, vm_size: str, cooldown: typing.Optional[float] = None) -> None:
+        cooldown = self.exhausted_cooldown if cooldown is None else cooldown
+        self.exhausted_until[vm_size] = self.clock() + cooldown
+
+    def is_exhausted(self, vm_size: str) -> bool:
+        until = self.exhausted_until.get(vm_size)
+        if until is None:
+            return False
+        if self.clock() >= until:
+            del self.exhausted_until[vm_size]
+            return False
+        return True
+
+    def failures(self, vm_size: str) -> float:
+        return self._decayed(vm_size)[0] if vm_size in self.counts else 0.0
+
+    def evictions(self, vm_size: str) -> float:
+        return self._decayed(vm_size)[1] if vm_size in self.counts else 0.0
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # write and rename so that a concurrent load never sees a partial file
+        with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as fw:
+            json.dump({"half_life": self.half_life, "exhausted_cooldown": self.exhausted_cooldown,
+                       "counts": self.counts, "exhausted_until": self.exhausted_until}, fw)
+        os.replace(fw.name, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SkuHistory":
+        try:
+            with open(path) as fr:
+                data = json.load(fr)
+        except (OSError, ValueError):
+            return cls()
+        history = cls(half_life=data.get("half_life", 3600),
+                      exhausted_cooldown=data.get("exhausted_cooldown", DEFAULT_EXHAUSTED_COOLDOWN))
+        history.counts = data.get("counts", {})
+        history.exhausted_until = data.get("exhausted_until", {})
+        return history
+
+
+def _normalize(column: typing.List[float]) -> typing.List[float]:
+    high = max(column) if column else 0
+    if high <= 0:
+        return [0.0] * len(column)
+    return [value / high for value in column]
+
+
+def _saturate(column: typing.List[float], scale: float = PENALTY_SCALE) -> typing.List[float]:
+    return [value / (value + scale) if value > 0 else 0.0 for value in column]
+
+
+def score_skus(sku_capacity: typing.Dict[str, typing.Any], history: typing.Optional[SkuHistory] = None,
+               weights: typing.Optional[typing.Dict[str, float]] = None) -> typing.List[typing.Tuple[str, float]]:
+    """[(vm_size, score)] best first, ties broken by vm_size so the order is deterministic.
+    sku_capacity is CapacityCache.by_sku()."""
+    weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+    history = history or SkuHistory()
+
+    vm_sizes = sorted(vm_size for vm_size, sku in sku_capacity.items()
+                      if sku.available_count > 0 and not history.is_exhausted(vm_size))
+    if not vm_sizes:
+        return []
+    skus = [sku_capacity[vm_size] for vm_size in vm_sizes]
+
+    capacity = _normalize([float(sku.available_count) for sku in skus])
+    # unknown quota counts as unconstrained
+    quota_raw = [sku.available_core_quota for sku in skus]
+    known = [q for q in quota_raw if q is not None]
+    ceiling = max(known) if known else 1
+    quota = _normalize([float(ceiling if q is None else q) for q in quota_raw])
+    # log scale so a 72 vcpu SKU does not dwarf everything else
+    vcpu = _normalize([math.log2(1 + sku.vcpu_count) for sku in skus])
+    failures = _saturate([history.failures(vm_size) for vm_size in vm_sizes])
+    evictions = _saturate([history.evictions(vm_size) for vm_size in vm_sizes])
+
+    scores = [weights["capacity"] * c + weights["quota"] * q + weights["vcpu"] * v
+              - weights["failures"] * f - weights["evictions"] * e
+              for c, q, v, f, e in zip(capacity, quota, vcpu, failures, evictions)]
+    return sorted(zip(vm_sizes, scores), key=lambda pair: (-pair[1], pair[0]))
+
+
+def split_target(target_count: int, scored: typing.List[typing.Tuple[str, float]],
+                 sku_capacity: typing.Dict[str, typing.Any]) -> typing.Dict[str, int]:
+    """Splits target_count across the scored SKUs in proportion to their scores (largest remainder),
+    never giving a SKU more than its available_count. What doesn't fit anywhere is left out."""
+    if target_count <= 0 or not scored:
+        return {}
+    # shift so that every remaining SKU gets a positive share, the worst one a small one
+    low = min(score for _, score in scored)
+    weights = {vm_size: score - low + 0.1 for vm_size, score in scored}
+    limits = {vm_size: sku_capacity[vm_size].available_count for vm_size, _ in scored}
+
+    split = {vm_size: 0 for vm_size, _ in scored}
+    remaining = target_count
+    open_skus = [vm_size for vm_size, _ in scored]
+    while remaining > 0 and open_skus:
+        total = sum(weights[vm_size] for vm_size in open_skus)
+        shares = {vm_size: remaining * weights[vm_size] / total for vm_size in open_skus}
+        granted = {vm_size: min(int(shares[vm_size]), limits[vm_size] - split[vm_size]) for vm_size in open_skus}
+        leftover = remaining - sum(granted.values())
+        # hand out the rounding remainder by largest fraction, in score order for ties
+        for vm_size in sorted(open_skus, key=lambda v: (-(shares[v] - int(shares[v])), open_skus.index(v))):
+            if leftover <= 0:
+                break
+            if split[vm_size] + granted[vm_size] < limits[vm_size] and granted[vm_size] == int(shares[vm_size]):
+                granted[vm_size] += 1
+                leftover -= 1
+        for vm_size, count in granted.items():
+            split[vm_size] += count
+        remaining = target_count - sum(split.values())
+        progressed = any(granted.values())
+        open_skus = [vm_size for vm_size in open_skus if split[vm_size] < limits[vm_size]]
+        if not progressed:
+            # every open SKU's share rounded to zero, give one each in score order
+            for vm_size in open_skus[:remaining]:
+                split[vm_size] += 1
+            remaining = target_count - sum(split.values())
+            open_skus = [vm_size for vm_size in open_skus if split[vm_size] < limits[vm_size]]
+    return {vm_size: count for vm_size, count in split.items() if count > 0}
+
+
+def allocate_with_failover(capacity: typing.Any, nodearray: str, shortfall: int,
+                           history: typing.Optional[SkuHistory] = None,
+                           active: typing.Optional[typing.Dict[str, int]] = None) -> typing.Dict[str, int]:
+    """Allocates shortfall more nodes through capacity (a CapacityCache), spread across the
+    nodearray's SKUs. A SKU whose allocation comes up short (no spot capacity) is marked
+    exhausted in history and what it did not get is re-planned across the remaining SKUs right
+    away, instead of on the next run. The exhaustion lasts for history's cooldown only if the
+    caller keeps history (TargetCountController, or a history file), otherwise for this call.
+
+    Allocations use allow_existing=True, so stopped and deallocated nodes of a SKU are started
+    again before new VMs are created. The nodes already active per SKU (active) match those
+    allocations too, so each SKU's first request is raised by its active count and they are not
+    counted as allocated. Returns the number of nodes allocated per vm_size."""
+    history = history or SkuHistory()
+    # active nodes are matched (and taken) by the first allocation for their SKU only
+    active = dict(active or {})
+    allocated: typing.Dict[str, int] = {}
+    exhausted: typing.List[str] = []
+    remaining = shortfall
+    while remaining > 0:
+        by_sku = {vm_size: sku for vm_size, sku in capacity.by_sku(nodearray).items() if vm_size not in exhausted}
+        split = split_target(remaining, score_skus(by_sku, history), by_sku)
+        if not split:
+            print("No SKU left with capacity for the remaining {} nodes".format(remaining))
+            break
+        print("Spreading {} new nodes: {}".format(remaining, split))
+        newly_exhausted = []
+        for vm_size, count in split.items():
+            existing = active.pop(vm_size, 0)
+            result = capacity.allocate(constraints={"node.nodearray": nodearray, "exclusive": True, "ncpus": 1, "node.vm_size": vm_size},
+                                       node_count=existing + count, allow_existing=True, all_or_nothing=False)
+            got = max(0, len(getattr(result, "nodes", None) or []) - existing)
+            allocated[vm_size] = allocated.get(vm_size, 0) + got
+            if got < count:
+                history.record_failure(vm_size, count - got)
+                history.mark_exhausted(vm_size)
+                newly_exhausted.append(vm_size)
+        exhausted.extend(newly_exhausted)
+        remaining = shortfall - sum(allocated.values())
+        if remaining <= 0:
+            break
+        if not newly_exhausted:
+            # every SKU got its full share and the split was capped by the buckets' available
+            # counts, another round would plan the same split again
+            print("No more capacity in the buckets for the remaining {} nodes".format(remaining))
+            break
+        # each further round leaves out at least one more SKU, so this ends
+        print("Allocation short by {}, {} exhausted, failing over".format(remaining, newly_exhausted))
+        metrics.REGISTRY.retry("allocate.failover")
+    return allocated
@@ -0,0 +1,187 @@
+"""Compact, column-wise snapshot of a cluster's nodes
+
+A full node record is a dict with dozens of keys. For scans like "Status in {Failed, Unavailable}
+and nodearray == X" we only need a few attributes, so NodeSnapshot keeps them as columns: NodeId,
+Name and Hostname as lists of str and Status, nodearray and vm_size as array('H') codes into small
+tables of interned strings. Filters compare integer codes and never build a dict per node.
+
+    snapshot = NodeSnapshot.from_records(cluster.iter_nodes(attrs=SNAPSHOT_ATTRS))
+    failed = snapshot.select(statuses=["Failed", "Unavailable"], nodearray="execute-spot")
+    cluster.terminate(snapshot.node_ids(failed))
+
+Run this module to benchmark memory and scan time against the plain dict path.
+"""
+import sys
+import typing
+from array import array
+
+
+# The record attributes a snapshot keeps (nodearray is the record's Template)
+SNAPSHOT_ATTRS = ["NodeId", "Name", "Hostname", "Status", "Template", "MachineType"]
+
+
+class _Interned:
+    """Maps a small set of repeated strings (statuses, nodearrays, vm_sizes) to integer codes"""
+
+    def __init__(self) -> None:
+        self.values: typing.List[typing.Optional[str]] = []
+        self.codes: typing.Dict[typing.Optional[str], int] = {}
+
+    def code(self, value: typing.Optional[str]) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            value = sys.intern(value) if isinstance(value, str) else value
+            self.values.append(value)
+            self.codes[value] = code
+        return code
+
+    def lookup(self, values: typing.Iterable[typing.Optional[str]]) -> typing.Set[int]:
+        return {self.codes[v] for v in values if v in self.codes}
+
+
+class NodeSnapshot:
+
+    def __init__(self) -> None:
+        self.ids: typing.List[typing.Optional[str]] = []
+        self.names: typing.List[typing.Optional[str]] = []
+        self.hostnames: typing.List[typing.Optional[str]] = []
+        self.status = array("H")
+        self.nodearray = array("H")
+        self.vm_size = array("H")
+        # only populated by from_nodes, so callers get back the scalelib Node objects they passed in
+        self.objects: typing.List[typing.Any] = []
+
+        self._statuses = _Interned()
+        self._nodearrays = _Interned()
+        self._vm_sizes = _Interned()
+
+    def _append(self, node_id, name, hostname, status, nodearray, vm_size) -> None:
+        self.ids.append(node_id)
+        self.names.append(name)
+        self.hostnames.append(hostname)
+        self.status.append(self._statuses.code(status))
+        self.nodearray.append(self._nodearrays.code(nodearray))
+        self.vm_size.append(self._vm_sizes.code(vm_size))
+
+    @classmethod
+    def from_records(cls, records: typing.Iterable[typing.Dict]) -> "NodeSnapshot":
+        """From /clusters/{name}/nodes records, ideally streamed and projected onto SNAPSHOT_ATTRS"""
+        snapshot = cls()
+        for record in records:
+            snapshot._append(record.get("NodeId"), record.get("Name"), record.get("Hostname"),
+                             record.get("Status"), record.get("Template"), record.get("MachineType"))
+        return snapshot
+
+    @classmethod
+    def from_nodes(cls, nodes: typing.Iterable[typing.Any]) -> "NodeSnapshot":
+        """From scalelib Node objects, e.g. node_mgr.get_nodes()"""
+        snapshot = cls()
+        for node in nodes:
+            delayed_node_id = getattr(node, "delayed_node_id", None)
+            node_id = getattr(delayed_node_id, "node_id", None)
+            snapshot._append(node_id, node.name, getattr(node, "hostname", None),
+                             getattr(node, "state", None), node.nodearray, node.vm_size)
+            snapshot.objects.append(node)
+        return snapshot
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def select(self, statuses: typing.Optional[typing.Iterable[str]] = None,
+               nodearray: typing.Optional[str] = None,
+               vm_sizes: typing.Optional[typing.Iterable[str]] = None) -> typing.List[int]:
+        """Row indexes matching all of the given filters"""
+        columns = []
+        if statuses is not None:
+            columns.append((self.status, self._statuses.lookup(statuses)))
+        if nodearray is not None:
+            columns.append((self.nodearray, self._nodearrays.lookup([nodearray])))
+        if vm_sizes is not None:
+            columns.append((self.vm_size, self._vm_sizes.lookup(vm_sizes)))
+
+        if any(not wanted for _, wanted in columns):
+            return []
+        if not columns:
+            return list(range(len(self)))
+
+        # narrow with the first column, then filter the survivors on the rest
+        column, wanted = columns[0]
+        rows = [i for i, code in enumerate(column) if code in wanted]
+        for column, wanted in columns[1:]:
+            rows = [i for i in rows if column[i] in wanted]
+        return rows
+
+    def node_ids(self, rows: typing.Iterable[int]) -> typing.List[str]:
+        return [self.ids[i] for i in rows]
+
+    def nodes(self, rows: typing.Iterable[int]) -> typing.List[typing.Any]:
+        return [self.objects[i] for i in rows]
+
+    def iter_name_host_status(self) -> typing.Iterator[typing.Tuple]:
+        """(Name, Hostname, Status) per row, read straight from the columns, for printing"""
+        statuses = self._statuses.values
+        for name, hostname, status in zip(self.names, self.hostnames, self.status):
+            yield name, hostname, statuses[status]
+
+    def row(self, i: int) -> typing.Dict[str, typing.Any]:
+        """A single row as a dict, for printing"""
+        return {
+            "NodeId": self.ids[i],
+            "Name": self.names[i],
+            "Hostname": self.hostnames[i],
+            "Status": self._statuses.values[self.status[i]],
+            "Template": self._nodearrays.values[self.nodearray[i]],
+            "MachineType": self._vm_sizes.values[self.vm_size[i]],
+        }
+
+
+def _benchmark(node_count: int = 20000) -> None:
+    import gc
+    import random
+    import time
+    import tracemalloc
+
+    statuses = ["Ready", "Ready", "Ready", "Acquiring", "Preparing", "Failed", "Unavailable", "Off"]
+    nodearrays = ["execute", "execute-spot", "azce-blade-lp"]
+    vm_sizes = ["Standard_D2_v3", "Standard_F72S_v2", "Standard_D64S_v3"]
+
+    def _records():
+        rng = random.Random(0)
+        for i in range(node_count):
+            record = {"NodeId": "node-id-%08d" % i, "Name": "execute-%d" % i, "Hostname": "ip-0a00%04x" % i,
+                      "Status": rng.choice(statuses), "Template": rng.choice(nodearrays),
+                      "MachineType": rng.choice(vm_sizes)}
+            # the rest of a typical node record
+            record.update({"Attribute%02d" % a: "value-%d-%d" % (i, a) for a in range(30)})
+            yield record
+
+    wanted = {"Failed", "Unavailable"}
+
+    gc.collect()
+    tracemalloc.start()
+    records = list(_records())
+    dict_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    dict_hits = [r["NodeId"] for r in records if r["Status"] in wanted and r["Template"] == "execute-spot"]
+    dict_scan = time.perf_counter() - start
+    del records
+
+    gc.collect()
+    tracemalloc.start()
+    snapshot = NodeSnapshot.from_records(_records())
+    snapshot_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    snapshot_hits = snapshot.node_ids(snapshot.select(statuses=wanted, nodearray="execute-spot"))
+    snapshot_scan = time.perf_counter() - start
+
+    assert dict_hits == snapshot_hits
+    print("{} nodes, {} matches".format(node_count, len(dict_hits)))
+    print("dicts     : {:8.1f} MB  scan {:7.2f} ms".format(dict_memory / 2**20, dict_scan * 1000))
+    print("snapshot  : {:8.1f} MB  scan {:7.2f} ms".format(snapshot_memory / 2**20, snapshot_scan * 1000))
+
+
+if __name__ == "__main__":
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
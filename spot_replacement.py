@@ -5,8 +5,8 @@ import typing
 from cyclecloud.client import Client, Record
 import logging
 import sys
+import time
 from hpc.autoscale.util import json_dump
-from retry import retry
 
 from uuid import uuid4
 
@@ -15,6 +15,13 @@ from hpc.autoscale.job.demandprinter import print_demand
 from hpc.autoscale.job.job import Job
 from hpc.autoscale.node.nodemanager import NodeManager, new_node_manager
 
+import metrics
+from capacity import CapacityCache
+from bootup_tracker import PhaseTracer, track_bootup
+from ccrest import get_rest_client
+from retry_policy import BOOTUP_POLICY
+from sku_scoring import DEFAULT_HISTORY_FILE, SkuHistory, allocate_with_failover, score_skus
+
 
 CC_CONFIG: typing.Dict[str, typing.Any] = {
     "url": "https://localhost:8443",  # Or your CC URL
@@ -39,9 +46,14 @@ BASE_CLUSTER_PARAMS: typing.Dict[str, typing.Any] = {
 
 
 
-def scale_nodearray_to_target_demand(cluster_name, nodearray, target_count, shuffle=True, dry_run=False) -> None:
+# Nodes counting towards the target: started (or starting) and not failed
+INACTIVE_STATUSES = {"Failed", "Off", "Terminating", "Deallocated"}
+
 
-    client = Client(CC_CONFIG)
+def scale_nodearray_to_target_demand(cluster_name, nodearray, target_count, shuffle=True, dry_run=False,
+                                     capacity: typing.Optional[CapacityCache] = None,
+                                     history: typing.Optional[SkuHistory] = None,
+                                     history_file: typing.Optional[str] = None) -> None:
 
     print("Scaling nodearray {} in cluster {} to {} nodes".format(nodearray, cluster_name, target_count))
 
@@ -49,9 +61,11 @@ def scale_nodearray_to_target_demand(cluster_name, nodearray, target_count, shuf
     We're simply doing a "Target Count" style allocation, so we could simply use the NodeMgr API here.
     But we're using the DemandCalculator API to provide a basis for a more advanced autoscaler later.
     """
-    dcalc = new_demand_calculator(CC_CONFIG)
+    with metrics.timed("new_demand_calculator"):
+        dcalc = new_demand_calculator(CC_CONFIG)
     node_mgr = dcalc.node_mgr
-    vm_sizes = [bucket.vm_size for bucket in node_mgr.get_buckets()]
+    capacity = capacity or CapacityCache(node_mgr)
+    vm_sizes = capacity.vm_sizes(nodearray)
 
     # Simple means to spread the demand across machine types to avoid spot capacity issues
     # Sample Constraint (showing how it could be extended to add preference for spot over non-spot as
@@ -61,9 +75,11 @@ def scale_nodearray_to_target_demand(cluster_name, nodearray, target_count, shuf
 
     machine_type_selection_order = [{"node.vm_size": vm_size} for vm_size in vm_sizes]
     if shuffle:
-        # Spread the requests across machine types to avoid spot capacity issues
-        import random
-        random.shuffle(machine_type_selection_order)
+        if history is None and history_file:
+            history = SkuHistory.load(history_file)
+        # Prefer the machine types with the most spot capacity and the fewest recent failures and evictions
+        scored = score_skus(capacity.by_sku(nodearray), history)
+        machine_type_selection_order = [{"node.vm_size": vm_size} for vm_size, _ in scored]
     constraint_set = {"node.nodearray": nodearray, "exclusive": True, "ncpus": 1, "or": machine_type_selection_order}
     job = Job(
             name="placeholder_job",
@@ -73,10 +89,12 @@ def scale_nodearray_to_target_demand(cluster_name, nodearray, target_count, shuf
             packing_strategy="scatter"
         )
     dcalc.add_job(job)
-    demand_result = dcalc.finish()
+    with metrics.timed("dcalc.finish"):
+        demand_result = dcalc.finish()
 
     if not dry_run:
-        dcalc.bootup()
+        with metrics.timed("dcalc.bootup"):
+            BOOTUP_POLICY.call(dcalc.bootup, name="dcalc.bootup")
 
     # note that /ncpus will display available/total. ncpus will display the total, and
     # *ncpus will display available.
@@ -85,9 +103,23 @@ def scale_nodearray_to_target_demand(cluster_name, nodearray, target_count, shuf
     print_demand(["name", "job_ids", "nodearray", "/ncpus", "vm_size", "pcpu_count"], demand_result)
 
 
-def scale_nodearray_to_target_count(cluster_name, nodearray, target_count, shuffle=True, dry_run=False) -> None:
+def _active_nodes_by_sku(node_mgr: NodeManager, nodearray: str) -> typing.Dict[str, int]:
+    active: typing.Dict[str, int] = {}
+    for node in node_mgr.get_nodes():
+        if (node.nodearray == nodearray and getattr(node, "target_state", "Started") == "Started"
+                and node.state not in INACTIVE_STATUSES):
+            active[node.vm_size] = active.get(node.vm_size, 0) + 1
+    return active
+
 
-    client = Client(CC_CONFIG)
+def scale_nodearray_to_target_count(cluster_name, nodearray, target_count, shuffle=True, dry_run=False,
+                                    node_mgr: typing.Optional[NodeManager] = None,
+                                    capacity: typing.Optional[CapacityCache] = None,
+                                    history: typing.Optional[SkuHistory] = None,
+                                    history_file: typing.Optional[str] = None,
+                                    wait_timeout: typing.Optional[float] = None,
+                                    trace_file: typing.Optional[str] = None,
+                                    active: typing.Optional[typing.Dict[str, int]] = None) -> typing.Any:
 
     print("Scaling nodearray {} in cluster {} to {} nodes".format(nodearray, cluster_name, target_count))
 
@@ -95,8 +127,12 @@ def scale_nodearray_to_target_count(cluster_name, nodearray, target_count, shuff
     We're simply doing a "Target Count" style allocation, so we can simply use the NodeMgr API here.
     Using the DemandCalculator API would provide a basis for a more advanced autoscaler later.
     """
-    node_mgr:NodeManager = new_node_manager(CC_CONFIG)
-    vm_sizes = [bucket.vm_size for bucket in node_mgr.get_buckets()]
+    # A long running controller passes in its warm node manager
+    if node_mgr is None:
+        with metrics.timed("new_node_manager"):
+            node_mgr = new_node_manager(CC_CONFIG)
+    capacity = capacity or CapacityCache(node_mgr)
+    vm_sizes = capacity.vm_sizes(nodearray)
 
     # Simple means to spread the demand across machine types to avoid spot capacity issues
     # Sample Constraint (showing how it could be extended to add preference for spot over non-spot as
@@ -104,19 +140,32 @@ def scale_nodearray_to_target_count(cluster_name, nodearray, target_count, shuff
     #     {"or": [{"node.vm_size": "Standard_NC6", "node.spot": true},
     #             {"node.vm_size": "Standard_F16", "node.spot": false}]}
 
-    machine_type_selection_order = [{"node.vm_size": vm_size} for vm_size in vm_sizes]
     if shuffle:
-        # Spread the requests across machine types to avoid spot capacity issues
-        import random
-        random.shuffle(machine_type_selection_order)
-    constraint_set = {"node.nodearray": nodearray, "exclusive": True, "ncpus": 1, "or": machine_type_selection_order}
-
-    node_mgr.allocate(constraints=constraint_set, node_count=target_count,
-                      allow_existing=True, all_or_nothing=False)
+        # Spread the shortfall across machine types to avoid spot capacity issues: each SKU gets a
+        # share weighted by its remaining capacity, quota and vcpus and penalized by recent failures
+        # and evictions (see sku_scoring)
+        if history is None and history_file:
+            history = SkuHistory.load(history_file)
+        # a caller polling the nodes itself knows the active nodes per SKU better than a warm node_mgr
+        if active is None:
+            active = _active_nodes_by_sku(node_mgr, nodearray)
+        shortfall = target_count - sum(active.values())
+        history = history or SkuHistory()
+        allocate_with_failover(capacity, nodearray, shortfall, history, active)
+        if history_file:
+            # the failures and exhausted SKUs of this run steer the next one
+            history.save(history_file)
+    else:
+        machine_type_selection_order = [{"node.vm_size": vm_size} for vm_size in vm_sizes]
+        constraint_set = {"node.nodearray": nodearray, "exclusive": True, "ncpus": 1, "or": machine_type_selection_order}
+
+        capacity.allocate(constraints=constraint_set, node_count=target_count,
+                          allow_existing=True, all_or_nothing=False)
 
     allocation_results = None
     if not dry_run:
-        allocation_results = node_mgr.bootup()
+        bootup_start = time.monotonic()
+        allocation_results = capacity.bootup()
         if allocation_results.nodes:
             print("Auto-starting:")
             for node in allocation_results.nodes:
@@ -125,12 +174,147 @@ def scale_nodearray_to_target_count(cluster_name, nodearray, target_count, shuff
             print("No additional nodes required.")
         else:
             print("Result: {}".format(allocation_results))
+        if wait_timeout and allocation_results.nodes:
+            # wait for just the nodes started above, not the whole cluster
+            # the trace shows which SKUs and regions start fastest under spot pressure
+            tracer = PhaseTracer(cluster_name) if trace_file else None
+            report = track_bootup(get_rest_client(CC_CONFIG), cluster_name, allocation_results,
+                                  timeout=wait_timeout, started_at=bootup_start, tracer=tracer)
+            if report:
+                print(report.summary())
+            if tracer:
+                tracer.write(trace_file)
+    return allocation_results
+
+
+
+
+class TargetCountController:
+    """Keeps a nodearray at its target count from a long running process
+
+    Each cycle does one cheap, projected (and conditional, when the server supports ETags)
+    poll of the cluster's nodes. If the nodearray is at its target nothing else happens. The
+    active node counts per SKU come from that poll. The node manager is kept warm between
+    cycles: nodes moving between active states (Acquiring, Preparing, Ready) don't change the
+    buckets and are ignored, it is only rebuilt (buckets and nodes refetched) when a node of the
+    nodearray appeared, went away, changed TargetState or became inactive, e.g. spot evictions,
+    and after every cycle that allocated from it. scalelib has no API to patch or refresh a node
+    manager's buckets and nodes in place, so a rebuild is a full one; the savings come from the
+    cycles at target, which only poll.
+    """
+
+    def __init__(self, cluster_name, nodearray, target_count, shuffle=True, dry_run=False, logger=None,
+                 history_file: typing.Optional[str] = None) -> None:
+        self.cluster_name = cluster_name
+        self.nodearray = nodearray
+        self.target_count = target_count
+        self.shuffle = shuffle
+        self.dry_run = dry_run
+        self.logger = logger or logging.getLogger()
+
+        self.rest = get_rest_client(CC_CONFIG)
+        self.node_mgr: typing.Optional[NodeManager] = None
+        self.capacity: typing.Optional[CapacityCache] = None
+        self.history_file = history_file
+        self.history = SkuHistory.load(history_file) if history_file else SkuHistory()
+        # NodeId -> MachineType of the nodes that were active at the last poll
+        self._active: typing.Dict[str, str] = {}
+        self._etag: typing.Optional[str] = None
+        self._fingerprint: typing.Optional[typing.FrozenSet] = None
+        self._active_count = 0
+        self.cycles = 0
+
+    def _poll(self) -> bool:
+        """Refreshes the active nodes, returns True if the nodearray changed in a way the node manager
+        has to be rebuilt for since the last poll"""
+        self._etag, records = self.rest.poll_cluster_nodes(
+            self.cluster_name, attrs=["NodeId", "Template", "Status", "TargetState", "MachineType"], etag=self._etag)
+        if records is None:
+            return False
+        mine = [r for r in records if r["Template"] == self.nodearray]
+        active = {r["NodeId"]: r["MachineType"] for r in mine
+                  if r["TargetState"] == "Started" and r["Status"] not in INACTIVE_STATUSES}
+        fingerprint = frozenset((r["NodeId"], r["TargetState"], r["NodeId"] in active) for r in mine)
+        changed = fingerprint != self._fingerprint
+        self._fingerprint = fingerprint
+        # this controller never stops nodes, so an active node going away was evicted (or failed)
+        for node_id, vm_size in self._active.items():
+            if node_id not in active:
+                self.history.record_eviction(vm_size)
+        self._active = active
+        self._active_count = len(active)
+        return changed
+
+    def _active_by_sku(self) -> typing.Dict[str, int]:
+        active: typing.Dict[str, int] = {}
+        for vm_size in self._active.values():
+            active[vm_size] = active.get(vm_size, 0) + 1
+        return active
+
+    def cycle(self) -> typing.Dict[str, typing.Any]:
+        start = time.perf_counter()
+        self.cycles += 1
+        changed = self._poll()
+        poll_latency = time.perf_counter() - start
+
+        refreshed = False
+        allocated = 0
+        if self._active_count < self.target_count:
+            if self.node_mgr is None or changed:
+                with metrics.timed("new_node_manager"):
+                    self.node_mgr = new_node_manager(CC_CONFIG)
+                self.capacity = CapacityCache(self.node_mgr)
+                refreshed = True
+            result = scale_nodearray_to_target_count(self.cluster_name, self.nodearray, self.target_count,
+                                                     shuffle=self.shuffle, dry_run=self.dry_run,
+                                                     node_mgr=self.node_mgr, capacity=self.capacity,
+                                                     history=self.history, active=self._active_by_sku())
+            # allocate() assigned the placeholder job to the matched nodes of this node manager, so
+            # they can't be matched again and its buckets no longer reflect the cluster: the next
+            # cycle that has to scale starts from a fresh one
+            self.node_mgr = None
+            if result is not None and result.nodes:
+                allocated = len(result.nodes)
+                # the new nodes show up on the next poll, which must not count as a change by itself
+                self._poll()
+        if self.history_file:
+            self.history.save(self.history_file)
+
+        stats = {
+            "cycle": self.cycles,
+            "active": self._active_count,
+            "target": self.target_count,
+            "allocated": allocated,
+            "node_mgr_refreshed": refreshed,
+            "poll_latency": poll_latency,
+            "latency": time.perf_counter() - start,
+        }
+        metrics.REGISTRY.observe("controller.cycle", stats["latency"])
+        metrics.REGISTRY.gauge("controller_active_nodes", self._active_count)
+        metrics.REGISTRY.gauge("controller_target_nodes", self.target_count)
+        self.logger.info("Cycle %(cycle)d: %(active)d/%(target)d active, allocated %(allocated)d, "
+                         "node manager refreshed %(node_mgr_refreshed)s, poll %(poll_latency).3fs, "
+                         "cycle %(latency).3fs", stats)
+        return stats
+
+    def run(self, interval: float = 60, max_cycles: typing.Optional[int] = None) -> None:
+        while max_cycles is None or self.cycles < max_cycles:
+            started = time.monotonic()
+            try:
+                self.cycle()
+            except Exception:
+                # one bad cycle must not kill the controller, the next one starts from a fresh node manager
+                self.logger.exception("Autoscale cycle %d failed", self.cycles)
+                self.node_mgr = None
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
 
     
 if __name__ == "__main__":
 
     import getpass
 
+    metrics.configure_from_env()
+
     print('Enter CycleCloud url, username and password.')
     url = input('CycleCloud URL: ({})'.format(CC_CONFIG['url'])) or CC_CONFIG['url']
     username = input('username: ({})'.format(CC_CONFIG['username'])) or CC_CONFIG['username']
@@ -151,5 +335,14 @@ if __name__ == "__main__":
 
     shuffle = input('Shuffle Spot? (true)').lower() in {'', 'y', 'yes', 'true'} or False
     dry_run = input('Dry Run? (false)').lower() in {'y', 'yes', 'true'} or False
-
-    scale_nodearray_to_target_count(cluster_name, nodearray, target_count, shuffle=shuffle, dry_run=False)
+    interval = float(input('Controller interval in seconds, 0 to run once: (0)') or 0)
+    wait_timeout = 0.0
+    if interval <= 0 and not dry_run:
+        wait_timeout = float(input('Seconds to wait for the new nodes to be Ready, 0 to not wait: (0)') or 0)
+
+    if interval > 0:
+        TargetCountController(cluster_name, nodearray, target_count, shuffle=shuffle, dry_run=dry_run,
+                              history_file=DEFAULT_HISTORY_FILE).run(interval)
+    else:
+        scale_nodearray_to_target_count(cluster_name, nodearray, target_count, shuffle=shuffle, dry_run=dry_run,
+                                        history_file=DEFAULT_HISTORY_FILE, wait_timeout=wait_timeout)
@@ -1,11 +1,34 @@
-"""Cyclecloud API demo"""
+"""Cyclecloud API demo
+
+Either a single --action on one --nodearray, or a --plan file of many actions applied with one
+node manager, one bootup() and one deallocate call:
+
+    [
+        {"action": "start", "nodearray": "execute", "count": 10, "sku": "Standard_F2s_v2"},
+        {"action": "start", "nodearray": "hpc", "count": 2},
+        {"action": "stop", "nodearray": "persistent-execute"},
+        {"action": "stop", "nodearray": "execute-spot", "idle_minutes": 30},
+        {"action": "stop", "nodearray": "execute", "count": 2, "sku": "Standard_F2s_v2"}
+    ]
+
+A stop step without count stops every (idle) node of the nodearray, or of its sku if set.
+"""
 import argparse
 import getpass
+import json
 import logging
 import sys
+import time
+import typing
 
 from hpc.autoscale.node.nodemanager import new_node_manager
 
+import metrics
+from bootup_tracker import PhaseTracer, track_bootup
+from capacity import CapacityCache
+from ccrest import get_rest_client
+from node_index import DEFAULT_IDLE_FILE, IdleTracker, NodeIndex, NoDemandDataError
+
 CC_CONFIG = {
     "url": "http://localhost:8080",  # Or your CC URL
     "username": "USER",
@@ -21,22 +44,49 @@ logging.basicConfig(
 )
 
 
-def deallocate_nodes(node_mgr, cluster_name, nodearray_name):
+def deallocate_nodes(node_mgr, cluster_name, nodearray_name, index=None, idle_minutes=None, idle_file=DEFAULT_IDLE_FILE):
     print("Deallocating nodes : {}".format(nodearray_name))
 
-    node_mgr.deallocate_nodes(
-        [x for x in node_mgr.get_nodes() if x.nodearray == nodearray_name]
-    )
+    if index is None and idle_minutes is None:
+        # every node of one nodearray: a single scan is cheaper than building an index
+        nodes = [node for node in node_mgr.get_nodes() if node.nodearray == nodearray_name]
+        if nodes:
+            with metrics.timed("node_mgr.deallocate_nodes"):
+                node_mgr.deallocate_nodes(nodes)
+        return nodes
+
+    # When stopping several nodearrays, build the index once and pass it to each call
+    if index is None:
+        index = NodeIndex(node_mgr, idle=IdleTracker(idle_file))
+    nodes = _stop_selection(index, nodearray_name, idle_minutes)
+    if idle_minutes is not None:
+        # remember when the remaining nodes became idle for the next run
+        index.idle.save()
+    if nodes:
+        index.deallocate_nodes(nodes)
+    return nodes
+
+
+def _stop_selection(index, nodearray_name, idle_minutes=None, sku=None, count=None, exclude=()):
+    vm_sizes = [sku] if sku else None
+    if idle_minutes is None:
+        nodes = index.select(nodearray=nodearray_name, vm_sizes=vm_sizes)
+    else:
+        # cost driven scale down: only nodes that have had no jobs for a while
+        nodes = index.select(nodearray=nodearray_name, vm_sizes=vm_sizes, states=["Ready"], idle=True,
+                             min_idle=float(idle_minutes) * 60)
+    nodes = [node for node in nodes if node.name not in exclude]
+    return nodes if count is None else nodes[:int(count)]
 
 
-def add_nodes(node_mgr, cluster_name, nodearray_name, count=1, sku=""):
+def add_nodes(node_mgr, cluster_name, nodearray_name, count=1, sku="", wait_timeout=None, trace_file=None):
     print("Adding nodes to cluster: {} nodearray: {}".format(cluster_name, nodearray_name))
 
+    capacity = CapacityCache(node_mgr)
+
     # Show available capacity before:
     print("Capacity BEFORE scale up")
-    buckets = node_mgr.get_buckets()
-    for bucket in buckets:
-        print(bucket)
+    capacity.print_buckets()
 
     # allocate by  node (vs slot)
     selector = {"node.nodearray": nodearray_name}
@@ -44,15 +94,122 @@ def add_nodes(node_mgr, cluster_name, nodearray_name, count=1, sku=""):
     print(sku)
     if sku:
         selector["node.vm_size"] = sku
-    r = node_mgr.allocate(selector, node_count=count)
+    r = capacity.allocate(selector, node_count=count)
     print("About to START nodes")
-    node_mgr.bootup()
+    bootup_start = time.monotonic()
+    result = capacity.bootup()
 
     # Show capacity after
     print("Capacity AFTER scale up")
-    buckets = node_mgr.get_buckets()
-    for bucket in buckets:
-        print(bucket)
+    capacity.print_buckets()
+
+    if wait_timeout:
+        tracer = PhaseTracer(cluster_name) if trace_file else None
+        report = track_bootup(get_rest_client(CC_CONFIG), cluster_name, result,
+                              timeout=wait_timeout, started_at=bootup_start, tracer=tracer)
+        if report:
+            print(report.summary())
+        if tracer:
+            tracer.write(trace_file)
+
+
+PLAN_ACTIONS = ("start", "stop")
+
+
+def load_plan(path):
+    """Reads and checks a plan file: a JSON list of actions, or {"actions": [...]}"""
+    with open(path) as fr:
+        plan = json.load(fr)
+    if isinstance(plan, dict):
+        plan = plan.get("actions", [])
+
+    errors = []
+    for i, step in enumerate(plan):
+        action = str(step.get("action", "")).lower()
+        if action not in PLAN_ACTIONS:
+            errors.append("step {}: action must be one of {}, got {!r}".format(i, PLAN_ACTIONS, step.get("action")))
+        if not step.get("nodearray"):
+            errors.append("step {}: nodearray is required".format(i))
+        try:
+            if int(step.get("count", 1)) < 1:
+                errors.append("step {}: count must be positive".format(i))
+        except (TypeError, ValueError):
+            errors.append("step {}: count must be an integer, got {!r}".format(i, step.get("count")))
+        step["action"] = action
+    if errors:
+        raise ValueError("Invalid plan {}:\n  {}".format(path, "\n  ".join(errors)))
+    return plan
+
+
+def _available_by_bucket(capacity) -> typing.Dict[typing.Tuple[str, str], int]:
+    available: typing.Dict[typing.Tuple[str, str], int] = {}
+    for bucket in capacity.buckets():
+        key = (bucket.nodearray, bucket.vm_size)
+        available[key] = available.get(key, 0) + bucket.available_count
+    return available
+
+
+def apply_plan(node_mgr, cluster_name, plan, dry_run=False, idle_file=DEFAULT_IDLE_FILE):
+    """Allocates every start step, then boots them up with a single bootup() and deallocates every
+    stop step with a single deallocate call. Stop steps apply to the nodes that existed before the plan,
+    only the ones idle for at least idle_minutes if the step sets it."""
+    print("Applying plan with {} steps to cluster: {}".format(len(plan), cluster_name))
+    capacity = CapacityCache(node_mgr)
+    before = _available_by_bucket(capacity)
+    idle_steps = any(step["action"] == "stop" and step.get("idle_minutes") is not None for step in plan)
+    index = NodeIndex(node_mgr, idle=IdleTracker(idle_file) if idle_steps else None)
+    stops = []
+    selected = set()
+    for step in plan:
+        if step["action"] == "stop":
+            # a node matched by an earlier stop step is not counted again
+            nodes = _stop_selection(index, step["nodearray"], step.get("idle_minutes"), step.get("sku"),
+                                    step.get("count"), exclude=selected)
+            selected.update(node.name for node in nodes)
+            stops.append((step, nodes))
+    if idle_steps:
+        index.idle.save()
+    index.idle.save()
+    to_stop = [node for _, nodes in stops for node in nodes]
+
+    results = []
+    for step in plan:
+        if step["action"] != "start":
+            continue
+        selector = {"node.nodearray": step["nodearray"]}
+        if step.get("sku"):
+            selector["node.vm_size"] = step["sku"]
+        result = capacity.allocate(selector, node_count=int(step.get("count", 1)))
+        allocated = len(getattr(result, "nodes", None) or [])
+        index.track_allocation(result)
+        results.append((step, allocated, result))
+        if not result:
+            logging.warning("Could not allocate %s x %s: %s", step.get("count", 1), selector, result)
+
+    if dry_run:
+        print("Dry run: not starting {} nodes or deallocating {} nodes".format(
+            sum(allocated for _, allocated, _ in results), len(to_stop)))
+    else:
+        if any(allocated for _, allocated, _ in results):
+            print("About to START nodes")
+            capacity.bootup()
+        if to_stop:
+            print("Deallocating {} nodes".format(len(to_stop)))
+            index.deallocate_nodes(to_stop)
+            capacity.invalidate({node.nodearray for node in to_stop})
+
+    after = _available_by_bucket(capacity)
+    print("Plan results")
+    for step, allocated, _ in results:
+        print("  start {:24} {:24} requested {:5} allocated {:5}".format(
+            step["nodearray"], step.get("sku") or "*", int(step.get("count", 1)), allocated))
+    for step, nodes in stops:
+        print("  stop  {:24} {:24} requested {:>5} stopping  {:5}".format(
+            step["nodearray"], step.get("sku") or "*", step.get("count", "all"), len(nodes)))
+    print("Capacity {:24} {:24} {:>8} {:>8}".format("nodearray", "vm_size", "before", "after"))
+    for key in sorted(set(before) | set(after)):
+        print("         {:24} {:24} {:8} {:8}".format(key[0], key[1], before.get(key, 0), after.get(key, 0)))
+    return results
 
 
 def main():
@@ -66,9 +223,19 @@ def main():
     parser.add_argument("--url", dest="url", default=CC_CONFIG["url"], help="CC URL")
     parser.add_argument("--username", dest="username", default=CC_CONFIG["username"], help="CC Username")
     parser.add_argument("--password", dest="password", default=None, help="CC Password")
+    parser.add_argument("--idle-minutes", dest="idle_minutes", type=float, default=None,
+                        help="Stop only Ready nodes that have been idle for at least this many minutes "
+                             "(needs job match history on the nodes)")
+    parser.add_argument("--wait", dest="wait", type=float, default=0,
+                        help="Seconds to wait for started nodes to be Ready, reporting time to ready (0 = don't wait)")
+    parser.add_argument("--trace", dest="trace_file", default=None,
+                        help="With --wait, append each node's bootup transitions to this JSON Lines file")
+    parser.add_argument("--plan", dest="plan", default=None, help="JSON file of start/stop actions to apply together")
+    parser.add_argument("--dry-run", dest="dry_run", action="store_true", help="Allocate the plan but do not start or stop nodes")
 
     args = parser.parse_args()
-    
+    plan = load_plan(args.plan) if args.plan else None
+
     if not args.password:
         print("Enter CycleCloud password.")
         args.password = getpass.getpass("password: ")
@@ -77,12 +244,22 @@ def main():
     CC_CONFIG["username"] = args.username
     CC_CONFIG["password"] = args.password
     CC_CONFIG["cluster_name"] = args.cluster_name
-    node_mgr = new_node_manager(CC_CONFIG)
+    metrics.configure_from_env()
+    with metrics.timed("new_node_manager"):
+        node_mgr = new_node_manager(CC_CONFIG)
 
-    if args.action.lower() == "stop":
-        deallocate_nodes(node_mgr, args.cluster_name, args.nodearray)
+    if plan is not None or args.action.lower() == "stop":
+        try:
+            if plan is not None:
+                apply_plan(node_mgr, args.cluster_name, plan, dry_run=args.dry_run)
+            else:
+                deallocate_nodes(node_mgr, args.cluster_name, args.nodearray, idle_minutes=args.idle_minutes)
+        except NoDemandDataError as e:
+            # idle selection needs job data, stopping busy nodes would be worse than doing nothing
+            sys.exit("Not stopping anything: {}".format(e))
     else:
-        add_nodes(node_mgr, args.cluster_name, args.nodearray, count=int(args.count),sku=args.sku)
+        add_nodes(node_mgr, args.cluster_name, args.nodearray, count=int(args.count),sku=args.sku, wait_timeout=args.wait,
+                  trace_file=args.trace_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+pytest.importorskip("requests")
+
+from ccrest import iter_json_array  # noqa: E402
+
+
+def _split(text, *cuts):
+    cuts = (0,) + cuts + (len(text),)
+    return [text[a:b] for a, b in zip(cuts, cuts[1:])]
+
+
+@pytest.mark.parametrize("chunks", [
+    ['{"nodes": [1', 'e5, 2.', '5]}'],
+    ['{"nodes": [1e', '5, 2', '.5]}'],
+    ['{"nodes": [1', '0', '0000, 2.5', ']}'],
+])
+def test_numbers_split_across_chunks(chunks):
+    assert list(iter_json_array(chunks, "nodes")) == [1e5, 2.5]
+
+
+def test_every_chunk_boundary():
+    document = {"other": [1, 2], "nodes": [{"Name": "é-1", "CoreCount": 12}, 2.5e-3, -7, True, None, "x"]}
+    text = json.dumps(document, ensure_ascii=False)
+    data = text.encode()
+    for cut in range(1, len(data)):
+        assert list(iter_json_array([data[:cut], data[cut:]], "nodes")) == document["nodes"]
+    for cut in range(1, len(text) - 1):
+        assert list(iter_json_array(_split(text, cut, cut + 1), "nodes")) == document["nodes"]
@@ -0,0 +1,66 @@
+from inventory import NodeInventory
+
+
+class FakeCluster:
+
+    cluster_name = "test"
+
+    def __init__(self, nodes, etags=True) -> None:
+        self.listing = {node["NodeId"]: dict(node) for node in nodes}
+        self.operations = {}
+        self.etags = etags
+        self.version = 0
+        self.listing_gets = 0
+        self.operation_gets = 0
+
+    def set_status(self, node_id, status) -> None:
+        self.listing[node_id]["Status"] = status
+        self.version += 1
+
+    def poll_nodes(self, attrs=None, etag=None, params=None):
+        current = str(self.version) if self.etags else None
+        if etag is not None and etag == current:
+            return etag, None
+        self.listing_gets += 1
+        return current, [dict(node) for node in self.listing.values()]
+
+    def nodes_by_operation_id(self, operation_id):
+        self.operation_gets += 1
+        return {"nodes": [dict(self.listing[node_id]) for node_id in self.operations[operation_id]
+                          if node_id in self.listing]}
+
+
+def _node(node_id, status="Ready"):
+    return {"NodeId": node_id, "Name": node_id, "Status": status, "Template": "execute"}
+
+
+def test_operation_stays_tracked_until_its_nodes_settle():
+    cluster = FakeCluster([_node("a", "Failed"), _node("b")], etags=False)
+    inventory = NodeInventory(cluster, full_sync_interval=3600)
+    inventory.refresh()
+
+    cluster.operations["op"] = ["a"]
+    inventory.track_operation("op")
+    cluster.set_status("a", "Terminating")
+    assert inventory.refresh()["changed"] == ["a"]
+
+    cluster.set_status("a", "Terminated")
+    assert inventory.refresh()["changed"] == ["a"]
+    assert inventory.nodes["a"]["Status"] == "Terminated"
+
+    gets = cluster.operation_gets
+    inventory.refresh()
+    assert cluster.operation_gets == gets
+
+
+def test_delta_refresh_sees_untracked_failures_with_etags():
+    cluster = FakeCluster([_node("a"), _node("b")])
+    inventory = NodeInventory(cluster, full_sync_interval=3600)
+    inventory.refresh()
+
+    assert inventory.refresh() == {"added": [], "changed": [], "removed": []}
+    assert cluster.listing_gets == 1
+
+    cluster.set_status("b", "Failed")
+    assert inventory.refresh()["changed"] == ["b"]
+    assert [node["NodeId"] for node in inventory.by_status("Failed")] == ["b"]
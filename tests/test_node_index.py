@@ -0,0 +1,52 @@
+import types
+
+import pytest
+
+from node_index import IdleTracker, NodeIndex, NoDemandDataError
+
+
+class FakeNodeManager:
+
+    def __init__(self, nodes) -> None:
+        self.nodes = nodes
+
+    def get_nodes(self):
+        return list(self.nodes)
+
+
+def _node(name, create_time_unix, last_match_time_unix=None, state="Ready"):
+    return types.SimpleNamespace(name=name, nodearray="execute", vm_size="Standard_D2_v3", state=state,
+                                 hostname=name, assignments=[], create_time_unix=create_time_unix,
+                                 last_match_time_unix=last_match_time_unix)
+
+
+def test_idle_age_starts_when_the_node_last_became_idle(tmp_path):
+    now = [100000.0]
+    path = str(tmp_path / "idle_since.json")
+    busy = _node("busy", now[0] - 86400, now[0] - 7200)
+    node_mgr = FakeNodeManager([_node("old", now[0] - 86400, now[0] - 7200), busy])
+
+    # both nodes were created a day ago, but neither was seen idle before
+    index = NodeIndex(node_mgr, clock=lambda: now[0], idle=IdleTracker(path, clock=lambda: now[0]))
+    assert index.select(idle=True, min_idle=1800) == []
+    assert [n.name for n in index.select(min_age=1800)] == ["busy", "old"]
+    index.idle.save()
+
+    # "busy" ran a job in between and finished it a minute ago
+    busy.last_match_time_unix = now[0] + 1740
+    now[0] += 1800
+    index = NodeIndex(node_mgr, clock=lambda: now[0], idle=IdleTracker(path, clock=lambda: now[0]))
+    assert [n.name for n in index.select(idle=True, min_idle=1800)] == ["old"]
+
+
+def test_first_sighting_without_job_history_is_not_idle_long_enough():
+    node_mgr = FakeNodeManager([_node("new", 0.0), _node("matched", 0.0, 50000.0)])
+    index = NodeIndex(node_mgr, clock=lambda: 100000.0, idle=IdleTracker(clock=lambda: 100000.0))
+    assert index.select(idle=True, min_idle=60) == []
+
+
+def test_idle_selection_refuses_without_demand_data():
+    node_mgr = FakeNodeManager([_node("a", 0.0), _node("b", 0.0)])
+    index = NodeIndex(node_mgr, clock=lambda: 100000.0)
+    with pytest.raises(NoDemandDataError):
+        index.select(idle=True, min_idle=60)
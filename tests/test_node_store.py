@@ -0,0 +1,79 @@
+import pytest
+
+from node_store import FilterSyntaxError, NodeStore, compile_filter
+
+
+class FakeRestClient:
+
+    def __init__(self, records) -> None:
+        self.records = records
+
+    def poll_cluster_nodes(self, cluster_name, etag=None, params=None):
+        return "1", [dict(record) for record in self.records]
+
+
+RECORDS = [
+    {"NodeId": "1", "Name": "execute-1", "Status": "Ready", "MachineType": "Standard_F2s_v2",
+     "CoreCount": 2, "Interruptible": False, "Configuration": {"Slots": 2}},
+    {"NodeId": "2", "Name": "execute-2", "Status": "Failed", "MachineType": "Standard_F4s_v2",
+     "CoreCount": 4, "Interruptible": True, "Configuration": {"Slots": 4}},
+    {"NodeId": "3", "Name": "hpc-1", "Status": "Off", "MachineType": "Standard_HB120rs_v3",
+     "CoreCount": 120, "Interruptible": False},
+]
+
+
+@pytest.fixture
+def store():
+    store = NodeStore()
+    store.sync(FakeRestClient(RECORDS), "demo")
+    yield store
+    store.close()
+
+
+def _names(store, expr):
+    return [row["Name"] for row in store.query("demo", expr, ["Name"])]
+
+
+@pytest.mark.parametrize("expr, names", [
+    ('Status == "ready"', ["execute-1"]),
+    ('Status != "Ready"', ["execute-2", "hpc-1"]),
+    ("CoreCount < 4", ["execute-1"]),
+    ("CoreCount <= 4", ["execute-1", "execute-2"]),
+    ("CoreCount > 4", ["hpc-1"]),
+    ("CoreCount >= 4", ["execute-2", "hpc-1"]),
+    ("Interruptible == true", ["execute-2"]),
+    ("Configuration.Slots =?= undefined", ["hpc-1"]),
+    ("Configuration.Slots =!= undefined", ["execute-1", "execute-2"]),
+    ('Name =~ "^execute-[0-9]$"', ["execute-1", "execute-2"]),
+    ('MachineType in {"standard_f2s_v2", "Standard_HB120rs_v3"}', ["execute-1", "hpc-1"]),
+    ('!(Status == "Ready")', ["execute-2", "hpc-1"]),
+    ('Status == "Off" || CoreCount == 2', ["execute-1", "hpc-1"]),
+    ('(Status == "Ready" || Status == "Failed") && CoreCount > 2', ["execute-2"]),
+])
+def test_filter_operators(store, expr, names):
+    assert _names(store, expr) == names
+
+
+def test_non_indexed_attribute_names_are_case_insensitive(store):
+    assert _names(store, "corecount > 4") == ["hpc-1"]
+    assert _names(store, "configuration.slots == 4") == ["execute-2"]
+    assert [row["corecount"] for row in store.query("demo", "CORECOUNT == 2", ["corecount"])] == [2]
+
+
+@pytest.mark.parametrize("expr", [
+    'Status == "Ready',
+    'Status == "Ready" &&',
+    '(Status == "Ready"',
+    'Status == "Ready")',
+    'MachineType in {"a", "b"',
+    "CoreCount == 2 $",
+    "== 2",
+])
+def test_filter_syntax_errors(expr):
+    with pytest.raises(FilterSyntaxError):
+        compile_filter(expr)
+
+
+def test_empty_filter_matches_everything(store):
+    assert compile_filter("  ") == ("1", [])
+    assert len(_names(store, None)) == len(RECORDS)
@@ -0,0 +1,45 @@
+from reaper import FailedNodeReaper, ReaperPolicy
+
+
+class FakeCluster:
+
+    cluster_name = "test"
+
+    def __init__(self, nodes) -> None:
+        self.listing = {node["NodeId"]: node for node in nodes}
+        self.terminated = []
+
+    def poll_nodes(self, attrs=None, etag=None, params=None):
+        return None, [dict(node) for node in self.listing.values()]
+
+    def nodes_by_operation_id(self, operation_id):
+        return {"nodes": []}
+
+    def terminate(self, node_ids, chunk_size=100):
+        self.terminated.extend(node_ids)
+        return {"status": "success", "chunks": [{"items": list(node_ids), "status": "terminated",
+                                                 "response": {"operationId": "op"}}]}
+
+
+def _nodes():
+    return [{"NodeId": "n{}".format(i), "Name": "n{}".format(i), "Status": "Failed", "Template": "execute"}
+            for i in range(8)] + [{"NodeId": "ok", "Name": "ok", "Status": "Ready", "Template": "execute"}]
+
+
+def test_single_cycle_runs_resume_failure_age_from_state_file(tmp_path):
+    state_file = str(tmp_path / "reaper.json")
+    policy = ReaperPolicy(min_failed_age=300, max_nodearray_fraction=1.0)
+    cluster = FakeCluster(_nodes())
+
+    first = FailedNodeReaper(cluster, policy, state_file=state_file, clock=lambda: 1000.0)
+    assert first.cycle().get("terminate", 0) == 0
+
+    # a later cron run, in a new process
+    second = FailedNodeReaper(cluster, policy, state_file=state_file, clock=lambda: 1400.0)
+    stats = second.cycle()
+    assert stats["terminate"] == 8
+    assert sorted(cluster.terminated) == sorted("n{}".format(i) for i in range(8))
+
+    # the requested terminations are remembered too
+    third = FailedNodeReaper(cluster, policy, state_file=state_file, clock=lambda: 1500.0)
+    assert third.cycle().get("terminate", 0) == 0
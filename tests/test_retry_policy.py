@@ -0,0 +1,89 @@
+import pytest
+
+from retry_policy import BOOTUP_POLICY, CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class RetryableError(Exception):
+    pass
+
+
+def _fail(error):
+    def fn():
+        raise error
+    return fn
+
+
+def test_half_open_trial_with_non_retryable_exception_reopens():
+    clock = FakeClock()
+    breaker = CircuitBreaker("cc", failure_threshold=1, reset_timeout=30, clock=clock)
+    policy = RetryPolicy(max_attempts=1, retry_on=(RetryableError,), breaker=breaker,
+                         sleep=clock.sleep, clock=clock)
+
+    with pytest.raises(RetryableError):
+        policy.call(_fail(RetryableError()))
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.now += 31
+    # the trial call fails with an exception the policy does not retry
+    with pytest.raises(ValueError):
+        policy.call(_fail(ValueError("connection reset")))
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # after the next reset timeout a new trial is let through instead of failing forever
+    clock.now += 31
+    assert policy.call(lambda: "ok") == "ok"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_circuit_fails_fast():
+    clock = FakeClock()
+    breaker = CircuitBreaker("cc", failure_threshold=2, reset_timeout=30, clock=clock)
+    policy = RetryPolicy(max_attempts=2, retry_on=(RetryableError,), breaker=breaker,
+                         sleep=clock.sleep, clock=clock)
+
+    with pytest.raises(RetryableError):
+        policy.call(_fail(RetryableError()))
+    with pytest.raises(CircuitOpenError):
+        policy.call(lambda: "ok")
+
+
+def test_call_deadline_caps_attempt_timeouts_and_total_time():
+    clock = FakeClock()
+    timeouts = []
+
+    def fn(timeout=None):
+        timeouts.append(timeout)
+        clock.now += timeout
+        raise RetryableError()
+
+    policy = RetryPolicy(max_attempts=5, base_delay=0.01, deadline=120, retry_on=(RetryableError,),
+                         sleep=clock.sleep, clock=clock)
+    with pytest.raises(RetryableError):
+        policy.call(fn, timeout=4, deadline=10)
+    assert clock.now <= 10
+    assert timeouts[:2] == [4, 4]
+    assert timeouts[2] < 4
+
+
+def test_bootup_policy_does_not_retry_errors_after_the_request_was_sent():
+    calls = []
+
+    def bootup():
+        calls.append(1)
+        raise RuntimeError("read timed out")
+
+    with pytest.raises(RuntimeError):
+        BOOTUP_POLICY.call(bootup)
+    assert len(calls) == 1
@@ -0,0 +1,73 @@
+import types
+
+from sku_scoring import SkuHistory, allocate_with_failover, score_skus
+
+
+def _sku(available_count: int) -> types.SimpleNamespace:
+    return types.SimpleNamespace(available_count=available_count, available_core_quota=None, vcpu_count=4)
+
+
+def test_failure_penalty_grows_with_failure_count():
+    history = SkuHistory()
+    history.record_failure("A", 1)
+    history.record_failure("B", 500)
+    scores = dict(score_skus({"A": _sku(5), "B": _sku(5), "C": _sku(5)}, history))
+    assert scores["C"] > scores["A"] > scores["B"]
+
+
+def test_history_round_trips_through_state_file(tmp_path):
+    history = SkuHistory()
+    history.record_failure("A", 2)
+    history.mark_exhausted("B")
+    path = str(tmp_path / "state" / "sku_history.json")
+    history.save(path)
+
+    loaded = SkuHistory.load(path)
+    assert round(loaded.failures("A")) == 2
+    assert loaded.is_exhausted("B")
+    assert "B" not in dict(score_skus({"A": _sku(5), "B": _sku(5)}, loaded))
+
+
+class FakeCapacity:
+    """by_sku() reports available counts that are not updated by allocate(), like a cached bucket
+    list. Each SKU can really deliver delivers[vm_size] nodes."""
+
+    def __init__(self, available, delivers) -> None:
+        self.available = available
+        self.delivers = dict(delivers)
+        self.calls = []
+
+    def by_sku(self, nodearray):
+        return {vm_size: _sku(count) for vm_size, count in self.available.items()}
+
+    def allocate(self, constraints, node_count, **kwargs):
+        vm_size = constraints["node.vm_size"]
+        self.calls.append((vm_size, node_count, kwargs))
+        got = min(node_count, self.delivers[vm_size])
+        self.delivers[vm_size] -= got
+        return types.SimpleNamespace(nodes=[object()] * got)
+
+
+def test_failover_replans_shortfall_on_other_skus():
+    history = SkuHistory()
+    capacity = FakeCapacity({"A": 10, "B": 10, "C": 10}, {"A": 1, "B": 10, "C": 10})
+    allocated = allocate_with_failover(capacity, "execute", 12, history)
+    assert sum(allocated.values()) == 12
+    assert allocated["A"] == 1
+    assert history.is_exhausted("A")
+    assert all(kwargs["allow_existing"] for _, _, kwargs in capacity.calls)
+
+
+def test_failover_stops_when_split_is_capped_and_nothing_is_exhausted():
+    # the buckets only have room for 4 of the 10 nodes, each SKU delivers its full share
+    capacity = FakeCapacity({"A": 2, "B": 2}, {"A": 100, "B": 100})
+    allocated = allocate_with_failover(capacity, "execute", 10, SkuHistory())
+    assert allocated == {"A": 2, "B": 2}
+    assert len(capacity.calls) == 2
+
+
+def test_failover_counts_active_nodes_once():
+    capacity = FakeCapacity({"A": 10}, {"A": 100})
+    allocated = allocate_with_failover(capacity, "execute", 3, SkuHistory(), active={"A": 2})
+    assert allocated == {"A": 3}
+    assert capacity.calls[0][1] == 5
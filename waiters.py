@@ -0,0 +1,137 @@
+"""Waiting for cluster nodes to reach a state
+
+wait_for_node_states replaces fixed-interval polling of the whole cluster: it polls with
+adaptive backoff (fast while nodes are changing, slower while nothing moves), only evaluates
+and reports the nodes that have not reached the target state yet, uses conditional requests
+(If-None-Match) so an unchanged listing is not re-sent or re-parsed when the server supports
+ETags, and returns as soon as every node is in the target state or any node has failed.
+Poll intervals are jittered so many waiters started together do not poll in lockstep.
+"""
+import logging
+import random
+import time
+import typing
+
+from retry_policy import CircuitOpenError
+
+
+WAIT_ATTRS = ["NodeId", "Name", "Status"]
+
+
+class NodeStateWait:
+    """Result of wait_for_node_states"""
+
+    def __init__(self) -> None:
+        # "reached", "failed" or "timeout"
+        self.outcome: typing.Optional[str] = None
+        self.elapsed = 0.0
+        self.polls = 0
+        self.not_modified = 0
+        # seconds during which at least one node was observed in each Status
+        self.phases: typing.Dict[str, float] = {}
+        self.failed_nodes: typing.List[typing.Dict] = []
+        self.pending: typing.Dict[str, str] = {}
+        # seconds from the start of the wait until each node was first seen in a target state
+        self.reached_at: typing.Dict[str, float] = {}
+
+    def __repr__(self) -> str:
+        return "NodeStateWait(outcome={}, elapsed={:.1f}s, polls={}, not_modified={}, phases={}, pending={})".format(
+            self.outcome, self.elapsed, self.polls, self.not_modified,
+            {k: round(v, 1) for k, v in self.phases.items()}, len(self.pending))
+
+
+def wait_for_node_states(rest_client, cluster_name: str, target_states: typing.Iterable[str] = ("Off",),
+                         failed_states: typing.Iterable[str] = ("Failed",), timeout: float = 6000,
+                         initial_interval: float = 2, max_interval: float = 30, backoff: float = 1.5,
+                         node_filter: typing.Optional[typing.Callable[[typing.Dict], bool]] = None,
+                         jitter: float = 0.2, params=None, stop_on_failure: bool = True,
+                         attrs: typing.Optional[typing.Sequence[str]] = None,
+                         on_transition: typing.Optional[typing.Callable[[typing.Dict, typing.Optional[str], float], None]] = None,
+                         logger=None, sleep=time.sleep, clock=time.monotonic,
+                         rng: typing.Optional[random.Random] = None) -> NodeStateWait:
+    """Polls until every node (matching node_filter) is in one of target_states, any node is in
+    one of failed_states or timeout seconds have passed. Prints each node's state transitions.
+    params narrow the listing server side, e.g. {"operation": operation_id}. With stop_on_failure
+    False, failed nodes count as done and the wait goes on until no node is pending.
+    on_transition(record, previous_status, elapsed) is called for every observed change, with the
+    record projected onto WAIT_ATTRS plus attrs."""
+    logger = logger or logging.getLogger()
+    rng = rng or random.Random()
+    poll_attrs = WAIT_ATTRS + [attr for attr in (attrs or []) if attr not in WAIT_ATTRS]
+    target_states = set(target_states)
+    failed_states = set(failed_states)
+
+    result = NodeStateWait()
+    last_status: typing.Dict[str, str] = {}
+    etag = None
+    interval = initial_interval
+    start = clock()
+    last_poll = start
+    active_statuses: typing.Set[str] = set()
+
+    while True:
+        try:
+            etag, records = rest_client.poll_cluster_nodes(cluster_name, attrs=poll_attrs, etag=etag, params=params)
+        except CircuitOpenError as e:
+            # the server is failing, keep waiting without adding load until it recovers or we time out
+            now = clock()
+            if now - start >= timeout:
+                result.outcome = "timeout"
+                result.elapsed = now - start
+                return result
+            logger.warning("Waiting for %s: %s", cluster_name, e)
+            interval = max_interval
+            sleep(min(interval, max(0.0, timeout - (now - start))))
+            continue
+        now = clock()
+        result.polls += 1
+
+        # attribute the time since the previous poll to the statuses that were active during it
+        for status in active_statuses:
+            result.phases[status] = result.phases.get(status, 0.0) + (now - last_poll)
+        last_poll = now
+
+        changed = False
+        if records is None:
+            result.not_modified += 1
+        else:
+            pending: typing.Dict[str, str] = {}
+            failed = []
+            for record in records:
+                if node_filter and not node_filter(record):
+                    continue
+                node_id = record["NodeId"]
+                status = record["Status"]
+                if last_status.get(node_id) != status:
+                    changed = True
+                    if status not in target_states or node_id in last_status:
+                        print("{} {} -> {}".format(record["Name"], last_status.get(node_id, "-"), status))
+                    if on_transition:
+                        on_transition(record, last_status.get(node_id), now - start)
+                    last_status[node_id] = status
+                    if status in target_states and node_id not in result.reached_at:
+                        result.reached_at[node_id] = now - start
+                if status in failed_states:
+                    failed.append(record)
+                elif status not in target_states:
+                    pending[node_id] = status
+            result.pending = pending
+            result.failed_nodes = failed
+            active_statuses = set(pending.values())
+
+        if result.failed_nodes and (stop_on_failure or (records is not None and not result.pending)):
+            result.outcome = "failed"
+        elif records is not None and not result.pending:
+            result.outcome = "reached"
+        elif now - start >= timeout:
+            result.outcome = "timeout"
+
+        if result.outcome:
+            result.elapsed = now - start
+            logger.info("Waited for %s: %s", cluster_name, result)
+            return result
+
+        # poll quickly while nodes are transitioning, back off while nothing changes
+        interval = initial_interval if changed else min(max_interval, interval * backoff)
+        delay = interval * rng.uniform(1 - jitter, 1 + jitter)
+        sleep(min(delay, max(0.0, timeout - (now - start))))